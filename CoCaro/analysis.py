@@ -0,0 +1,206 @@
+# Phát lại và phân tích offline các trận trong game_history.db
+import argparse, json, os, sqlite3, sys, time
+from collections import Counter
+from concurrent.futures import Executor, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from common import COORDS, Board, find_win_line
+from history import REPLAY_GAP, decode_line, iter_stored_moves, load_replay, stored_size
+
+# hướng của đường thắng theo (dx, dy) giữa hai ô liên tiếp
+DIRECTIONS = {(1, 0): "ngang", (0, 1): "dọc", (1, 1): "chéo", (1, -1): "chéo ngược"}
+# 8 phép đối xứng của bàn vuông, để gộp các khai cuộc chỉ khác nhau do xoay/lật
+SYMMETRIES = [lambda x, y: (x, y), lambda x, y: (-y, x), lambda x, y: (-x, -y), lambda x, y: (y, -x),
+              lambda x, y: (-x, y), lambda x, y: (y, x), lambda x, y: (x, -y), lambda x, y: (-y, -x)]
+OPENING_MOVES = 3
+MAX_GAP = 60  # khoảng cách giữa hai nước >= MAX_GAP giây gộp vào một ô
+
+def open_ro(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+def iter_chunks(db_path: str, chunk: int = 500) -> Iterator[List[Tuple]]:
+    """Đọc matches theo khoá id, mỗi lần chunk dòng (id, player_x, player_o, winner, moves, win_line)."""
+    conn = open_ro(db_path)
+    try:
+        # mở read-only nên không nâng cấp schema được: DB cũ thiếu cột thì coi như NULL
+        has_line = any(r[1] == "win_line" for r in conn.execute("PRAGMA table_info(matches)"))
+        sql = (f"SELECT id, player_x, player_o, winner, moves, {'win_line' if has_line else 'NULL'} "
+               "FROM matches WHERE id > ? ORDER BY id LIMIT ?")
+        last = ""
+        while True:
+            rows = conn.execute(sql, (last, chunk)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield rows
+    finally:
+        conn.close()
+
+def bounded_map(pool: Executor, fn: Callable, items: Iterable, inflight: int) -> Iterator:
+    """Như pool.map nhưng chỉ rút tiếp từ items khi số việc đang chạy < inflight, nên
+    tiến trình đọc không kéo cả DB vào bộ nhớ khi các worker chạy chậm hơn. Không giữ thứ tự."""
+    pending = set()
+    for item in items:
+        pending.add(pool.submit(fn, item))
+        if len(pending) >= inflight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            yield f.result()
+
+def opening_key(moves: List[Tuple]) -> str:
+    """OPENING_MOVES nước đầu, tính theo độ lệch so với nước đầu tiên và lấy dạng nhỏ nhất
+    trong 8 phép đối xứng."""
+    x0, y0 = moves[0][0], moves[0][1]
+    rel = [(x - x0, y - y0) for x, y, _, _ in moves[1:OPENING_MOVES]]
+    return " ".join(f"{dx},{dy}" for dx, dy in min([f(dx, dy) for dx, dy in rel] for f in SYMMETRIES))
+
+def analyze_chunk(rows: List[Tuple]) -> Dict:
+    """Chạy trong process pool: thống kê một chunk, trả về các Counter để gộp."""
+    out = {k: Counter() for k in ("results", "first_moves", "openings", "opening_x_wins",
+                                  "gaps", "lengths", "line_dirs", "line_cells")}
+    out["bad_rows"] = 0
+    for _, px, po, winner, data, stored_line in rows:
+        try:
+            moves = list(iter_stored_moves(data))
+            size = stored_size(data)
+            line = decode_line(stored_line)
+        except (ValueError, KeyError, TypeError, IndexError):
+            out["bad_rows"] += 1
+            continue
+        result = "X" if winner == px else ("O" if winner == po else "draw")
+        out["results"][result] += 1
+        out["lengths"][len(moves)] += 1
+        if not moves:
+            continue
+        x, y = moves[0][0], moves[0][1]
+        out["first_moves"][f"{COORDS[x] if x < len(COORDS) else x}{y+1}"] += 1
+        if len(moves) >= OPENING_MOVES:
+            key = opening_key(moves)
+            out["openings"][key] += 1
+            out["opening_x_wins"][key] += result == "X"
+        ts = [m[3] for m in moves]
+        out["gaps"].update([d if d < MAX_GAP else MAX_GAP for d in map(int.__sub__, ts[1:], ts)])
+        if result == "draw":
+            continue
+        if line is None:
+            # dòng cũ chưa có cột win_line: dựng bitboard thẳng từ danh sách (X đi các nước
+            # chẵn, O các nước lẻ, mỗi ô một bit riêng) rồi dò lại
+            board, stride = Board(size), size + 1
+            board.x_bits = sum(1 << (my*stride + mx) for mx, my, _, _ in moves[0::2])
+            board.o_bits = sum(1 << (my*stride + mx) for mx, my, _, _ in moves[1::2])
+            x, y, s, _ = moves[-1]
+            line = find_win_line(board, x, y, s) if s == result else []
+        if not line:
+            out["line_dirs"]["không có (hết giờ/bỏ cuộc)"] += 1
+            continue
+        (ax, ay), (bx, by) = line[0], line[1]
+        out["line_dirs"][DIRECTIONS.get((bx - ax, by - ay), "?")] += 1
+        out["line_cells"].update(map(tuple, line))
+    return out
+
+def merge(total: Dict, part: Dict):
+    for k, v in part.items():
+        if isinstance(v, Counter):
+            total.setdefault(k, Counter()).update(v)
+        else:
+            total[k] = total.get(k, 0) + v
+
+def percentile(hist: Counter, q: float):
+    n = sum(hist.values())
+    if not n:
+        return None
+    acc = 0
+    for v in sorted(hist):
+        acc += hist[v]
+        if acc >= q * n:
+            return v
+
+def most_common(c: Counter, top: int) -> List:
+    """Như Counter.most_common nhưng hoà thì xếp theo khoá, để kết quả không phụ thuộc thứ tự gộp."""
+    return sorted(c.items(), key=lambda kv: (-kv[1], kv[0]))[:top]
+
+def report(total: Dict, top: int) -> Dict:
+    games = sum(total["results"].values())
+    lengths = total["lengths"]
+    gaps = total["gaps"]
+    return {
+        "games": games,
+        "bad_rows": total["bad_rows"],
+        "results": dict(total["results"]),
+        "avg_moves": round(sum(k*v for k, v in lengths.items()) / games, 1) if games else None,
+        "first_moves": most_common(total["first_moves"], top),
+        "openings": [{"moves": k, "games": c, "x_win_rate": round(total["opening_x_wins"][k] / c, 3)}
+                     for k, c in most_common(total["openings"], top)],
+        "move_time_s": {"p50": percentile(gaps, 0.5), "p90": percentile(gaps, 0.9), "p99": percentile(gaps, 0.99),
+                        "histogram": {(f"{k}+" if k == MAX_GAP else str(k)): v for k, v in sorted(gaps.items())}},
+        "win_line": {"direction": dict(total["line_dirs"]),
+                     "hot_cells": [[f"{COORDS[x] if x < len(COORDS) else x}{y+1}", c]
+                                   for (x, y), c in most_common(total["line_cells"], top)]},
+    }
+
+def analyze(db_path: str, chunk: int = 500, workers: int = 0, top: int = 10) -> Dict:
+    total: Dict = {}
+    chunks = iter_chunks(db_path, chunk)
+    if workers == 1:
+        for rows in chunks:
+            merge(total, analyze_chunk(rows))
+    else:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            for part in bounded_map(pool, analyze_chunk, chunks, 2 * workers):
+                merge(total, part)
+    if not total:
+        total = analyze_chunk([])
+    return report(total, top)
+
+def replay(db_path: str, match_id: str, speed: float):
+    """In bàn cờ sau từng nước, theo nhịp thời gian thật chia cho speed (0 = không chờ)."""
+    conn = open_ro(db_path)
+    try:
+        found = load_replay(conn, match_id)
+    finally:
+        conn.close()
+    if found is None:
+        sys.exit(f"match {match_id} not found")
+    info, size, moves = found
+    print(f"{info['id']}: {info['player_x']} (X) vs {info['player_o']} (O), {info['started_at']} -> {info['finished_at']}")
+    board = Board(size)
+    lo, hi = REPLAY_GAP
+    for i, (x, y, s, ts) in enumerate(moves):
+        if i and speed:
+            time.sleep(min(hi, max(lo, ts - moves[i-1][3])) / speed)
+        board.place(x, y, s)
+        print(f"\n{i+1}. {s} {COORDS[x] if x < len(COORDS) else x}{y+1}")
+        for row_no, row in enumerate(board.rows(), 1):
+            print(f"{row_no:>2} {' '.join(row)}")
+    line = info["win_line"]
+    if line is None:
+        line = find_win_line(board, *moves[-1][:3]) if moves and info["winner"] in (info["player_x"], info["player_o"]) else []
+    print(f"\nwinner: {info['winner']}" + (f" | đường thắng: {' '.join(f'{COORDS[x]}{y+1}' for x, y in line)}" if line else ""))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phát lại / phân tích các trận đã lưu")
+    parser.add_argument("--db", default="game_history.db")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("replay", help="phát lại một trận trên terminal")
+    p.add_argument("match_id")
+    p.add_argument("--speed", type=float, default=1.0, help="hệ số tốc độ (0 = in ngay)")
+    p = sub.add_parser("analyze", help="thống kê khai cuộc, thời gian mỗi nước và đường thắng")
+    p.add_argument("--chunk", type=int, default=500, help="số trận mỗi lần đọc / mỗi việc gửi cho worker")
+    p.add_argument("--workers", type=int, default=0, help="số tiến trình (0 = số CPU, 1 = chạy tại chỗ)")
+    p.add_argument("--top", type=int, default=10)
+    p.add_argument("--out", help="ghi kết quả JSON ra file (mặc định stdout)")
+    args = parser.parse_args()
+    if args.command == "replay":
+        replay(args.db, args.match_id, args.speed)
+    else:
+        text = json.dumps(analyze(args.db, args.chunk, args.workers, args.top), indent=2, ensure_ascii=False)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
@@ -0,0 +1,228 @@
+# Microbenchmark cho các đường nóng: common.py, codec và handle_move chạy trong tiến trình
+import argparse, asyncio, itertools, json, os, random, sys, tempfile, timeit, tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from codec import CODECS
+from common import BOARD_SIZE, Board, check_win, encode_json, find_win_line, parse_coord, recv_json
+
+SEED = 20240601
+N = BOARD_SIZE
+
+# các gói hay gặp nhất trên dây, theo tỉ lệ gần đúng của một ván (nước đi chiếm phần lớn)
+MESSAGES = [
+    {"type": "move", "x": 7, "y": 7},
+    {"type": "move_ok", "x": 7, "y": 7, "symbol": "X", "seq": 12},
+    {"type": "opponent_move", "x": 8, "y": 6, "symbol": "O", "seq": 13},
+    {"type": "your_turn", "deadline": 1760000000, "seq": 13},
+    {"type": "move_ok", "x": 9, "y": 5, "symbol": "X", "seq": 14},
+    {"type": "opponent_move", "x": 3, "y": 11, "symbol": "O", "seq": 15},
+    {"type": "your_turn", "deadline": 1760000015, "seq": 15},
+    {"type": "chat", "from": "alice", "text": "gg, ván hay quá"},
+    {"type": "match_start", "id": "M1760000000000", "you": "X", "opponent": "bob", "size": 15,
+     "time": {"per_move": 15, "total": None, "increment": 0}, "seq": 0},
+    {"type": "user_joined", "users": [f"player{i}" for i in range(20)]},
+]
+COORD_TOKENS = ["H8", "8,7", "a1", "o15", " h 8 ", "7 7", "z9", "16,x"]
+
+def drive(coro):
+    """Chạy tới hết một coroutine không có điểm chờ thật (dữ liệu đã sẵn trong buffer,
+    handle_move...) mà không qua event loop, để không đo nhầm chi phí lập lịch."""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("coroutine suspended")
+
+def random_board(stones: int, rng: random.Random) -> Tuple[Board, int, int, str]:
+    """stones quân X/O xen kẽ ở ô ngẫu nhiên, không bên nào có năm; kèm nước cuối."""
+    while True:
+        b, cells = Board(N), rng.sample(range(N*N), stones)
+        for i, c in enumerate(cells):
+            s = "XO"[i % 2]
+            b.place(c % N, c // N, s)
+            if check_win(b, c % N, c // N, s):
+                break
+        else:
+            c = cells[-1]
+            return b, c % N, c // N, "XO"[(stones - 1) % 2]
+
+def near_win(broken: bool) -> Tuple[Board, int, int, str]:
+    """Bốn quân X liền nhau trên đường chéo và nước thứ năm vừa đặt; broken=True thì chừa
+    một ô trống ở giữa (check_win phải dò hết các hướng rồi trả về False)."""
+    rng = random.Random(SEED)
+    b, _, _, _ = random_board(30, rng)
+    b.x_bits = b.o_bits = b.count = 0
+    line = [(3 + k, 3 + k) for k in range(5)]
+    for i, (x, y) in enumerate(line):
+        if not (broken and i == 2):
+            b.place(x, y, "X")
+    for x, y in [(3, 4), (5, 3), (8, 7), (6, 9), (2, 2)]:
+        b.place(x, y, "O")
+    return (b, *line[-1], "X")
+
+def reader_cases(read: Callable, encode: Callable, msgs: List[Dict]) -> Callable:
+    """Hàm đọc một gói mỗi lần gọi từ StreamReader đã có sẵn dữ liệu (nạp lại khi cạn)."""
+    reps = 500
+    chunk = b"".join(map(encode, msgs)) * reps
+    reader = asyncio.StreamReader(limit=len(chunk) + 1)
+    left = 0
+    def step():
+        nonlocal left
+        if not left:
+            reader.feed_data(chunk)
+            left = len(msgs) * reps
+        left -= 1
+        return drive(read(reader))
+    return step
+
+def move_path() -> Tuple[Callable, Callable]:
+    """handle_move trong tiến trình: hai người chơi với outbox giả (chỉ mã hoá gói, không
+    ghi socket) đi lần lượt một chuỗi nước cố định không ai thắng, hết chuỗi thì mở ván mới."""
+    from server import CaroServer, Client, TimeControl
+
+    class NullBox:
+        codec = CODECS["frame"]
+        closed = False
+        dropped = 0
+        def send(self, obj): self.codec.encode(obj); return True
+        def put(self, data): return True
+        offer = put
+        def close(self): pass
+
+    db = os.path.join(tempfile.mkdtemp(prefix="caro-bench-"), "bench.db")
+    server = CaroServer(port=0, db_path=db, bot_name=None, rate_limits=None)
+    a, b = (Client(name, None, None, outbox=NullBox()) for name in ("a", "b"))
+    server.clients.update(a=a, b=b)
+    board, _, _, _ = random_board(60, random.Random(SEED))
+    script = [(x, y) for y in range(N) for x in range(N) if board.get(x, y) != "."]
+    script = [xy for xy in script if board.get(*xy) == "X"][:30] + [xy for xy in script if board.get(*xy) == "O"][:30]
+    script = [script[i // 2 + (i % 2)*30] for i in range(60)]  # X, O xen kẽ
+    state = {"i": len(script)}
+
+    def new_match():
+        for m in list(server.matches.values()):
+            server.timers.cancel(m.id)
+            del server.matches[m.id]
+        a.in_match = b.in_match = None
+        server.add_invite("a", "b", TimeControl())
+        drive(server.handle_accept(b, "a"))
+        state["i"] = 0
+
+    def step():
+        i = state["i"]
+        if i == len(script):
+            new_match()
+            i = 0
+        x, y = script[i]
+        drive(server.dispatch(a if i % 2 == 0 else b, {"type": "move", "x": x, "y": y}))
+        state["i"] = i + 1
+
+    def close():
+        server.history.close()
+        server.history_reader.close()
+    return step, close
+
+def cases() -> Tuple[Dict[str, Callable], Callable]:
+    rng = random.Random(SEED)
+    sparse, dense = random_board(10, rng), random_board(110, rng)
+    win, broken = near_win(False), near_win(True)
+    rows = win[0].rows()
+    frame = CODECS["frame"]
+    coords = itertools.cycle(COORD_TOKENS).__next__
+    msgs = itertools.cycle(MESSAGES).__next__
+    move, close = move_path()
+    out = {
+        "check_win/sparse": lambda: check_win(*sparse),
+        "check_win/dense": lambda: check_win(*dense),
+        "check_win/near_win": lambda: check_win(*win),
+        "check_win/broken_four": lambda: check_win(*broken),
+        "check_win/rows": lambda: check_win(rows, *win[1:]),  # đường cũ: bàn dạng list, đổi sang Board mỗi lần
+        "find_win_line/near_win": lambda: find_win_line(*win),
+        "parse_coord/mix": lambda: parse_coord(coords()),
+        "encode_json/mix": lambda: encode_json(msgs()),
+        "recv_json/mix": reader_cases(recv_json, encode_json, MESSAGES),
+        "frame_encode/mix": lambda: frame.encode(msgs()),
+        "frame_read/mix": reader_cases(frame.read, frame.encode, MESSAGES),
+        "handle_move/inproc": move,
+    }
+    return out, close
+
+def ops_per_sec(fn: Callable, repeat: int) -> float:
+    t = timeit.Timer(fn)
+    n, _ = t.autorange()
+    return n / min(t.repeat(repeat, n))
+
+def allocations(fn: Callable, n: int = 1000) -> Tuple[float, float]:
+    """(byte cấp phát đỉnh trong một lần gọi, byte còn giữ lại trung bình mỗi lần gọi)
+    theo tracemalloc; số sau khác 0 kéo dài là dấu hiệu rò bộ nhớ."""
+    fn()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(50):
+            cur = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - cur)
+        cur = tracemalloc.get_traced_memory()[0]
+        for _ in range(n):
+            fn()
+        kept = (tracemalloc.get_traced_memory()[0] - cur) / n
+    finally:
+        tracemalloc.stop()
+    return peak, kept
+
+def run(names: Optional[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    all_cases, close = cases()
+    results = {}
+    try:
+        for name, fn in all_cases.items():
+            if names and names not in name:
+                continue
+            ops = ops_per_sec(fn, repeat)
+            peak, kept = allocations(fn)
+            results[name] = {"ops": round(ops, 1), "alloc": peak, "kept": round(kept, 1)}
+    finally:
+        close()
+    return results
+
+def report(results: Dict[str, Dict[str, float]], baseline: Optional[Dict], tolerance: float) -> List[str]:
+    """In bảng kết quả; trả về tên các case chậm hơn baseline quá tolerance."""
+    base = (baseline or {}).get("cases", {})
+    slower = []
+    print(f"{'case':<24}{'ops/s':>12}{'alloc B':>10}{'kept B':>9}" + (f"{'baseline':>12}{'delta':>9}" if base else ""))
+    for name, r in results.items():
+        line = f"{name:<24}{r['ops']:>12,.0f}{r['alloc']:>10,}{r['kept']:>9.1f}"
+        if name in base:
+            delta = r["ops"] / base[name]["ops"] - 1
+            flag = " !" if delta < -tolerance else ""
+            if flag: slower.append(name)
+            line += f"{base[name]['ops']:>12,.0f}{delta:>+8.1%}{flag}"
+        print(line)
+    return slower
+
+async def main(args) -> int:
+    # StreamReader cần event loop đang chạy; bản thân các phép đo chạy đồng bộ bên trong
+    results = run(args.filter, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    slower = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "cases": results}, f, indent=2)
+        print(f"baseline saved to {args.save}")
+    if slower:
+        print(f"chậm hơn baseline quá {args.tolerance:.0%}: {', '.join(slower)}")
+    return 1 if slower else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark các đường nóng; so sánh với baseline đã lưu")
+    parser.add_argument("--filter", help="chỉ chạy case có tên chứa chuỗi này")
+    parser.add_argument("--repeat", type=int, default=5, help="số lần lặp lấy kết quả tốt nhất")
+    parser.add_argument("--save", help="ghi kết quả ra file JSON làm baseline")
+    parser.add_argument("--compare", help="so sánh với baseline JSON (thoát mã 1 nếu có case chậm hơn)")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="mức chậm hơn baseline được bỏ qua (0.10 = 10%%)")
+    sys.exit(asyncio.run(main(parser.parse_args())))
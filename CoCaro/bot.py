@@ -0,0 +1,345 @@
+# Đối thủ máy cho server: engine Gomoku + lớp nối engine vào CaroServer
+import asyncio, json, random, time
+from concurrent.futures import Executor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from codec import LINE_JSON
+from common import BOARD_SIZE, DIRS, Board
+
+if TYPE_CHECKING:
+    from server import CaroServer, Client
+
+WIN = 10**7
+# điểm của một cửa sổ 5 ô chỉ chứa quân của một bên, theo số quân trong cửa sổ;
+# tứ mở xuất hiện ở hai cửa sổ 4 quân, tam mở ở vài cửa sổ 3 quân, ...
+WEIGHTS = (0, 2, 24, 320, 6000, WIN)
+TT_SIZE = 1 << 18
+CANDIDATES = 12
+MIN_SEARCH = 0.2  # còn ít thời gian hơn thế khi tới lượt vào pool thì đi nước nhanh luôn
+
+@lru_cache(maxsize=None)
+def geometry(size: int):
+    """Các cửa sổ 5 ô trên mọi đường theo DIRS, cửa sổ chứa mỗi ô và lân cận bán kính 2."""
+    windows: List[Tuple[int, ...]] = []
+    for y in range(size):
+        for x in range(size):
+            for dx, dy in DIRS:
+                ex, ey = x + 4*dx, y + 4*dy
+                if 0 <= ex < size and 0 <= ey < size:
+                    windows.append(tuple((y + k*dy)*size + x + k*dx for k in range(5)))
+    cell_windows: List[List[int]] = [[] for _ in range(size*size)]
+    for w, cells in enumerate(windows):
+        for c in cells:
+            cell_windows[c].append(w)
+    near = []
+    for c in range(size*size):
+        x, y = c % size, c // size
+        near.append([ny*size + nx for ny in range(max(0, y-2), min(size, y+3))
+                     for nx in range(max(0, x-2), min(size, x+3)) if (nx, ny) != (x, y)])
+    return windows, cell_windows, near
+
+_rng = random.Random(20240601)
+_ZOBRIST: Dict[int, List[List[int]]] = {}
+_TT: Dict[int, Tuple[int, int, int, int]] = {}  # hash -> (depth, score, flag, best)
+EXACT, LOWER, UPPER = 0, 1, 2
+
+def zobrist(size: int) -> List[List[int]]:
+    z = _ZOBRIST.get(size)
+    if z is None:
+        z = _ZOBRIST[size] = [[0]*(size*size)] + [[_rng.getrandbits(64) for _ in range(size*size)] for _ in range(2)]
+    return z
+
+class Timeout(Exception):
+    pass
+
+class Engine:
+    """Trạng thái tìm kiếm: ô phẳng (0 trống, 1 X, 2 O) cùng số quân mỗi bên trong
+    từng cửa sổ, nên make/undo và điểm đánh giá đều cập nhật tăng dần."""
+    def __init__(self, size: int):
+        self.size = size
+        self.windows, self.cell_windows, self.near_cells = geometry(size)
+        self.cells = [0]*(size*size)
+        self.count = [[0]*len(self.windows) for _ in range(3)]  # count[side][window]
+        self.near = [0]*(size*size)
+        self.score = 0  # theo góc nhìn X
+        self.hash = 0
+        self.z = zobrist(size)
+        self.stones = 0
+        self.nodes = 0
+        self.stop_at = 0.0
+
+    @classmethod
+    def from_bits(cls, size: int, x_bits: int, o_bits: int) -> "Engine":
+        e = cls(size)
+        stride = size + 1
+        for y in range(size):
+            for x in range(size):
+                i = y*stride + x
+                if (x_bits >> i) & 1: e.make(y*size + x, 1)
+                elif (o_bits >> i) & 1: e.make(y*size + x, 2)
+        return e
+
+    @staticmethod
+    def window_value(own: int, opp: int) -> int:
+        if own and opp: return 0
+        return WEIGHTS[own] if own else -WEIGHTS[opp]
+
+    def make(self, c: int, side: int) -> bool:
+        """Đặt quân, trả về True nếu vừa tạo thành năm."""
+        cx, co = self.count[1], self.count[2]
+        mine = cx if side == 1 else co
+        val = self.window_value
+        won = False
+        delta = 0
+        for w in self.cell_windows[c]:
+            before = val(cx[w], co[w])
+            mine[w] += 1
+            delta += val(cx[w], co[w]) - before
+            if mine[w] == 5: won = True
+        self.score += delta
+        self.cells[c] = side
+        self.hash ^= self.z[side][c]
+        self.stones += 1
+        for n in self.near_cells[c]: self.near[n] += 1
+        return won
+
+    def undo(self, c: int):
+        side = self.cells[c]
+        cx, co = self.count[1], self.count[2]
+        mine = cx if side == 1 else co
+        val = self.window_value
+        delta = 0
+        for w in self.cell_windows[c]:
+            before = val(cx[w], co[w])
+            mine[w] -= 1
+            delta += val(cx[w], co[w]) - before
+        self.score += delta
+        self.cells[c] = 0
+        self.hash ^= self.z[side][c]
+        self.stones -= 1
+        for n in self.near_cells[c]: self.near[n] -= 1
+
+    def win_cells(self, side: int) -> List[int]:
+        """Các ô trống mà side đặt vào là thắng ngay."""
+        own, opp = self.count[side], self.count[3 - side]
+        out = set()
+        for w, cells in enumerate(self.windows):
+            if own[w] == 4 and opp[w] == 0:
+                for c in cells:
+                    if self.cells[c] == 0: out.add(c)
+        return list(out)
+
+    def four_moves(self, side: int) -> List[int]:
+        """Các nước tạo ra một 'tứ' (cửa sổ 4 quân + 1 ô trống) cho side."""
+        own, opp = self.count[side], self.count[3 - side]
+        out = set()
+        for w, cells in enumerate(self.windows):
+            if own[w] == 3 and opp[w] == 0:
+                for c in cells:
+                    if self.cells[c] == 0: out.add(c)
+        return list(out)
+
+    def candidates(self, side: int, limit: int = CANDIDATES, first: Optional[int] = None) -> List[int]:
+        """Ô trống cạnh quân đã có (bán kính 2), xếp theo giá trị tấn công + phòng thủ."""
+        cells, near = self.cells, self.near
+        own, opp = self.count[side], self.count[3 - side]
+        scored = []
+        for c in range(len(cells)):
+            if cells[c] or not near[c]:
+                continue
+            s = 0
+            for w in self.cell_windows[c]:
+                a, b = own[w], opp[w]
+                if not b: s += WEIGHTS[a+1] - WEIGHTS[a]
+                if not a: s += WEIGHTS[b+1] - WEIGHTS[b]
+            scored.append((s, c))
+        if not scored:
+            if self.stones == 0:
+                return [(self.size // 2)*self.size + self.size // 2]
+            return []
+        scored.sort(reverse=True)
+        out = [c for _, c in scored[:limit]]
+        if first is not None and first in out:
+            out.remove(first); out.insert(0, first)
+        elif first is not None and not cells[first]:
+            out.insert(0, first)
+        return out
+
+    def negamax(self, depth: int, alpha: int, beta: int, side: int, ply: int) -> int:
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.perf_counter() > self.stop_at:
+            raise Timeout()
+        key = self.hash ^ side
+        entry = _TT.get(key)
+        best_move = None
+        if entry is not None:
+            e_depth, e_score, e_flag, best_move = entry
+            if e_depth >= depth:
+                if e_flag == EXACT: return e_score
+                if e_flag == LOWER and e_score >= beta: return e_score
+                if e_flag == UPPER and e_score <= alpha: return e_score
+        if depth == 0:
+            return self.score if side == 1 else -self.score
+        moves = self.candidates(side, first=best_move)
+        if not moves:
+            return 0
+        alpha0, best, best_move = alpha, -WIN*2, moves[0]
+        for c in moves:
+            if self.make(c, side):
+                score = WIN - ply
+            else:
+                score = -self.negamax(depth - 1, -beta, -alpha, 3 - side, ply + 1)
+            self.undo(c)
+            if score > best:
+                best, best_move = score, c
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+        flag = UPPER if best <= alpha0 else (LOWER if best >= beta else EXACT)
+        if len(_TT) >= TT_SIZE:
+            _TT.clear()
+        _TT[key] = (depth, best, flag, best_move)
+        return best
+
+    def vcf(self, side: int, depth: int) -> Optional[int]:
+        """Tìm thắng bằng chuỗi 'tứ' liên tiếp (đối thủ buộc phải chặn)."""
+        if depth == 0 or self.win_cells(3 - side):
+            return None
+        self.nodes += 1
+        if self.nodes & 255 == 0 and time.perf_counter() > self.stop_at:
+            raise Timeout()
+        for c in self.four_moves(side):
+            if self.make(c, side):
+                self.undo(c); return c
+            threats = self.win_cells(side)
+            found = len(threats) >= 2
+            if len(threats) == 1:
+                d = threats[0]
+                self.make(d, 3 - side)
+                found = self.vcf(side, depth - 1) is not None
+                self.undo(d)
+            self.undo(c)
+            if found:
+                return c
+        return None
+
+    def quick_move(self, side: int) -> Tuple[Optional[int], List[int]]:
+        """Nước không cần tìm kiếm (thắng ngay hoặc chặn thắng ngay) nếu có, kèm các ô ứng viên."""
+        wins = self.win_cells(side) or self.win_cells(3 - side)
+        if wins:
+            return wins[0], []
+        moves = self.candidates(side)
+        return (moves[0] if len(moves) == 1 else None), moves
+
+    def best_move(self, side: int, budget: float, max_depth: int = 10) -> Tuple[int, int]:
+        """Trả về (ô, độ sâu đã hoàn thành)."""
+        self.stop_at = time.perf_counter() + budget
+        forced, moves = self.quick_move(side)
+        if forced is not None:
+            return forced, 0
+        best, done = moves[0], 0
+        try:
+            hit = self.vcf(side, 8)
+            if hit is not None:
+                return hit, 0
+            for depth in range(1, max_depth + 1):
+                score = self.negamax(depth, -WIN*2, WIN*2, side, 0)
+                entry = _TT.get(self.hash ^ side)
+                if entry is not None:
+                    best = entry[3]
+                done = depth
+                if abs(score) >= WIN - 100:
+                    break
+        except Timeout:
+            pass
+        return best, done
+
+def search_move(size: int, x_bits: int, o_bits: int, symbol: str, deadline: float) -> Tuple[int, int]:
+    """Điểm vào cho process pool: nhận bitboard và hạn chót tuyệt đối (time.time()),
+    nên thời gian job nằm chờ trong hàng đợi của pool cũng được tính; trả về (x, y)."""
+    e = Engine.from_bits(size, x_bits, o_bits)
+    c, _ = e.best_move(1 if symbol == "X" else 2, max(0.0, deadline - time.time()))
+    return c % size, c // size
+
+def quick_move(size: int, x_bits: int, o_bits: int, symbol: str) -> Tuple[int, int]:
+    """Nước đi không tìm kiếm, đủ rẻ để chạy ngay trên event loop khi pool đang bận hết hoặc bị lỗi."""
+    e = Engine.from_bits(size, x_bits, o_bits)
+    forced, moves = e.quick_move(1 if symbol == "X" else 2)
+    c = forced if forced is not None else moves[0]
+    return c % size, c // size
+
+class BotPlayer:
+    """Người chơi máy trong một trận. Đóng vai outbox của Client: server 'gửi' gói
+    tin cho bot như với người thật, bot trả lời bằng cách gọi lại server.dispatch."""
+    codec = LINE_JSON
+    dropped = 0
+
+    def __init__(self, server: "CaroServer", pool: Executor, slots: asyncio.Semaphore, think_time: float):
+        self.server = server
+        self.pool = pool
+        self.slots = slots  # dùng chung giữa các bot, bằng số tiến trình của pool
+        self.think_time = think_time
+        self.rated_as = "Bot"  # tên ghi vào lịch sử và Elo, server đặt lại theo độ mạnh
+        self.client: Optional["Client"] = None
+        self.board = Board(BOARD_SIZE)
+        self.symbol = "O"
+        self.closed = False
+
+    def send(self, obj: Dict) -> bool:
+        if self.closed:
+            return False
+        t = obj.get("type")
+        if t == "match_start":
+            self.board = Board(obj.get("size", BOARD_SIZE))
+            self.symbol = obj["you"]
+        elif t in ("move_ok", "opponent_move"):
+            self.board.place(obj["x"], obj["y"], obj["symbol"])
+        elif t == "your_turn":
+            asyncio.create_task(self.think(obj.get("deadline")))
+        elif t == "match_end":
+            self.server.remove_bot(self.client)
+        return True
+
+    def put(self, data: bytes) -> bool:
+        for line in data.splitlines():
+            self.send(json.loads(line))
+        return True
+
+    offer = put
+
+    def close(self):
+        self.closed = True
+
+    async def think(self, deadline: Optional[float]):
+        stop = time.time() + self.think_time
+        if deadline:
+            # deadline do server gửi đã làm tròn xuống giây, chừa thêm 1 giây an toàn
+            stop = min(stop, deadline - 1)
+        b = self.board
+        args = (b.size, b.x_bits, b.o_bits, self.symbol)
+        # mỗi tiến trình của pool chỉ nhận một job: chờ chỗ trống trong phần thời gian còn lại,
+        # không kịp thì đi nước nhanh thay vì để hết giờ trong hàng đợi
+        move = None
+        if await self.acquire(stop - time.time() - MIN_SEARCH):
+            try:
+                move = await asyncio.get_running_loop().run_in_executor(self.pool, search_move, *args, stop)
+            except Exception as e:  # pool hỏng (BrokenProcessPool), lỗi pickle/tìm kiếm: vẫn phải đi
+                print(f"bot search failed: {e!r}")
+            finally:
+                self.slots.release()
+        x, y = move or quick_move(*args)
+        if not self.closed:
+            await self.server.dispatch(self.client, {"type": "move", "x": x, "y": y})
+
+    async def acquire(self, wait: float) -> bool:
+        """Giữ một chỗ trong pool; False nếu sau wait giây vẫn chưa có chỗ."""
+        if not self.slots.locked():
+            await self.slots.acquire()
+            return True
+        try:
+            await asyncio.wait_for(self.slots.acquire(), max(0.0, wait))
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -0,0 +1,182 @@
+# Nhật ký các trận đang chơi để server khởi động lại (sập, deploy) vẫn giữ được ván dở
+import itertools, json, os, queue, threading, time
+from typing import Dict, Iterator, List, Optional
+
+_STOP = object()
+
+# Mỗi dòng một bản ghi, chỉ ghi thêm vào cuối (id trận là ASCII, không có dấu cách):
+#   s <id> {json}                  trận bắt đầu: người chơi, size, tc, started_at, token phiên
+#   m <id> <x> <y> <ts> <cx> <co>  một nước đi (quân đi xen kẽ từ X) và đồng hồ hai bên ("-" nếu
+#                                  không có tc.total); luôn đủ 7 trường để khôi phục cắt được cả lô
+#   e <id>                         trận kết thúc, bỏ khỏi tập còn sống
+# Các hàm dưới trả về dòng chưa có "\n"; CheckpointLog thêm khi ghi.
+
+def start_record(match_id: str, info: Dict) -> bytes:
+    return b"s %s %s" % (match_id.encode("ascii"), json.dumps(info, ensure_ascii=False).encode("utf-8"))
+
+def move_record(match_id: str, x: int, y: int, ts: int, clock: Optional[Dict[str, float]] = None) -> bytes:
+    tail = f"{clock['X']:.3f} {clock['O']:.3f}" if clock else "- -"
+    return f"m {match_id} {x} {y} {ts} {tail}".encode("ascii")
+
+def end_record(match_id: str) -> bytes:
+    return b"e " + match_id.encode("ascii")
+
+def load(path: str) -> Dict[bytes, List[bytes]]:
+    """Đọc log, trả về id -> các dòng (bản ghi s rồi các m) của những trận chưa kết thúc.
+
+    Dòng cuối bị cắt dở (sập giữa lúc ghi) bị bỏ qua.
+    """
+    live: Dict[bytes, List[bytes]] = {}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return live
+    lines = data.split(b"\n")
+    lines.pop()  # phần sau "\n" cuối cùng: rỗng, hoặc dòng bị cắt
+    get = live.get
+    for line in lines:
+        op = line[:1]
+        if op == b"m":
+            match = get(line[2:line.find(b" ", 2)])
+            if match is not None:
+                match.append(line)
+        elif op == b"s":
+            live[line[2:line.find(b" ", 2)]] = [line]
+        elif op == b"e":
+            live.pop(line[2:], None)
+    return live
+
+class _Ints(dict):
+    """Bảng token -> int tự lấp dần: toạ độ và giây lặp lại rất nhiều, tra dict rẻ hơn int()."""
+    def __missing__(self, key: bytes) -> int:
+        value = self[key] = int(key)
+        return value
+
+def parse_all(live: Dict[bytes, List[bytes]]) -> Iterator:
+    """Tách từng trận của load() thành (info, xs, ys, ts, đồng hồ cuối hoặc None), theo thứ
+    tự của live. Làm theo cả lô: một json.loads cho mọi bản ghi s, một lần split cho mọi
+    bản ghi m, rồi mỗi trận chỉ còn cắt lát."""
+    groups = list(live.values())
+    infos = json.loads(b"[" + b",".join(g[0][g[0].find(b" ", 2) + 1:] for g in groups) + b"]")
+    tokens = b" ".join(itertools.chain.from_iterable(itertools.islice(g, 1, None) for g in groups)).split()
+    num = _Ints().__getitem__
+    xs, ys, ts = list(map(num, tokens[2::7])), list(map(num, tokens[3::7])), list(map(num, tokens[4::7]))
+    i = 0
+    for info, g in zip(infos, groups):
+        j = i + len(g) - 1
+        clock = None
+        if j > i and tokens[7*j - 2] != b"-":
+            clock = {"X": float(tokens[7*j - 2]), "O": float(tokens[7*j - 1])}
+        yield info, xs[i:j], ys[i:j], ts[i:j], clock
+        i = j
+
+class CheckpointLog:
+    """Ghi log ở một thread nền (như HistoryWriter): event loop chỉ đưa bản ghi vào
+    hàng đợi, thread gom trong interval giây rồi ghi + fsync một lần.
+
+    Thread giữ bản sao các dòng của những trận còn sống; khi log dài hơn
+    compact_ratio lần phần còn sống thì viết lại file chỉ với phần đó (file tạm +
+    os.replace, nên lúc nào trên đĩa cũng có một log đầy đủ).
+    """
+    def __init__(self, path: str, live: Optional[Dict[bytes, List[bytes]]] = None, interval: float = 0.2,
+                 fsync: bool = True, compact_ratio: int = 4, compact_min: int = 1 << 20):
+        self.path = path
+        self.interval = interval
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.live = live if live is not None else {}
+        self.live_bytes = sum(len(l) + 1 for lines in self.live.values() for l in lines)
+        self.size = 0
+        self.f = None
+        self.closed = False
+        self.q: "queue.Queue" = queue.Queue()
+        self.compactions = 0
+        self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, record: bytes):
+        """Đưa một dòng (start_record/move_record/end_record) vào hàng đợi ghi."""
+        if not self.closed:
+            self.q.put(record)
+
+    def flush(self):
+        """Chặn tới khi mọi bản ghi đã submit nằm trên đĩa."""
+        self.q.join()
+
+    def close(self, timeout: Optional[float] = None):
+        self.closed = True
+        if self.thread.is_alive():
+            self.q.put(_STOP)
+            self.thread.join(timeout)
+
+    def _apply(self, record: bytes) -> bool:
+        """Cập nhật bản sao trận còn sống; False nếu bản ghi không cần ghi (trận không được log)."""
+        op, sp = record[:1], record.find(b" ", 2)
+        match_id = record[2:sp] if sp > 0 else record[2:]
+        if op == b"s":
+            self.live[match_id] = [record]
+        else:
+            lines = self.live.get(match_id)
+            if lines is None:
+                return False
+            if op == b"m":
+                lines.append(record)
+            else:
+                del self.live[match_id]
+                self.live_bytes -= sum(map(len, lines)) + len(lines)
+                return True
+        self.live_bytes += len(record) + 1
+        return True
+
+    def _rewrite(self):
+        if self.f:
+            self.f.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            for lines in self.live.values():
+                f.write(b"\n".join(lines) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.f = open(self.path, "ab")
+        self.size = self.live_bytes
+        self.compactions += 1
+
+    def _run(self):
+        q = self.q
+        self._rewrite()  # bỏ phần đã kết thúc của log cũ ngay khi khởi động
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is _STOP:
+                q.task_done()
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    q.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            kept = [rec for rec in batch if self._apply(rec)]
+            if kept:
+                data = b"\n".join(kept) + b"\n"
+                self.f.write(data)
+                self.f.flush()
+                if self.fsync:
+                    os.fsync(self.f.fileno())
+                self.size += len(data)
+                if self.size > self.compact_ratio*self.live_bytes + self.compact_min:
+                    self._rewrite()
+            for _ in batch: q.task_done()
+        self.f.close()
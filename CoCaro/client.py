@@ -1,18 +1,86 @@
 import argparse, asyncio, sys, time
+from typing import Optional
 from common import send_json, recv_json, parse_coord, COORDS, THINK_TIME_SECONDS
+from codec import CODECS, LINE_JSON
+
+def fmt_line(line) -> str:
+    return " ".join(f"{COORDS[x]}{y+1}" for x, y in line)
 
 class CaroClient:
-    def __init__(self, name: str, host="127.0.0.1", port=7777):
+    def __init__(self, name: str, host="127.0.0.1", port=7777, codecs=("frame", "json")):
         self.name = name
         self.host = host
         self.port = port
         self.reader = None
         self.writer = None
+        self.codecs = list(codecs)
+        self.codec = LINE_JSON
+        self.session = None
+        self.resume_grace = 0
+        self.seq = 0  # số nước của trận hiện tại đã nhận, gửi kèm khi resume
 
-    async def start(self):
+    async def connect(self) -> dict:
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        await send_json(self.writer, {"type": "login", "name": self.name})
+        await send_json(self.writer, {"type": "login", "name": self.name, "codecs": self.codecs})
         hello = await recv_json(self.reader)
+        self.codec = CODECS.get(hello.get("codec"), LINE_JSON)
+        self.session, self.resume_grace = hello.get("session"), hello.get("resume_grace", 0)
+        return hello
+
+    async def resume(self) -> dict:
+        """Nối lại phiên cũ bằng token; server phát lại các nước đi sau self.seq."""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await send_json(self.writer, {"type": "resume", "session": self.session, "seq": self.seq, "codecs": self.codecs})
+        hello = await recv_json(self.reader)
+        if hello.get("type") == "resume_ok":
+            self.codec = CODECS.get(hello.get("codec"), LINE_JSON)
+            snap = hello.get("match")
+            if snap and "cells" in snap:
+                self.seq = snap["seq"]
+        return hello
+
+    async def reconnect(self) -> Optional[dict]:
+        """Thử resume trong thời gian ân hạn của server, giãn dần khoảng chờ."""
+        give_up, delay = time.time() + self.resume_grace, 0.2
+        while self.session and time.time() < give_up:
+            try:
+                hello = await self.resume()
+            except OSError:
+                hello = {}
+            if hello.get("type") == "resume_ok":
+                return hello
+            if hello.get("msg") == "session expired":
+                break
+            if hello.get("msg") == "session on another worker":
+                continue  # cluster: kết nối mới rơi vào worker khác, thử lại ngay
+            await asyncio.sleep(delay); delay = min(delay*2, 5)
+        self.session = None
+        return None
+
+    async def send(self, obj: dict):
+        self.writer.write(self.codec.encode(obj))
+        await self.writer.drain()
+
+    async def recv(self) -> dict:
+        msg = await self.codec.read(self.reader)
+        t = msg.get("type")
+        while t == "ping":
+            # trả lời heartbeat ngay tại đây để mọi vòng đọc (REPL, GUI, loadtest) đều được
+            self.writer.write(self.codec.encode({"type": "pong"}))
+            msg = await self.codec.read(self.reader)
+            t = msg.get("type")
+        if t in ("move_ok", "opponent_move"):
+            seq = msg.get("seq", self.seq + 1)
+            if seq != self.seq + 1:
+                # lỡ mất sự kiện: xin các nước từ chỗ còn khớp, trả lời là gói sync
+                self.writer.write(self.codec.encode({"type": "sync", "since": self.seq}))
+            self.seq = max(self.seq, seq)
+        elif t in ("match_start", "sync"):
+            self.seq = msg.get("seq", 0)
+        return msg
+
+    async def start(self):
+        hello = await self.connect()
         if hello.get("type") != "login_ok":
             print("Login failed:", hello)
             return
@@ -21,39 +89,95 @@ class CaroClient:
         await self.repl()
 
     async def listen(self):
-        try:
-            while True:
-                msg = await recv_json(self.reader)
-                t = msg.get("type")
-                if t == "user_list":
-                    print("[users]", ", ".join(msg.get("users", [])))
-                elif t == "invite":
-                    print(f"[invite] từ {msg['from']}. Dùng: accept {msg['from']}")
-                elif t == "match_start":
-                    print(f"[match] Bắt đầu! Bạn là {msg['you']}, đối thủ: {msg['opponent']}")
-                elif t == "your_turn":
-                    dl = msg.get("deadline")
-                    remain = dl - int(time.time()) if dl else THINK_TIME_SECONDS
-                    print(f"[turn] Lượt của bạn. Còn {remain}s. Gõ: move <pos>. VD: move H8")
-                elif t == "move_ok":
-                    print(f"Bạn đánh {COORDS[msg['x']]}{msg['y']+1}")
-                elif t == "opponent_move":
-                    print(f"Đối thủ đánh {COORDS[msg['x']]}{msg['y']+1}")
-                elif t == "match_end":
-                    print(f"[kết thúc] lý do: {msg['reason']} | winner: {msg['winner']}")
-                elif t == "chat":
-                    print(f"[{msg['from']}] {msg['text']}")
-                elif t == "error":
-                    print("[error]", msg.get("msg"))
-        except Exception:
-            print("[disconnected]")
+        while True:
+            try:
+                await self.listen_once()
+            except Exception:
+                pass
             try:
                 self.writer and self.writer.close()
             except:
                 pass
+            print("[disconnected]")
+            hello = await self.reconnect()
+            if not hello:
+                return
+            snap = hello.get("match")
+            print("[resume] Đã nối lại" + (f" trận với {snap['opponent']}, bạn là {snap['you']}" if snap else ""))
+
+    async def listen_once(self):
+        while True:
+            msg = await self.recv()
+            t = msg.get("type")
+            if t == "user_list":
+                print("[users]", ", ".join(msg.get("users", [])))
+            elif t == "user_joined":
+                print("[online]", ", ".join(msg.get("users", [])))
+            elif t == "user_left":
+                print("[offline]", ", ".join(msg.get("users", [])))
+            elif t == "invite":
+                print(f"[invite] từ {msg['from']}. Dùng: accept {msg['from']}")
+            elif t == "match_start":
+                print(f"[match] Bắt đầu! Bạn là {msg['you']}, đối thủ: {msg['opponent']}")
+            elif t == "your_turn":
+                dl = msg.get("deadline")
+                remain = dl - int(time.time()) if dl else THINK_TIME_SECONDS
+                print(f"[turn] Lượt của bạn. Còn {remain}s. Gõ: move <pos>. VD: move H8")
+            elif t == "move_ok":
+                print(f"Bạn đánh {COORDS[msg['x']]}{msg['y']+1}")
+            elif t == "opponent_move":
+                print(f"Đối thủ đánh {COORDS[msg['x']]}{msg['y']+1}")
+            elif t == "match_end":
+                print(f"[kết thúc] lý do: {msg['reason']} | winner: {msg['winner']}" + (f" | điểm: {msg['rating']}" if "rating" in msg else "")
+                      + (f" | đường thắng: {fmt_line(msg['win_line'])}" if msg.get("win_line") else ""))
+            elif t == "chat":
+                print(f"[{msg['from']}] {msg['text']}")
+            elif t == "history":
+                for m in msg.get("matches", []):
+                    print(f"[history] {m['id']} {m['finished_at']} {m['player_x']} vs {m['player_o']} -> {m['winner']}")
+            elif t == "stats":
+                st = msg.get("stats") or {}
+                print(f"[stats] {msg.get('name')}: {st.get('wins', 0)}W {st.get('losses', 0)}L {st.get('draws', 0)}D, streak {st.get('streak', 0)}")
+            elif t == "leaderboard":
+                for i, r in enumerate(msg.get("rows", []), 1):
+                    print(f"[top] {i}. {r['name']} - {r['wins']} thắng / {r['games']} trận")
+            elif t == "match_list":
+                for m in msg.get("matches", []):
+                    info = f"{m['moves']} nước, {m['spectators']} người xem" if m.get("moves") is not None else "ở worker khác"
+                    print(f"[trận] {m['id']}: {m['player_x']} vs {m['player_o']} ({info})")
+                if msg.get("next"):
+                    print(f"[trận] còn nữa, gõ: matches {msg['next']}")
+            elif t == "spectate_ok":
+                n = msg["size"]; cells = msg["cells"]
+                print(f"[xem] {msg['player_x']} (X) vs {msg['player_o']} (O)")
+                for y in range(n):
+                    print(f"{y+1:>2} " + " ".join(cells[y*n:(y+1)*n]))
+            elif t == "match_move":
+                print(f"[xem] {msg['symbol']} đánh {COORDS[msg['x']]}{msg['y']+1}")
+            elif t == "match_over":
+                print(f"[xem] kết thúc: {msg['reason']} | winner: {msg['winner']}"
+                      + (f" | đường thắng: {fmt_line(msg['win_line'])}" if msg.get("win_line") else ""))
+            elif t == "queue_ok":
+                print(f"[ghép trận] Đang chờ đối thủ (điểm {msg['rating']}, {msg['waiting']} người trong hàng)")
+            elif t == "queue_left":
+                print("[ghép trận] Đã rời hàng chờ")
+            elif t == "replay_start":
+                print(f"[replay] {msg['id']}: {msg['player_x']} (X) vs {msg['player_o']} (O), {msg['count']} nước, x{msg['speed']:g}")
+            elif t == "replay_move":
+                print(f"[replay] {msg['i']+1}. {msg['symbol']} {COORDS[msg['x']]}{msg['y']+1}")
+            elif t == "replay_moves":
+                print("[replay] " + " ".join(f"{i+1}.{COORDS[x]}{y+1}" for i, (x, y) in enumerate(msg["moves"])))
+            elif t == "replay_end":
+                print(f"[replay] kết thúc, winner: {msg['winner']}" + (f" | đường thắng: {fmt_line(msg['win_line'])}" if msg.get("win_line") else ""))
+            elif t == "sync":
+                print(f"[sync] trận {msg['id']} đã đồng bộ tới nước {msg['seq']}")
+            elif t == "invite_expired":
+                print(f"[invite] Lời mời tới {msg['opponent']} đã hết hạn")
+            elif t == "error":
+                print("[error]", msg.get("msg"))
 
     async def repl(self):
-        print("Lệnh: users | challenge <name> | accept <name> | move <xy> | say <text> | help | quit")
+        print("Lệnh: users | challenge <name> | accept <name> | move <xy> | say <text> | history [name] | stats [name] | top | matches [sau id] | watch [id] | replay <id> [speed] | queue | unqueue | help | quit")
         loop = asyncio.get_running_loop()
         while True:
             cmd = await loop.run_in_executor(None, sys.stdin.readline)
@@ -63,17 +187,17 @@ class CaroClient:
             if cmd == "quit":
                 break
             if cmd == "help":
-                print("users | challenge <name> | accept <name> | move <xy> | say <text> | quit")
+                print("users | challenge <name> | accept <name> | move <xy> | say <text> | history [name] | stats [name] | top | matches [sau id] | watch [id] | replay <id> [speed] | queue | unqueue | quit")
                 continue
             if cmd == "users":
                 continue
             if cmd.startswith("challenge "):
                 _, opp = cmd.split(maxsplit=1)
-                await send_json(self.writer, {"type": "challenge", "opponent": opp})
+                await self.send({"type": "challenge", "opponent": opp})
                 continue
             if cmd.startswith("accept "):
                 _, opp = cmd.split(maxsplit=1)
-                await send_json(self.writer, {"type": "accept", "opponent": opp})
+                await self.send({"type": "accept", "opponent": opp})
                 continue
             if cmd.startswith("move "):
                 _, pos = cmd.split(maxsplit=1)
@@ -81,11 +205,41 @@ class CaroClient:
                 if not xy:
                     print("Sai định dạng. Ví dụ: H8 hoặc 8,7 hoặc a1")
                 else:
-                    await send_json(self.writer, {"type": "move", "x": xy[0], "y": xy[1]})
+                    await self.send({"type": "move", "x": xy[0], "y": xy[1]})
+                continue
+            parts = cmd.split(maxsplit=1)
+            if parts and parts[0] in ("history", "stats"):
+                req = {"type": parts[0]}
+                if len(parts) > 1: req["name"] = parts[1]
+                await self.send(req)
+                continue
+            if cmd in ("queue", "unqueue"):
+                await self.send({"type": "queue_join" if cmd == "queue" else "queue_leave"})
+                continue
+            if parts and parts[0] == "matches":
+                await self.send({"type": "list_matches", "after": parts[1]} if len(parts) > 1 else {"type": "list_matches"})
+                continue
+            if parts and parts[0] == "replay":
+                args = cmd.split()
+                if args[1:] == ["stop"]:
+                    await self.send({"type": "replay_stop"})
+                elif len(args) in (2, 3):
+                    try:
+                        await self.send({"type": "replay", "id": args[1], "speed": float(args[2]) if len(args) == 3 else 1.0})
+                    except ValueError:
+                        print("Dùng: replay <id> [tốc độ] (0 = hiện ngay cả ván) | replay stop")
+                else:
+                    print("Dùng: replay <id> [tốc độ] (0 = hiện ngay cả ván) | replay stop")
+                continue
+            if parts and parts[0] == "watch":
+                await self.send({"type": "spectate", "id": parts[1]} if len(parts) > 1 else {"type": "unspectate"})
+                continue
+            if cmd == "top":
+                await self.send({"type": "leaderboard"})
                 continue
             if cmd.startswith("say "):
                 _, text = cmd.split(" ", 1)
-                await send_json(self.writer, {"type": "chat", "text": text})
+                await self.send({"type": "chat", "text": text})
                 continue
             print("Không hiểu lệnh. Gõ help.")
 
@@ -94,5 +248,6 @@ if __name__ == "__main__":
     parser.add_argument("--name", required=True)
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--codec", action="append", help="codec đề nghị theo thứ tự ưu tiên (mặc định: frame, json)")
     args = parser.parse_args()
-    asyncio.run(CaroClient(args.name, args.host, args.port).start())
+    asyncio.run(CaroClient(args.name, args.host, args.port, args.codec or ("frame", "json")).start())
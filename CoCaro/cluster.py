@@ -0,0 +1,186 @@
+import asyncio, itertools, os
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from codec import LINE_JSON
+from common import encode_json, recv_json
+from fanout import Outbox
+
+if TYPE_CHECKING:
+    from server import CaroServer
+
+# giới hạn một dòng trên link worker <-> coordinator; gói relay (deliver) là gói server gửi
+# cho client nên có thể lớn hơn nhiều so với max_frame của gói client gửi lên
+LINK_LIMIT = 16 << 20
+
+class Coordinator:
+    """Tiến trình điều phối khi chạy nhiều worker (--workers N).
+
+    Giữ danh bạ tên -> worker và chủ sở hữu của từng trận; các worker nối tới
+    qua Unix socket và nhờ nó chuyển gói tin cho người chơi ở worker khác.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.links: Dict[int, Outbox] = {}
+        self.names: Dict[str, int] = {}
+        self.matches: Dict[str, Tuple[int, List[str]]] = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle_worker, self.path, limit=LINK_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    def to(self, worker: int, obj: Dict):
+        box = self.links.get(worker)
+        if box:
+            box.put(encode_json(obj))
+
+    def broadcast(self, obj: Dict, skip: Optional[int] = None):
+        data = encode_json(obj)
+        for w, box in self.links.items():
+            if w != skip:
+                box.put(data)
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await recv_json(reader)
+        wid = hello["worker"]
+        box = self.links[wid] = Outbox(writer, maxsize=0)
+        self.to(wid, {"op": "snapshot", "names": self.names,
+                      "matches": {mid: [w, players] for mid, (w, players) in self.matches.items()}})
+        try:
+            while True:
+                msg = await recv_json(reader)
+                op = msg.get("op")
+                if op == "deliver":
+                    w = self.names.get(msg["to"])
+                    if w is not None:
+                        self.to(w, msg)
+                elif op == "forward":
+                    self.to(msg["worker"], msg)
+                elif op == "claim":
+                    ok = msg["name"] not in self.names
+                    if ok:
+                        self.names[msg["name"]] = wid
+                        self.broadcast({"op": "joined", "name": msg["name"], "worker": wid}, skip=wid)
+                    self.to(wid, {"op": "reply", "rid": msg["rid"], "ok": ok})
+                elif op == "release":
+                    if self.names.get(msg["name"]) == wid:
+                        del self.names[msg["name"]]
+                        self.broadcast({"op": "left", "name": msg["name"]}, skip=wid)
+                elif op == "match":
+                    self.matches[msg["id"]] = (wid, msg["players"])
+                    self.broadcast(dict(msg, worker=wid), skip=wid)
+                elif op == "match_end":
+                    self.matches.pop(msg["id"], None)
+                    self.broadcast(msg, skip=wid)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            print(f"coordinator: link to worker {wid} failed: {e!r}")
+        finally:
+            # abort thay vì close: khi coordinator dừng, task ghi của outbox đã bị huỷ nên
+            # chỉ close thì socket vẫn mở và worker không bao giờ thấy EOF
+            box.abort()
+            # worker đã nối lại bằng link mới thì tên và trận của nó vẫn còn hiệu lực
+            if self.links.get(wid) is box:
+                del self.links[wid]
+                for name in [n for n, w in self.names.items() if w == wid]:
+                    del self.names[name]
+                    self.broadcast({"op": "left", "name": name})
+                for mid in [m for m, (w, _) in self.matches.items() if w == wid]:
+                    _, players = self.matches.pop(mid)
+                    self.broadcast({"op": "match_end", "id": mid, "players": players})
+
+class RemoteOutbox:
+    """Outbox đại diện cho người chơi đang nối vào worker khác; luôn gửi line-JSON,
+    worker đích mã hoá lại theo codec thật của client."""
+    closed = False
+    dropped = 0
+    codec = LINE_JSON
+
+    def __init__(self, link: "ClusterLink", name: str):
+        self.link = link
+        self.name = name
+
+    def send(self, obj: Dict) -> bool:
+        return self.put(self.codec.encode(obj))
+
+    def put(self, data: bytes) -> bool:
+        self.link.send({"op": "deliver", "to": self.name, "data": data.decode("utf-8")})
+        return True
+
+    offer = put
+
+    def close(self):
+        pass
+
+class ClusterLink:
+    """Kết nối từ một worker tới Coordinator; các gói nhận được chuyển cho
+    CaroServer.on_cluster, riêng phản hồi claim được ghép với request."""
+    def __init__(self, server: "CaroServer", worker_id: int, path: str):
+        self.server = server
+        self.worker_id = worker_id
+        self.path = path
+        self.box: Optional[Outbox] = None
+        self.rids = itertools.count()
+        self.waiting: Dict[int, asyncio.Future] = {}
+
+    async def connect(self, retries: int = 50):
+        for _ in range(retries):
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=LINK_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"coordinator not reachable at {self.path}")
+        self.box = Outbox(writer, maxsize=0)
+        self.send({"op": "hello", "worker": self.worker_id})
+        self.task = asyncio.create_task(self._listen(reader))
+
+    def send(self, obj: Dict):
+        self.box.put(encode_json(obj))
+
+    async def claim(self, name: str) -> bool:
+        """Giữ tên trên toàn cụm; False nếu worker khác đã dùng."""
+        rid = next(self.rids)
+        fut = self.waiting[rid] = asyncio.get_running_loop().create_future()
+        self.send({"op": "claim", "rid": rid, "name": name})
+        return await fut
+
+    def release(self, name: str):
+        self.send({"op": "release", "name": name})
+
+    async def _listen(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                msg = await recv_json(reader)
+                if msg.get("op") == "reply":
+                    fut = self.waiting.pop(msg["rid"], None)
+                    if fut and not fut.done():
+                        fut.set_result(msg["ok"])
+                    continue
+                try:
+                    await self.server.on_cluster(msg)
+                except Exception as e:
+                    # một gói xử lý lỗi không được làm worker điếc với coordinator
+                    print(f"worker {self.worker_id}: cluster op {msg.get('op')!r} failed: {e!r}")
+        except (ConnectionError, ValueError) as e:  # ValueError: JSON hỏng hoặc FrameTooLarge
+            print(f"worker {self.worker_id}: coordinator link failed ({e!r}), reconnecting")
+        await self.reconnect()
+
+    async def reconnect(self):
+        """Mở link mới sau khi link cũ hỏng (dòng đọc dở thì không đọc tiếp được nữa)."""
+        self.box.abort()
+        for fut in self.waiting.values():
+            if not fut.done():
+                fut.set_result(False)  # claim không có trả lời: coi như tên đã bị dùng
+        self.waiting.clear()
+        try:
+            await self.connect()
+        except ConnectionError:
+            print(f"worker {self.worker_id}: lost coordinator, shutting down")
+            self.server.stop()
+            return
+        self.server.on_cluster_reconnect()
@@ -0,0 +1,115 @@
+# Lớp mã hoá đường truyền: line-JSON (mặc định, cho client cũ) và khung có độ dài
+import asyncio, json, struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from common import FrameTooLarge, encode_json, recv_json
+
+try:
+    import orjson
+    json_dumps: Callable[[Any], bytes] = orjson.dumps
+    json_loads: Callable[[bytes], Any] = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAX_FRAME = 1 << 20
+_HDR = struct.Struct(">IB")  # độ dài (tính cả byte kind) + kind
+
+class Codec:
+    name = "json"
+
+    def encode(self, obj: Dict[str, Any]) -> bytes:
+        return encode_json(obj)
+
+    async def read(self, reader: asyncio.StreamReader, limit: Optional[int] = None) -> Dict[str, Any]:
+        """limit bị bỏ qua: độ dài dòng đã bị chặn bởi limit của StreamReader."""
+        return await recv_json(reader)
+
+class FramedCodec(Codec):
+    """Khung [u32 độ dài][u8 kind][thân]. kind 0 là JSON (hoặc msgpack), các kind
+    còn lại là dạng nhị phân cố định cho những gói nóng trên đường đánh cờ."""
+    KINDS: Dict[str, Tuple[int, str, Tuple[str, ...]]] = {
+        # type: (kind, struct, các trường theo thứ tự)
+        "move":          (1, ">BB",  ("x", "y")),
+        "move_ok":       (2, ">BBBH", ("x", "y", "symbol", "seq")),
+        "opponent_move": (3, ">BBBH", ("x", "y", "symbol", "seq")),
+        "your_turn":     (4, ">IH",   ("deadline", "seq")),
+    }
+
+    def __init__(self, name: str = "frame", dumps=None, loads=None, max_frame: int = MAX_FRAME):
+        self.name = name
+        self.dumps = dumps or json_dumps
+        self.loads = loads or json_loads
+        self.max_frame = max_frame
+        self.by_kind: Dict[int, Tuple[str, struct.Struct, Tuple[str, ...]]] = {}
+        self.by_type: Dict[str, Tuple[int, struct.Struct, Tuple[str, ...]]] = {}
+        for t, (kind, fmt, fields) in self.KINDS.items():
+            st = struct.Struct(fmt)
+            self.by_kind[kind] = (t, st, fields)
+            self.by_type[t] = (kind, st, fields)
+
+    def _pack_hot(self, obj: Dict[str, Any]) -> Optional[bytes]:
+        spec = self.by_type.get(obj.get("type"))
+        if spec is None or len(obj) != len(spec[2]) + 1:
+            return None
+        kind, st, fields = spec
+        vals: List[int] = []
+        for f in fields:
+            v = obj.get(f)
+            if f == "symbol":
+                if v not in ("X", "O"): return None
+                v = v == "O"
+            elif not isinstance(v, int) or v < 0:
+                return None
+            vals.append(v)
+        try:
+            return _HDR.pack(st.size + 1, kind) + st.pack(*vals)
+        except struct.error:
+            return None
+
+    def encode(self, obj: Dict[str, Any]) -> bytes:
+        data = self._pack_hot(obj)
+        if data is not None:
+            return data
+        body = self.dumps(obj)
+        return _HDR.pack(len(body) + 1, 0) + body
+
+    async def read(self, reader: asyncio.StreamReader, limit: Optional[int] = None) -> Dict[str, Any]:
+        try:
+            size, kind = _HDR.unpack(await reader.readexactly(_HDR.size))
+            if size > (limit or self.max_frame):
+                raise FrameTooLarge(f"frame of {size} bytes")
+            if size < 1:
+                raise ValueError(f"bad frame size {size}")
+            body = await reader.readexactly(size - 1)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("peer closed")
+        if kind == 0:
+            return self.loads(body)
+        spec = self.by_kind.get(kind)
+        if spec is None:
+            raise ValueError(f"unknown frame kind {kind}")
+        t, st, fields = spec
+        msg = {"type": t}
+        for f, v in zip(fields, st.unpack(body)):
+            msg[f] = ("O" if v else "X") if f == "symbol" else v
+        return msg
+
+LINE_JSON = Codec()
+CODECS: Dict[str, Codec] = {"json": LINE_JSON, "frame": FramedCodec()}
+if msgpack is not None:
+    CODECS["frame-msgpack"] = FramedCodec("frame-msgpack", msgpack.packb, msgpack.unpackb)
+
+def negotiate(offered: Optional[List[str]]) -> Codec:
+    """Chọn codec đầu tiên trong danh sách client đề nghị mà server hỗ trợ."""
+    for name in offered or []:
+        if name in CODECS:
+            return CODECS[name]
+    return LINE_JSON
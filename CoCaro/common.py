@@ -1,19 +1,30 @@
 from __future__ import annotations
-import asyncio, json
-from typing import Any, Dict, Tuple, List
+import asyncio, hashlib, json
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Tuple, List
 
 BOARD_SIZE = 15
 THINK_TIME_SECONDS = 15
 COORDS = "ABCDEFGHIJKLMNO"  # 15 cột
 DIRS = [(1,0), (0,1), (1,1), (1,-1)]
 
+def encode_json(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
 async def send_json(writer: asyncio.StreamWriter, obj: Dict[str, Any]):
-    data = json.dumps(obj, ensure_ascii=False) + "\n"
-    writer.write(data.encode("utf-8"))
+    writer.write(encode_json(obj))
     await writer.drain()
 
+class FrameTooLarge(ValueError):
+    """Gói tin vượt giới hạn kích thước (limit của StreamReader hoặc max_frame)."""
+
 async def recv_json(reader: asyncio.StreamReader) -> Dict[str, Any]:
-    line = await reader.readline()
+    try:
+        line = await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        line = e.partial  # như readline: dòng cuối không có \n vẫn được đọc
+    except asyncio.LimitOverrunError:
+        raise FrameTooLarge("line too long")
     if not line:
         raise ConnectionError("peer closed")
     return json.loads(line.decode("utf-8").strip())
@@ -39,39 +50,178 @@ def parse_coord(token: str) -> Tuple[int,int] | None:
             except: return None
     return None
 
-def check_win(board: List[List[str]], x:int, y:int, symbol:str) -> bool:
-    n = len(board)
-    for dx,dy in DIRS:
-        cnt = 1
-        for s in (1,-1):
-            nx, ny = x, y
-            while True:
-                nx += dx*s
-                ny += dy*s
-                if 0<=nx<n and 0<=ny<n and board[ny][nx] == symbol:
-                    cnt += 1
-                else:
-                    break
-        if cnt >= 5:
+class Board:
+    """Bàn cờ dạng bitboard: mỗi bên một bitmask (int Python).
+
+    Ô (x,y) ứng với bit y*(size+1)+x; cột thứ size luôn bằng 0 làm cột chặn
+    để phép dịch bit theo hàng ngang/chéo không tràn sang hàng kế bên.
+    """
+    __slots__ = ("size", "stride", "x_bits", "o_bits", "count")
+
+    def __init__(self, size: int = BOARD_SIZE):
+        self.size = size
+        self.stride = size + 1
+        self.x_bits = 0
+        self.o_bits = 0
+        self.count = 0
+
+    @classmethod
+    def from_rows(cls, rows: List[List[str]] | List[str]) -> "Board":
+        b = cls(len(rows))
+        for y, row in enumerate(rows):
+            for x, v in enumerate(row):
+                if v in ("X", "O"):
+                    b.place(x, y, v)
+        return b
+
+    def shifts(self) -> Tuple[int, ...]:
+        """Độ dịch bit tương ứng với từng hướng trong DIRS."""
+        return tuple(s for s, _ in _geometry(self.size))
+
+    def bit(self, x: int, y: int) -> int:
+        return 1 << (y*self.stride + x)
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        return 0 <= x < self.size and 0 <= y < self.size
+
+    def mask(self, symbol: str) -> int:
+        return self.x_bits if symbol == "X" else self.o_bits
+
+    def occupied(self, x: int, y: int) -> bool:
+        return bool(((self.x_bits | self.o_bits) >> (y*self.stride + x)) & 1)
+
+    def get(self, x: int, y: int) -> str:
+        i = y*self.stride + x
+        if (self.x_bits >> i) & 1: return "X"
+        if (self.o_bits >> i) & 1: return "O"
+        return "."
+
+    def place(self, x: int, y: int, symbol: str):
+        if symbol == "X": self.x_bits |= self.bit(x, y)
+        else:             self.o_bits |= self.bit(x, y)
+        self.count += 1
+
+    def is_full(self) -> bool:
+        return self.count >= self.size*self.size
+
+    def has_five(self, symbol: str) -> bool:
+        """Kiểm tra có >=5 quân liên tiếp ở bất kỳ hướng nào (dịch bit rồi AND)."""
+        b = self.mask(symbol)
+        for s in self.shifts():
+            m = b & (b >> s)
+            m &= m >> (2*s)
+            if m & (b >> (4*s)):
+                return True
+        return False
+
+    def rows(self) -> List[str]:
+        return ["".join(self.get(x, y) for x in range(self.size)) for y in range(self.size)]
+
+    def digest(self) -> str:
+        """Mã băm 64 bit (hex) của thế cờ; khác hash() ở chỗ ổn định giữa các tiến trình."""
+        n = (self.stride*self.size + 7) // 8
+        data = bytes((self.size,)) + self.x_bits.to_bytes(n, "little") + self.o_bits.to_bytes(n, "little")
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+@lru_cache(maxsize=None)
+def _geometry(size: int) -> Tuple[Tuple[int, int], ...]:
+    """Với mỗi hướng: (độ dịch s, mặt nạ 9 ô cách nhau s bit) dùng cho check_win."""
+    stride = size + 1
+    out = []
+    for dx, dy in DIRS:
+        s = abs(dx + dy*stride)
+        out.append((s, sum(1 << (k*s) for k in range(9))))
+    return tuple(out)
+
+MOVES_FORMAT = 1
+
+def _put_varint(out: bytearray, v: int):
+    while v >= 0x80:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+
+def _get_varint(data, pos: int) -> Tuple[int, int]:
+    v = shift = 0
+    while True:
+        b = data[pos]; pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return v, pos
+        shift += 7
+
+def encode_moves(moves: List[Dict[str, Any]], size: int = BOARD_SIZE) -> bytes:
+    """Nén danh sách nước đi thành bytes.
+
+    Bố cục: [phiên bản][size][varint ts nước đầu] rồi mỗi nước một ô
+    (1 byte, 2 byte nếu bàn > 16x16) và varint độ lệch thời gian so với nước
+    trước. Ký hiệu không lưu vì X luôn đi trước và hai bên đi xen kẽ.
+    """
+    out = bytearray((MOVES_FORMAT, size))
+    wide = size*size > 256
+    prev = moves[0]["ts"] if moves else 0
+    _put_varint(out, prev)
+    for i, mv in enumerate(moves):
+        if mv.get("symbol", "XO"[i % 2]) != "XO"[i % 2]:
+            raise ValueError(f"move {i} breaks X/O alternation")
+        cell = mv["y"]*size + mv["x"]
+        if wide: out += cell.to_bytes(2, "big")
+        else:    out.append(cell)
+        _put_varint(out, max(0, mv["ts"] - prev))
+        prev = max(prev, mv["ts"])
+    return bytes(out)
+
+def iter_moves(data: bytes | memoryview) -> Iterator[Tuple[int, int, str, int]]:
+    """Giải nén dần từng nước (x, y, symbol, ts) mà không dựng cả danh sách."""
+    if data[0] != MOVES_FORMAT:
+        raise ValueError(f"unknown moves format {data[0]}")
+    size = data[1]
+    wide = size*size > 256
+    ts, pos = _get_varint(data, 2)
+    i, end = 0, len(data)
+    while pos < end:
+        if wide:
+            cell = (data[pos] << 8) | data[pos+1]; pos += 2
+        else:
+            cell = data[pos]; pos += 1
+        dt, pos = _get_varint(data, pos)
+        ts += dt
+        yield cell % size, cell // size, "XO"[i % 2], ts
+        i += 1
+
+def decode_moves(data: bytes | memoryview) -> List[Dict[str, Any]]:
+    return [{"x": x, "y": y, "symbol": s, "ts": ts} for x, y, s, ts in iter_moves(data)]
+
+def _as_board(board) -> Board:
+    return board if isinstance(board, Board) else Board.from_rows(board)
+
+def check_win(board: Board | List[List[str]], x:int, y:int, symbol:str) -> bool:
+    b = _as_board(board)
+    bits, stride = b.mask(symbol), b.stride
+    i = y*stride + x
+    if not (bits >> i) & 1:
+        return False
+    for s, line in _geometry(b.size):
+        # chỉ xét 9 ô trên đường qua (x,y) theo hướng s
+        lo = i - 4*s
+        w = ((bits >> lo) if lo >= 0 else (bits << -lo)) & line
+        m = w & (w >> s)
+        m &= m >> (2*s)
+        if m & (w >> (4*s)):
             return True
     return False
 
-def find_win_line(board: List[List[str]], x:int, y:int, symbol:str) -> List[Tuple[int,int]]:
+def find_win_line(board: Board | List[List[str]], x:int, y:int, symbol:str) -> List[Tuple[int,int]]:
     """Trả về danh sách toạ độ (>=5) tạo thành một đường thắng chứa (x,y)."""
-    n = len(board)
+    b = _as_board(board)
+    bits, stride, n = b.mask(symbol), b.stride, b.size
     best: List[Tuple[int,int]] = []
     for dx,dy in DIRS:
-        cells = [(x,y)]
-        for s in (1,-1):
-            nx, ny = x, y
-            while True:
-                nx += dx*s
-                ny += dy*s
-                if 0<=nx<n and 0<=ny<n and board[ny][nx]==symbol:
-                    if s==1: cells.append((nx,ny))
-                    else:    cells.insert(0,(nx,ny))
-                else:
-                    break
-        if len(cells) > len(best):
-            best = cells
+        lo = hi = 0
+        while 0 <= x-dx*(lo+1) < n and 0 <= y-dy*(lo+1) < n and (bits >> ((y-dy*(lo+1))*stride + x-dx*(lo+1))) & 1:
+            lo += 1
+        while 0 <= x+dx*(hi+1) < n and 0 <= y+dy*(hi+1) < n and (bits >> ((y+dy*(hi+1))*stride + x+dx*(hi+1))) & 1:
+            hi += 1
+        if lo + hi + 1 > len(best):
+            best = [(x+dx*k, y+dy*k) for k in range(-lo, hi+1)]
     return best if len(best) >= 5 else []
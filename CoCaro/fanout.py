@@ -0,0 +1,185 @@
+import asyncio, time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional
+
+from codec import Codec, LINE_JSON
+
+OVERFLOW_POLICIES = ("disconnect", "drop")
+
+class Outbox:
+    """Hàng đợi gửi có giới hạn cho một kết nối, kèm một task ghi riêng.
+
+    put() không bao giờ chờ: khi hàng đầy thì gọi on_overflow để server xử lý
+    theo chính sách đã cấu hình. Task ghi gom mọi gói đang chờ vào một lần write.
+    Khi hàng trống và socket không còn dữ liệu tồn, put() ghi thẳng vào transport
+    (một lần send, không phải đợi task ghi được đánh thức ở vòng lặp sau).
+    metrics (tuỳ chọn) nhận số byte gửi ra và thời gian chờ drain của mỗi lần write.
+    """
+    def __init__(self, writer: asyncio.StreamWriter, maxsize: int = 256,
+                 on_overflow: Optional[Callable[["Outbox"], None]] = None, codec: Codec = LINE_JSON,
+                 metrics=None):
+        self.writer = writer
+        self.transport = writer.transport
+        self.metrics = metrics
+        self.codec = codec
+        self.q: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize)
+        self.on_overflow = on_overflow
+        self.dropped = 0
+        self.closed = False
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, obj: Dict) -> bool:
+        return self.put(self.codec.encode(obj))
+
+    def send_many(self, objs: List[Dict]) -> bool:
+        """Mã hoá cả lô rồi đẩy thành một gói, để chúng đi chung một lần write."""
+        return self.put(b"".join(map(self.codec.encode, objs)))
+
+    def _write_now(self, data: bytes) -> bool:
+        # chỉ khi không có gì đang xếp hàng (giữ thứ tự) và transport không tồn dữ liệu
+        # (giữ giới hạn bộ nhớ: client chậm vẫn phải đi qua hàng đợi có giới hạn)
+        if not self.q.empty() or self.transport.get_write_buffer_size() or self.transport.is_closing():
+            return False
+        self.transport.write(data)
+        if self.metrics:
+            self.metrics.inc("caro_outbound_bytes_total", by=len(data))
+        return True
+
+    def offer(self, data: bytes) -> bool:
+        """Như put nhưng khi hàng đầy chỉ trả về False, không áp chính sách tràn."""
+        if self.closed or self.q.full():
+            return False
+        if not self._write_now(data):
+            self.q.put_nowait(data)
+        return True
+
+    def put(self, data: bytes) -> bool:
+        if self.closed:
+            return False
+        if self._write_now(data):
+            return True
+        try:
+            self.q.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.on_overflow:
+                self.on_overflow(self)
+            return False
+
+    async def _run(self):
+        q, writer, mt = self.q, self.writer, self.metrics
+        try:
+            while True:
+                chunks = [await q.get()]
+                while not q.empty():
+                    chunks.append(q.get_nowait())
+                data = b"".join(chunks)
+                writer.write(data)
+                if mt:
+                    mt.inc("caro_outbound_bytes_total", by=len(data))
+                    t0 = time.perf_counter()
+                    await writer.drain()
+                    mt.observe("caro_drain_seconds", time.perf_counter() - t0)
+                else:
+                    await writer.drain()
+                for _ in chunks: q.task_done()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def flush(self, timeout: float = 1.0):
+        """Chờ gửi hết hàng đợi (tối đa timeout giây)."""
+        if self.task.done():
+            return
+        try:
+            await asyncio.wait_for(self.q.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
+    def abort(self):
+        """Ngắt kết nối ngay, bỏ dữ liệu chưa gửi (dùng cho client quá chậm)."""
+        self.close()
+        transport = self.writer.transport
+        if transport is not None:
+            transport.abort()
+
+class HoldBox:
+    """Thay cho Outbox khi client mất kết nối giữa trận và đang chờ resume.
+
+    Giữ lại (có giới hạn) các gói không dựng lại được từ trạng thái trận như chat,
+    lời mời, match_end. Nước đi và lượt được phát lại từ Match khi resume; presence
+    bị bỏ vì resume_ok gửi lại cả danh sách người chơi.
+    """
+    REBUILT = ("match_start", "move_ok", "opponent_move", "your_turn")
+    dropped = 0
+
+    def __init__(self, codec: Codec = LINE_JSON, maxlen: int = 64):
+        self.codec = codec
+        self.held: Deque[Dict] = deque(maxlen=maxlen)
+        self.closed = False
+
+    def send(self, obj: Dict) -> bool:
+        if obj.get("type") not in self.REBUILT:
+            self.held.append(obj)
+        return True
+
+    def put(self, data: bytes) -> bool:
+        return True
+
+    offer = put
+
+    def close(self):
+        self.closed = True
+
+def multicast(boxes: Iterable, msgs: List[Dict], best_effort: bool = False) -> List:
+    """Mã hoá msgs một lần cho mỗi codec rồi đẩy vào từng outbox.
+
+    best_effort=True dùng offer() (không ngắt kết nối người nhận chậm) và trả về
+    danh sách outbox đã từ chối gói tin.
+    """
+    payloads: Dict[str, bytes] = {}
+    refused = []
+    for box in boxes:
+        payload = payloads.get(box.codec.name)
+        if payload is None:
+            payload = payloads[box.codec.name] = b"".join(box.codec.encode(m) for m in msgs)
+        if not (box.offer(payload) if best_effort else box.put(payload)):
+            refused.append(box)
+    return refused
+
+class PresenceFanout:
+    """Gom các sự kiện đăng nhập/thoát trong một khoảng ngắn thành delta
+    user_joined/user_left, mã hoá một lần cho mỗi codec và đẩy vào outbox của mọi client."""
+    def __init__(self, targets: Callable[[], Iterable[Outbox]], delay: float = 0.05):
+        self.targets = targets
+        self.delay = delay
+        self.pending: Dict[str, bool] = {}
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def joined(self, name: str): self._mark(name, True)
+    def left(self, name: str): self._mark(name, False)
+
+    def _mark(self, name: str, online: bool):
+        # vào rồi ra (hoặc ra rồi vào) trong cùng một đợt thì triệt tiêu nhau
+        if name in self.pending and self.pending[name] != online:
+            del self.pending[name]
+        else:
+            self.pending[name] = online
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        self.handle = None
+        if not self.pending:
+            return
+        joined: List[str] = [n for n, on in self.pending.items() if on]
+        left: List[str] = [n for n, on in self.pending.items() if not on]
+        self.pending.clear()
+        msgs = []
+        if joined: msgs.append({"type": "user_joined", "users": joined})
+        if left:   msgs.append({"type": "user_left", "users": left})
+        multicast(list(self.targets()), msgs)
@@ -5,11 +5,12 @@ import threading
 import time
 import queue
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import tkinter as tk
 from tkinter import messagebox, ttk
 
-from common import send_json, recv_json, BOARD_SIZE, COORDS, THINK_TIME_SECONDS
+from common import BOARD_SIZE, COORDS, THINK_TIME_SECONDS, Board
+from client import CaroClient
 # ^^^ nếu bạn vẫn để tên file là common.py thì đổi lại: from common import ...
 
 # ---- Theme ----
@@ -17,22 +18,106 @@ BG = "#0f172a"; PANEL = "#111827"; BORDER = "#1f2937"; GRID = "#475569"
 ACCENT = "#22d3ee"; TEXT = "#e5e7eb"; SUB = "#9ca3af"
 X_COLOR = "#60a5fa"; O_COLOR = "#f87171"; LAST_MOVE = "#fde68a"; WINLINE = "#22c55e"
 
-CELL = 36; PAD = 28; BOARD_PIX = CELL*BOARD_SIZE
+CELL = 36; MIN_CELL = 16; PAD = 28; BOARD_PIX = CELL*BOARD_SIZE
 
 @dataclass
 class GameState:
     you: Optional[str] = None
     opponent: Optional[str] = None
-    board: List[List[str]] = field(default_factory=lambda: [["." for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)])
+    board: Board = field(default_factory=Board)
     your_turn: bool = False
     deadline: Optional[float] = None
     last_move: Optional[Tuple[int,int]] = None
     win_line: Optional[List[Tuple[int,int]]] = None
 
+class BoardView:
+    """Vẽ bàn cờ kiểu retained-mode: lưới và nhãn chỉ vẽ lại khi đổi kích thước bàn,
+    mỗi quân là một cặp item riêng trên canvas; bóng di chuột và dấu nước cuối là
+    item cố định, chỉ dời bằng coords. Mỗi sự kiện chỉ chạm vào các ô thay đổi."""
+    def __init__(self, canvas: tk.Canvas):
+        self.canvas = canvas
+        self.size = 0; self.cell = CELL
+        self.pieces: Dict[Tuple[int,int], Tuple[int,int]] = {}
+        self.win_items: List[int] = []
+
+    def center(self, x: int, y: int) -> Tuple[float, float]:
+        return PAD + self.cell/2 + x*self.cell, PAD + self.cell/2 + y*self.cell
+
+    def reset(self, size: int):
+        c = self.canvas; c.delete("all")
+        # bàn lớn hơn mặc định thì thu nhỏ ô để canvas không vượt quá cửa sổ
+        self.size = size; self.cell = cell = CELL if size <= BOARD_SIZE else max(MIN_CELL, BOARD_PIX // size)
+        pix = cell*size; small = ("Segoe UI", max(7, cell // 4))
+        c.config(width=pix+2*PAD, height=pix+2*PAD)
+        c.create_rectangle(PAD-8, PAD-8, PAD+pix+8, PAD+pix+8, outline=ACCENT, width=1)
+        c.create_rectangle(PAD, PAD, PAD+pix, PAD+pix, fill=BG, outline=BORDER, width=2)
+        for i in range(size):
+            x, y = self.center(i, i)
+            c.create_line(PAD+cell/2, y, PAD+pix-cell/2, y, fill=GRID)
+            c.create_line(x, PAD+cell/2, x, PAD+pix-cell/2, fill=GRID)
+            c.create_text(x, PAD-10, text=COORDS[i] if i < len(COORDS) else str(i+1), fill=SUB, font=small)
+            c.create_text(PAD-14, y, text=str(i+1), fill=SUB, font=small)
+        self.font = ("Segoe UI", int(cell*0.55), "bold")
+        self.pieces = {}; self.win_items = []
+        r = cell*0.15
+        self.last = c.create_oval(-r, -r, r, r, fill=LAST_MOVE, outline="", state=tk.HIDDEN)
+        self.ghost = (c.create_oval(0, 0, 0, 0, width=2, dash=(4, 3), state=tk.HIDDEN),
+                      c.create_text(0, 0, font=self.font, state=tk.HIDDEN))
+
+    def place(self, x: int, y: int, symbol: str):
+        """Thêm một quân và dời dấu nước cuối tới đó."""
+        c = self.canvas
+        if (x, y) not in self.pieces:
+            cx, cy = self.center(x, y); r = self.cell*0.42
+            color = X_COLOR if symbol == "X" else O_COLOR
+            self.pieces[(x, y)] = (c.create_oval(cx-r, cy-r, cx+r, cy+r, outline=color, width=3),
+                                   c.create_text(cx, cy, text=symbol, fill=color, font=self.font))
+        self.mark_last((x, y))
+
+    def mark_last(self, pos: Optional[Tuple[int,int]]):
+        c = self.canvas
+        if pos is None:
+            c.itemconfigure(self.last, state=tk.HIDDEN); return
+        cx, cy = self.center(*pos); r = self.cell*0.15
+        c.coords(self.last, cx-r, cy-r, cx+r, cy+r)
+        c.itemconfigure(self.last, state=tk.NORMAL); c.tag_raise(self.last)
+
+    def hover(self, pos: Optional[Tuple[int,int]], symbol: Optional[str]):
+        """Hiện quân mờ ở pos (hoặc ẩn đi nếu pos None / ô đã có quân)."""
+        c = self.canvas; oval, text = self.ghost
+        if pos is None or not symbol or pos in self.pieces:
+            c.itemconfigure(oval, state=tk.HIDDEN); c.itemconfigure(text, state=tk.HIDDEN); return
+        cx, cy = self.center(*pos); r = self.cell*0.42
+        color = X_COLOR if symbol == "X" else O_COLOR
+        c.coords(oval, cx-r, cy-r, cx+r, cy+r); c.coords(text, cx, cy)
+        c.itemconfigure(oval, outline=color, state=tk.NORMAL)
+        c.itemconfigure(text, text=symbol, fill=SUB, state=tk.NORMAL)
+        c.tag_raise(oval); c.tag_raise(text)
+
+    def show_win(self, line: Optional[List[Tuple[int,int]]]):
+        c = self.canvas
+        for item in self.win_items: c.delete(item)
+        self.win_items = []
+        for x, y in line or []:
+            cx, cy = self.center(x, y); h = self.cell*0.5
+            self.win_items.append(c.create_rectangle(cx-h, cy-h, cx+h, cy+h, outline=WINLINE, width=2))
+
+    def sync(self, board: Board, last_move: Optional[Tuple[int,int]] = None):
+        """Đưa canvas về đúng trạng thái board, chỉ thêm/xoá những ô khác nhau."""
+        if board.size != self.size:
+            self.reset(board.size)
+        for pos in [p for p in self.pieces if not board.occupied(*p)]:
+            for item in self.pieces.pop(pos): self.canvas.delete(item)
+        for y in range(board.size):
+            for x in range(board.size):
+                v = board.get(x, y)
+                if v != "." and (x, y) not in self.pieces: self.place(x, y, v)
+        self.mark_last(last_move)
+
 class PrettyClient:
     def __init__(self, name: str, host: str, port: int):
         self.name, self.host, self.port = name, host, port
-        self.reader = None; self.writer = None; self.loop = None
+        self.net = CaroClient(name, host, port); self.loop = None
         self.in_q: "queue.Queue[dict]" = queue.Queue()
         self.game = GameState(); self.users: list[str] = []; self.hover_xy: Optional[Tuple[int,int]] = None
 
@@ -63,6 +148,7 @@ class PrettyClient:
         ttk.Button(btnrow, text="Thách đấu", command=self.challenge).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(0,6))
         ttk.Button(btnrow, text="Chấp nhận…", command=self.accept_dialog).pack(side=tk.LEFT, expand=True, fill=tk.X)
         ttk.Button(btnrow, text="Đầu hàng", command=self.resign).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(6,0))
+        ttk.Button(users_card, text="Ghép trận ngẫu nhiên", command=lambda: self.send_now({"type":"queue_join"})).pack(fill=tk.X, pady=(6,0))
 
         chat_card = ttk.Frame(right, style="Card.TFrame", padding=12); chat_card.pack(fill=tk.BOTH, expand=True, pady=(12,0))
         ttk.Label(chat_card, text="Chat", font=("Segoe UI", 11, "bold")).pack(anchor=tk.W)
@@ -73,8 +159,13 @@ class PrettyClient:
         self.chat_entry = ttk.Entry(chat_row); self.chat_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
         ttk.Button(chat_row, text="Gửi", command=self.send_chat).pack(side=tk.LEFT, padx=(6,0))  # <-- đã có send_chat
 
-        self.draw_board()
-        self.root.after(60, self.poll_q); self.root.after(200, self.update_timer)
+        self.view = BoardView(self.canvas); self.view.reset(self.game.board.size)
+        # luồng mạng đánh thức luồng Tk bằng event_generate (cần Tcl build có thread),
+        # nếu không có thì quay về poll hàng đợi như cũ
+        self.wake_pending = False; self.timer_job = None
+        self.threaded_tcl = self.root.tk.eval("info exists tcl_platform(threaded)") == "1"
+        self.root.bind("<<NetMsg>>", lambda e: self.drain_q())
+        if not self.threaded_tcl: self.root.after(60, self.poll_q)
         self.start_network()
 
     # Network
@@ -85,69 +176,48 @@ class PrettyClient:
         threading.Thread(target=runner, daemon=True).start()
 
     async def net_main(self):
-        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        await send_json(self.writer, {"type":"login","name":self.name})
-        self.in_q.put(await recv_json(self.reader))
-        try:
-            while True: self.in_q.put(await recv_json(self.reader))
-        except Exception as e: self.in_q.put({"type":"_error","msg":str(e)})
+        hello = await self.net.connect()
+        while hello:
+            self.post(hello)
+            try:
+                while True: self.post(await self.net.recv())
+            except Exception as e: err = str(e)
+            self.post({"type":"_reconnecting"})
+            hello = await self.net.reconnect()  # resume trong thời gian ân hạn, giữ nguyên trận
+        self.post({"type":"_error","msg":err})
+
+    def post(self, msg: dict):
+        """Gọi từ luồng mạng: xếp gói tin và đánh thức luồng Tk một lần cho cả loạt."""
+        self.in_q.put(msg)
+        if self.threaded_tcl and not self.wake_pending:
+            self.wake_pending = True
+            try: self.root.event_generate("<<NetMsg>>", when="tail")
+            except (tk.TclError, RuntimeError): pass  # cửa sổ đã đóng
 
     async def send(self, obj: dict):
-        if self.writer: await send_json(self.writer, obj)
+        if self.net.writer:
+            await self.net.send(obj)
     def send_now(self, obj: dict):
         if self.loop: asyncio.run_coroutine_threadsafe(self.send(obj), self.loop)
 
     # Board rendering
-    def draw_board(self):
-        c = self.canvas; c.delete("all")
-        c.create_rectangle(PAD-8, PAD-8, PAD+BOARD_PIX+8, PAD+BOARD_PIX+8, outline=ACCENT, width=1)
-        c.create_rectangle(PAD, PAD, PAD+BOARD_PIX, PAD+BOARD_PIX, fill=BG, outline=BORDER, width=2)
-        for i in range(BOARD_SIZE):
-            y = PAD + CELL/2 + i*CELL
-            c.create_line(PAD+CELL/2, y, PAD+BOARD_PIX-CELL/2, y, fill=GRID)
-            x = PAD + CELL/2 + i*CELL
-            c.create_line(x, PAD+CELL/2, x, PAD+BOARD_PIX-CELL/2, fill=GRID)
-        for i, ch in enumerate(COORDS):
-            x = PAD + CELL/2 + i*CELL
-            c.create_text(x, PAD-10, text=ch, fill=SUB)
-            c.create_text(PAD-14, PAD+CELL/2+i*CELL, text=str(i+1), fill=SUB)
-        if self.game.win_line:
-            for (x,y) in self.game.win_line:
-                cx = PAD + CELL/2 + x*CELL; cy = PAD + CELL/2 + y*CELL
-                c.create_rectangle(cx-CELL*0.5, cy-CELL*0.5, cx+CELL*0.5, cy+CELL*0.5, outline=WINLINE, width=2)
-        for y in range(BOARD_SIZE):
-            for x in range(BOARD_SIZE):
-                v = self.game.board[y][x]
-                if v != ".": self.draw_piece(x,y,v)
-        if self.game.last_move:
-            x,y = self.game.last_move
-            cx = PAD + CELL/2 + x*CELL; cy = PAD + CELL/2 + y*CELL; r = CELL*0.15
-            c.create_oval(cx-r, cy-r, cx+r, cy+r, fill=LAST_MOVE, outline="")
-        if self.hover_xy and self.game.your_turn:
-            x,y = self.hover_xy
-            if self.game.board[y][x] == ".": self.draw_piece(x,y,self.game.you, ghost=True)
-
-    def draw_piece(self, x:int, y:int, symbol:str, ghost=False):
-        cx = PAD + CELL/2 + x*CELL; cy = PAD + CELL/2 + y*CELL; r = CELL*0.42
-        outline = X_COLOR if symbol=="X" else O_COLOR
-        if ghost: outline = outline + "80"
-        self.canvas.create_oval(cx-r, cy-r, cx+r, cy+r, outline=outline, width=3)
-        self.canvas.create_text(cx, cy, text=symbol, fill=outline, font=("Segoe UI", int(CELL*0.55), "bold"))
+    def refresh_hover(self):
+        self.view.hover(self.hover_xy, self.game.you if self.game.your_turn else None)
 
     def board_xy(self, xpix, ypix):
-        x = int((xpix - PAD) // CELL); y = int((ypix - PAD) // CELL)
-        return (x,y) if 0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE else None
+        cell = self.view.cell; x = int((xpix - PAD) // cell); y = int((ypix - PAD) // cell)
+        return (x,y) if self.game.board.in_bounds(x,y) else None
 
     def on_click(self, ev):
         pos = self.board_xy(ev.x, ev.y)
         if not pos or not self.game.your_turn: return
         x,y = pos
-        if self.game.board[y][x] == ".": self.send_now({"type":"move","x":x,"y":y})
+        if not self.game.board.occupied(x,y): self.send_now({"type":"move","x":x,"y":y})
 
     def on_hover(self, ev):
         pos = self.board_xy(ev.x, ev.y)
-        if pos != self.hover_xy: self.hover_xy = pos; self.draw_board()
-    def clear_hover(self): self.hover_xy = None; self.draw_board()
+        if pos != self.hover_xy: self.hover_xy = pos; self.refresh_hover()
+    def clear_hover(self): self.hover_xy = None; self.refresh_hover()
 
     # UI helpers
     def append_chat(self, line: str):
@@ -179,41 +249,81 @@ class PrettyClient:
         self.send_now({"type":"resign"})
 
     # Message pump
-    def poll_q(self):
+    def drain_q(self):
+        """Xử lý mọi gói đang chờ rồi cập nhật hiển thị một lần."""
+        self.wake_pending = False; n = 0
         try:
-            while True: self.handle_msg(self.in_q.get_nowait())
+            while True: self.handle_msg(self.in_q.get_nowait()); n += 1
         except queue.Empty: pass
-        self.root.after(60, self.poll_q)
+        if n: self.refresh_hover(); self.update_timer()
+
+    def poll_q(self):
+        self.drain_q(); self.root.after(60, self.poll_q)
+
+    def set_users(self, users):
+        self.list_users.delete(0, tk.END); self.users = list(users)
+        for u in self.users: self.list_users.insert(tk.END, u)
 
     def handle_msg(self, msg: dict):
         t = msg.get("type")
         if t == "login_ok":
             self.append_chat("[system] Đăng nhập thành công.")
+            self.set_users(msg.get("users", []))
+        elif t == "resume_ok":
+            self.append_chat("[system] Đã nối lại máy chủ.")
+            self.set_users(msg.get("users", []))
+            snap = msg.get("match")
+            if snap and "cells" in snap:
+                n = snap["size"]; cells = snap["cells"]
+                self.game.board = Board.from_rows([cells[y*n:(y+1)*n] for y in range(n)]); self.view.sync(self.game.board)
+            elif not snap:
+                self.game.your_turn = False; self.game.deadline = None
+        elif t == "sync":
+            if "cells" in msg:
+                n = msg["size"]; cells = msg["cells"]
+                self.game.board = Board.from_rows([cells[y*n:(y+1)*n] for y in range(n)])
+            else:
+                d = msg["diff"]
+                for i in range(0, len(d), 2):
+                    # ký hiệu theo thứ tự nước (X đi trước); ô đã có từ sự kiện lẻ thì bỏ qua
+                    x, y = d[i], d[i+1]
+                    if not self.game.board.occupied(x, y): self.game.board.place(x, y, "XO"[(msg["since"] + i//2) % 2])
+            self.view.sync(self.game.board)
+        elif t == "queue_ok":
+            self.append_chat(f"[system] Đang tìm đối thủ (điểm {msg.get('rating')})…")
+        elif t == "invite_expired":
+            self.append_chat(f"[system] Lời mời tới {msg.get('opponent')} đã hết hạn.")
+        elif t == "_reconnecting":
+            self.append_chat("[system] Mất kết nối, đang nối lại…")
         elif t == "user_list":
-            self.list_users.delete(0, tk.END); self.users = list(msg.get("users", []))
-            for u in self.users: self.list_users.insert(tk.END, u)
+            self.set_users(msg.get("users", []))
+        elif t == "user_joined":
+            self.set_users(self.users + [u for u in msg.get("users", []) if u not in self.users])
+        elif t == "user_left":
+            gone = set(msg.get("users", [])); self.set_users([u for u in self.users if u not in gone])
         elif t == "invite":
             frm = msg.get("from")
             if messagebox.askyesno("Lời mời", f"{frm} thách đấu. Chấp nhận?"):
                 self.send_now({"type":"accept","opponent":frm})
         elif t == "match_start":
-            self.game = GameState(); self.game.you = msg.get("you"); self.game.opponent = msg.get("opponent")
+            self.game = GameState(board=Board(msg.get("size", BOARD_SIZE))); self.game.you = msg.get("you"); self.game.opponent = msg.get("opponent")
+            self.view.sync(self.game.board); self.view.show_win(None)
             self.lbl_status.config(text=f"Trận với {self.game.opponent} | Bạn: {self.game.you}")
-            self.draw_board()
         elif t == "your_turn":
-            self.game.your_turn = True; self.game.deadline = msg.get("deadline"); self.draw_board()
+            self.game.your_turn = True; self.game.deadline = msg.get("deadline")
         elif t == "move_ok":
-            x,y = msg["x"], msg["y"]; self.game.board[y][x] = msg.get("symbol","?")
-            self.game.last_move = (x,y); self.game.your_turn = False; self.draw_board()
+            x,y = msg["x"], msg["y"]; self.game.board.place(x, y, msg.get("symbol","?"))
+            self.game.last_move = (x,y); self.game.your_turn = False
+            self.view.place(x, y, msg.get("symbol","?"))
         elif t == "opponent_move":
-            x,y = msg["x"], msg["y"]; self.game.board[y][x] = msg.get("symbol","?")
-            self.game.last_move = (x,y); self.draw_board()
+            x,y = msg["x"], msg["y"]; self.game.board.place(x, y, msg.get("symbol","?"))
+            self.game.last_move = (x,y); self.view.place(x, y, msg.get("symbol","?"))
         elif t == "match_end":
             self.game.your_turn = False; self.game.deadline = None
             self.game.win_line = msg.get("win_line")  # highlight đường thắng
-            self.draw_board()
+            self.view.show_win(self.game.win_line); self.refresh_hover(); self.update_timer()
             reason = msg.get("reason"); winner = msg.get("winner")
-            messagebox.showinfo("Kết thúc", f"Lý do: {reason}\nKết quả: {winner}")
+            messagebox.showinfo("Kết thúc", f"Lý do: {reason}\nKết quả: {winner}" + (f"\nĐiểm: {msg['rating']}" if "rating" in msg else ""))
             self.lbl_status.config(text="Chưa trong trận")
         elif t == "chat":
             self.append_chat(f"[{msg.get('from')}] {msg.get('text')}")
@@ -223,13 +333,14 @@ class PrettyClient:
             self.append_chat("[system] Mất kết nối máy chủ.")
 
     def update_timer(self):
+        if self.timer_job: self.root.after_cancel(self.timer_job); self.timer_job = None
         if self.game.your_turn and self.game.deadline:
-            remain = int(self.game.deadline - time.time()); 
-            if remain < 0: remain = 0
-            self.lbl_timer.config(text=f"Thời gian: {remain}s")
+            remain = self.game.deadline - time.time()
+            self.lbl_timer.config(text=f"Thời gian: {max(0, int(remain))}s")
+            # hẹn đúng lúc số giây hiển thị đổi, thay vì poll 200ms
+            if remain > 0: self.timer_job = self.root.after(int(remain % 1 * 1000) + 1, self.update_timer)
         else:
             self.lbl_timer.config(text="")
-        self.root.after(200, self.update_timer)
 
     def run(self): self.root.mainloop()
 
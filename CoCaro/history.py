@@ -0,0 +1,362 @@
+import argparse, asyncio, json, queue, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from common import BOARD_SIZE, encode_moves, iter_moves
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id TEXT PRIMARY KEY,
+    player_x TEXT,
+    player_o TEXT,
+    winner TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    moves BLOB,
+    win_line TEXT,
+    board_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_matches_player_x ON matches(player_x, finished_at, id);
+CREATE INDEX IF NOT EXISTS idx_matches_player_o ON matches(player_o, finished_at, id);
+CREATE INDEX IF NOT EXISTS idx_matches_winner ON matches(winner);
+CREATE INDEX IF NOT EXISTS idx_matches_finished ON matches(finished_at, id);
+CREATE TABLE IF NOT EXISTS player_stats (
+    name TEXT PRIMARY KEY,
+    games INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    draws INTEGER NOT NULL DEFAULT 0,
+    streak INTEGER NOT NULL DEFAULT 0,
+    best_streak INTEGER NOT NULL DEFAULT 0,
+    last_finished TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_player_stats_wins ON player_stats(wins DESC, name);
+CREATE TABLE IF NOT EXISTS ratings (
+    name TEXT PRIMARY KEY,
+    rating REAL NOT NULL,
+    games INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+INSERT_MATCH = ("INSERT OR REPLACE INTO matches (id, player_x, player_o, winner, started_at, finished_at, moves, win_line, board_hash) "
+                "VALUES (?,?,?,?,?,?,?,?,?)")
+
+# streak > 0: chuỗi thắng, < 0: chuỗi thua; trong UPDATE mọi cột bên phải là giá trị cũ
+UPSERT_STATS = """
+INSERT INTO player_stats (name, games, wins, losses, draws, streak, best_streak, last_finished)
+VALUES (?1, 1, ?2, ?3, ?4, ?2 - ?3, ?2, ?5)
+ON CONFLICT(name) DO UPDATE SET
+    games = games + 1,
+    wins = wins + excluded.wins,
+    losses = losses + excluded.losses,
+    draws = draws + excluded.draws,
+    streak = CASE WHEN excluded.wins THEN max(streak, 0) + 1
+                  WHEN excluded.losses THEN min(streak, 0) - 1
+                  ELSE 0 END,
+    best_streak = CASE WHEN excluded.wins THEN max(best_streak, max(streak, 0) + 1)
+                       ELSE best_streak END,
+    last_finished = excluded.last_finished
+"""
+
+UPSERT_RATING = "INSERT INTO ratings (name, rating, games) VALUES (?,?,?) ON CONFLICT(name) DO UPDATE SET rating = excluded.rating, games = excluded.games"
+
+ELO_START = 1500.0
+ELO_K = 32.0
+# khi phát lại, khoảng cách giữa hai nước bị kẹp trong đoạn này (giây, trước khi chia cho tốc độ)
+REPLAY_GAP = (0.25, 3.0)
+
+MATCH_COLUMNS = ("id", "player_x", "player_o", "winner", "started_at", "finished_at")
+STATS_COLUMNS = ("name", "games", "wins", "losses", "draws", "streak", "best_streak", "last_finished")
+
+_STOP = object()
+
+def connect(db_path: str, **kw) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, **kw)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(matches)")}
+    for col in ("win_line", "board_hash"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE matches ADD COLUMN {col} TEXT")  # DB cũ: để NULL cho các trận đã có
+    conn.commit()
+    if conn.execute("SELECT 1 FROM player_stats LIMIT 1").fetchone() is None:
+        rebuild_stats(conn)
+    if conn.execute("SELECT 1 FROM ratings LIMIT 1").fetchone() is None:
+        rebuild_ratings(conn)
+    return conn
+
+def stats_params(row: Tuple) -> List[Tuple]:
+    """Tham số UPSERT_STATS cho hai người chơi của một dòng matches."""
+    _, px, po, winner, _, finished_at = row[:6]
+    out = []
+    for name in (px, po):
+        won = int(winner == name)
+        lost = int(winner in (px, po) and winner != name)
+        out.append((name, won, lost, int(not won and not lost), finished_at))
+    return out
+
+def rebuild_stats(conn: sqlite3.Connection):
+    """Dựng lại player_stats từ toàn bộ matches (chỉ dùng một lần khi nâng cấp DB)."""
+    with conn:
+        conn.execute("DELETE FROM player_stats")
+        cur = conn.execute("SELECT id, player_x, player_o, winner, started_at, finished_at FROM matches ORDER BY finished_at, id")
+        for row in cur:
+            conn.executemany(UPSERT_STATS, stats_params(row))
+
+def elo(ra: float, rb: float, score: float, k: float = ELO_K) -> Tuple[float, float]:
+    """Điểm mới của (a, b) sau một ván; score là kết quả của a (1 thắng, 0.5 hoà, 0 thua)."""
+    d = k * (score - 1 / (1 + 10 ** ((rb - ra) / 400)))
+    return ra + d, rb - d
+
+def match_score(row: Tuple) -> float:
+    _, px, po, winner = row[:4]
+    return 1.0 if winner == px else (0.0 if winner == po else 0.5)
+
+def apply_ratings(conn: sqlite3.Connection, rows) -> int:
+    """Cập nhật ratings theo thứ tự các dòng matches (đã sắp theo thời gian kết thúc)."""
+    cache: Dict[str, List] = {}
+    def get(name: str) -> List:
+        r = cache.get(name)
+        if r is None:
+            row = conn.execute("SELECT rating, games FROM ratings WHERE name = ?", (name,)).fetchone()
+            r = cache[name] = list(row) if row else [ELO_START, 0]
+        return r
+    for row in rows:
+        a, b = get(row[1]), get(row[2])
+        a[0], b[0] = elo(a[0], b[0], match_score(row))
+        a[1] += 1; b[1] += 1
+    conn.executemany(UPSERT_RATING, [(n, r, g) for n, (r, g) in cache.items()])
+    return len(cache)
+
+def rebuild_ratings(conn: sqlite3.Connection):
+    """Tính lại toàn bộ ratings bằng cách phát lại matches theo thứ tự thời gian."""
+    with conn:
+        conn.execute("DELETE FROM ratings")
+        apply_ratings(conn, conn.execute("SELECT id, player_x, player_o, winner FROM matches ORDER BY finished_at, id").fetchall())
+
+def write_matches(conn: sqlite3.Connection, rows: List[Tuple]):
+    """Ghi các dòng matches (theo INSERT_MATCH, đúng thứ tự kết thúc) cùng player_stats và
+    ratings trong một transaction, để hai bảng tổng hợp luôn khớp với matches."""
+    with conn:
+        conn.executemany(INSERT_MATCH, rows)
+        conn.executemany(UPSERT_STATS, [p for row in rows for p in stats_params(row)])
+        apply_ratings(conn, rows)
+
+def load_ratings(conn: sqlite3.Connection) -> Dict[str, float]:
+    return dict(conn.execute("SELECT name, rating FROM ratings"))
+
+def player_history(conn: sqlite3.Connection, name: str, before: Optional[List] = None, limit: int = 20) -> Tuple[List[Dict], Optional[List]]:
+    """Các trận của name, mới nhất trước, phân trang theo khoá (finished_at, id).
+
+    Mỗi nhánh của UNION dùng đúng một index idx_matches_player_x/_o.
+    """
+    cols = ", ".join(MATCH_COLUMNS)
+    key = "AND (finished_at, id) < (?, ?)" if before else ""
+    args = [name, *before] if before else [name]
+    sql = (
+        f"SELECT {cols} FROM (SELECT {cols} FROM matches WHERE player_x = ? {key} ORDER BY finished_at DESC, id DESC LIMIT ?) "
+        f"UNION ALL SELECT {cols} FROM (SELECT {cols} FROM matches WHERE player_o = ? {key} ORDER BY finished_at DESC, id DESC LIMIT ?) "
+        "ORDER BY finished_at DESC, id DESC LIMIT ?"
+    )
+    rows = conn.execute(sql, (*args, limit, *args, limit, limit)).fetchall()
+    matches = [dict(zip(MATCH_COLUMNS, r)) for r in rows]
+    nxt = [rows[-1][5], rows[-1][0]] if len(rows) == limit else None
+    return matches, nxt
+
+def player_stats(conn: sqlite3.Connection, name: str) -> Optional[Dict]:
+    row = conn.execute(f"SELECT {', '.join(STATS_COLUMNS)} FROM player_stats WHERE name = ?", (name,)).fetchone()
+    return dict(zip(STATS_COLUMNS, row)) if row else None
+
+def leaderboard(conn: sqlite3.Connection, after: Optional[List] = None, limit: int = 10) -> Tuple[List[Dict], Optional[List]]:
+    """Bảng xếp hạng theo số trận thắng, phân trang theo khoá (wins, name)."""
+    cols = ", ".join(STATS_COLUMNS)
+    if after:
+        rows = conn.execute(
+            f"SELECT {cols} FROM player_stats WHERE wins < ? OR (wins = ? AND name > ?) ORDER BY wins DESC, name LIMIT ?",
+            (after[0], after[0], after[1], limit),
+        ).fetchall()
+    else:
+        rows = conn.execute(f"SELECT {cols} FROM player_stats ORDER BY wins DESC, name LIMIT ?", (limit,)).fetchall()
+    out = [dict(zip(STATS_COLUMNS, r)) for r in rows]
+    nxt = [rows[-1][2], rows[-1][0]] if len(rows) == limit else None
+    return out, nxt
+
+class HistoryReader:
+    """Chạy các truy vấn đọc trên một thread riêng với kết nối riêng (WAL cho phép
+    đọc song song với HistoryWriter)."""
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-reader")
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, self.conn, *args)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.conn.close()
+
+def iter_stored_moves(data) -> Iterator[Tuple[int, int, str, int]]:
+    """Giải nén cột moves: (x, y, symbol, ts). Hỗ trợ cả dòng cũ lưu JSON (TEXT)
+    lẫn dòng đã nén (BLOB)."""
+    if isinstance(data, bytes):
+        yield from iter_moves(memoryview(data))
+    else:
+        for mv in json.loads(data or "[]"):
+            yield mv["x"], mv["y"], mv["symbol"], mv["ts"]
+
+def stored_size(data) -> int:
+    return data[1] if isinstance(data, bytes) and data else BOARD_SIZE
+
+def encode_line(line: List[Tuple[int, int]]) -> str:
+    """Cột win_line: "x,y x,y ..." (chuỗi rỗng khi trận không kết thúc bằng năm quân)."""
+    return " ".join(f"{x},{y}" for x, y in line)
+
+def decode_line(text: Optional[str]) -> Optional[List[List[int]]]:
+    """None nếu dòng cũ chưa có cột win_line."""
+    if text is None:
+        return None
+    return [[int(v) for v in p.split(",")] for p in text.split()]
+
+def iter_replay(conn: sqlite3.Connection, match_id: str) -> Iterator[Tuple[int, int, str, int]]:
+    """Đọc nước đi của một trận theo kiểu stream: (x, y, symbol, ts)."""
+    row = conn.execute("SELECT moves FROM matches WHERE id=?", (match_id,)).fetchone()
+    if row is None:
+        raise KeyError(match_id)
+    yield from iter_stored_moves(row[0])
+
+def load_replay(conn: sqlite3.Connection, match_id: str) -> Optional[Tuple[Dict, int, List[Tuple[int, int, str, int]]]]:
+    """(thông tin trận, kích thước bàn, các nước đi) của một trận, None nếu không có.
+    Thông tin gồm cả win_line (None với dòng cũ) và board_hash."""
+    row = conn.execute(f"SELECT {', '.join(MATCH_COLUMNS)}, win_line, board_hash, moves FROM matches WHERE id=?",
+                       (match_id,)).fetchone()
+    if row is None:
+        return None
+    info = dict(zip(MATCH_COLUMNS, row))
+    info["win_line"], info["board_hash"] = decode_line(row[-3]), row[-2]
+    return info, stored_size(row[-1]), list(iter_stored_moves(row[-1]))
+
+def migrate_moves(conn: sqlite3.Connection, batch_size: int = 1000, size: int = BOARD_SIZE) -> Tuple[int, int]:
+    """Chuyển các dòng moves dạng JSON sang BLOB nén. Trả về (số dòng đã chuyển, số dòng bỏ qua)."""
+    converted = skipped = 0
+    last = ""
+    while True:
+        rows = conn.execute(
+            "SELECT id, moves FROM matches WHERE id > ? AND typeof(moves) = 'text' ORDER BY id LIMIT ?",
+            (last, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for match_id, text in rows:
+            last = match_id
+            try:
+                updates.append((encode_moves(json.loads(text or "[]"), size), match_id))
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"skip {match_id}: {e}")
+                skipped += 1
+        with conn:
+            conn.executemany("UPDATE matches SET moves=? WHERE id=?", updates)
+        converted += len(updates)
+    return converted, skipped
+
+class HistoryWriter:
+    """Ghi lịch sử trận đấu ở một thread nền để không chặn event loop.
+
+    Các trận kết thúc được đưa vào hàng đợi; thread gom chúng trong tối đa
+    commit_interval giây (hoặc max_batch dòng) rồi ghi một transaction duy nhất.
+    Lỗi tạm thời (database is locked/busy) thì thử lại lô đó tối đa retries lần, chờ
+    retry_delay giây và gấp đôi sau mỗi lần; vẫn lỗi thì bỏ lô và đếm vào failed.
+    """
+    def __init__(self, db_path: str, commit_interval: float = 0.2, max_batch: int = 500,
+                 retries: int = 5, retry_delay: float = 0.1):
+        self.conn = connect(db_path, check_same_thread=False)
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.q: "queue.Queue" = queue.Queue()
+        self.written = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+        self.retried = 0  # số lần thử lại một lô
+        self.failed = 0   # số trận bị bỏ vì ghi lỗi sau mọi lần thử
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, row: Tuple):
+        self.q.put(row)
+
+    def flush(self):
+        """Chặn tới khi mọi dòng đã submit được commit."""
+        self.q.join()
+
+    def close(self, timeout: Optional[float] = None):
+        if self.thread.is_alive():
+            self.q.put(_STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        q = self.q
+        stop = False
+        while not stop:
+            item = q.get()
+            if item is _STOP:
+                q.task_done()
+                break
+            batch: List[Tuple] = [item]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    q.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in batch: q.task_done()
+        self.conn.close()
+
+    def _write(self, batch: List[Tuple]):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            t0 = time.perf_counter()
+            try:
+                write_matches(self.conn, batch)  # lỗi giữa chừng: transaction đã rollback, ghi lại cả lô được
+                self.written += len(batch)
+                self.batches += 1
+                self.write_seconds += time.perf_counter() - t0
+                return
+            except sqlite3.OperationalError as e:  # locked/busy, đĩa đầy...: có thể qua khỏi
+                if attempt == self.retries:
+                    err = e
+                    break
+                print(f"history write failed ({len(batch)} rows): {e}, retrying in {delay:g}s")
+                self.retried += 1
+                time.sleep(delay)
+                delay *= 2
+            except sqlite3.Error as e:  # IntegrityError...: thử lại vẫn lỗi như cũ
+                err = e
+                break
+        self.failed += len(batch)
+        print(f"history write failed ({len(batch)} rows), dropped: {err}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Công cụ bảo trì game_history.db")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--db", default="game_history.db")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--vacuum", action="store_true", help="thu hồi dung lượng sau khi chuyển")
+    args = parser.parse_args()
+    conn = connect(args.db)
+    done, skipped = migrate_moves(conn, args.batch)
+    print(f"converted {done} rows, skipped {skipped}")
+    if args.vacuum:
+        conn.execute("VACUUM")
+    conn.close()
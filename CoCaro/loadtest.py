@@ -0,0 +1,233 @@
+# Công cụ tạo tải + đo độ trễ cho giao thức Caro (chạy headless, không cần GUI)
+import argparse, asyncio, json, random, sys, time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from client import CaroClient
+from common import Board, BOARD_SIZE
+
+@dataclass
+class Stats:
+    connect_ms: List[float] = field(default_factory=list)
+    move_ok_ms: List[float] = field(default_factory=list)
+    opponent_ms: List[float] = field(default_factory=list)
+    moves: int = 0
+    games: int = 0
+    chats: int = 0
+    errors: Dict[str, int] = field(default_factory=dict)
+
+    def error(self, what: str):
+        self.errors[what] = self.errors.get(what, 0) + 1
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+    pick = lambda q: round(s[min(len(s)-1, int(q*len(s)))], 3)
+    return {"count": len(s), "p50": pick(0.50), "p99": pick(0.99), "p999": pick(0.999), "max": round(s[-1], 3)}
+
+def server_rss_kb(pid: Optional[int]) -> Optional[int]:
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+class SimPlayer(CaroClient):
+    """Người chơi giả lập: tự thách đấu/chấp nhận, đánh ngẫu nhiên hoặc theo kịch bản."""
+    def __init__(self, name: str, host: str, port: int, stats: Stats, sent: Dict, args):
+        super().__init__(name, host, port, args.codec or ("frame", "json"))
+        self.stats, self.sent, self.args = stats, sent, args
+        self.opponent: Optional[str] = None
+        self.board = Board(BOARD_SIZE)
+        self.match_key: Optional[str] = None
+        self.symbol = "X"
+        self.script: List = []
+
+    async def run(self, opponent: str, challenger: bool, games_left: int):
+        while games_left > 0:
+            if challenger:
+                await self.send({"type": "challenge", "opponent": opponent})
+            ended = await self.play_one(opponent)
+            if not ended:
+                return
+            games_left -= 1
+            if challenger:
+                self.stats.games += 1
+
+    async def play_one(self, opponent: str) -> bool:
+        while True:
+            try:
+                msg = await asyncio.wait_for(self.recv(), self.args.timeout)
+            except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+                self.stats.error(type(e).__name__)
+                return False
+            t = msg.get("type")
+            now = time.perf_counter()
+            if t == "invite" and msg.get("from") == opponent:
+                await self.send({"type": "accept", "opponent": opponent})
+            elif t == "match_start":
+                self.board = Board(msg.get("size", BOARD_SIZE))
+                self.symbol = msg["you"]
+                self.match_key = "".join(sorted((self.name, opponent)))
+                self.script = self.scripted_moves() if self.args.mode == "scripted" else []
+            elif t == "your_turn":
+                if self.args.think_ms:
+                    await asyncio.sleep(random.uniform(0, self.args.think_ms) / 1000)
+                if random.random() < self.args.chat_rate:
+                    await self.send({"type": "chat", "text": "gg"})
+                    self.stats.chats += 1
+                x, y = self.pick_move()
+                self.sent[self.match_key] = time.perf_counter()
+                await self.send({"type": "move", "x": x, "y": y})
+            elif t == "move_ok":
+                self.board.place(msg["x"], msg["y"], msg["symbol"])
+                self.stats.move_ok_ms.append((now - self.sent.get(self.match_key, now)) * 1000)
+                self.stats.moves += 1
+            elif t == "opponent_move":
+                self.board.place(msg["x"], msg["y"], msg["symbol"])
+                self.stats.opponent_ms.append((now - self.sent.get(self.match_key, now)) * 1000)
+            elif t == "match_end":
+                return True
+            elif t == "error":
+                self.stats.error(msg.get("msg", "error"))
+
+    def scripted_moves(self) -> List:
+        # X đi thẳng một hàng để thắng sau 5 nước, O đi ở hàng khác
+        row = 0 if self.symbol == "X" else 2
+        return [(i, row) for i in range(self.board.size)]
+
+    def pick_move(self):
+        while self.script:
+            x, y = self.script.pop(0)
+            if not self.board.occupied(x, y):
+                return x, y
+        n = self.board.size
+        while True:
+            x, y = random.randrange(n), random.randrange(n)
+            if not self.board.occupied(x, y):
+                return x, y
+
+async def connect_all(args, stats: Stats, sent: Dict) -> List[SimPlayer]:
+    players: List[SimPlayer] = []
+    gap = 1.0 / args.connect_rate if args.connect_rate else 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(i: int):
+        async with sem:
+            p = SimPlayer(f"{args.prefix}{i}", args.host, args.port, stats, sent, args)
+            t0 = time.perf_counter()
+            try:
+                hello = await p.connect()
+            except OSError as e:
+                stats.error(type(e).__name__)
+                return
+            if hello.get("type") != "login_ok":
+                stats.error("login_failed")
+                return
+            stats.connect_ms.append((time.perf_counter() - t0) * 1000)
+            players.append(p)
+
+    tasks = []
+    for i in range(args.players):
+        tasks.append(asyncio.create_task(one(i)))
+        if gap:
+            await asyncio.sleep(gap)
+    await asyncio.gather(*tasks)
+    players.sort(key=lambda p: int(p.name[len(args.prefix):]))
+    return players
+
+async def main(args) -> Dict:
+    random.seed(args.seed)
+    stats, sent = Stats(), {}
+    rss_before = server_rss_kb(args.server_pid)
+    t0 = time.perf_counter()
+    players = await connect_all(args, stats, sent)
+    t_connect = time.perf_counter() - t0
+    # bỏ các thông báo user_joined dồn lại khi đăng nhập
+    await asyncio.sleep(args.settle)
+    t1 = time.perf_counter()
+    runs = []
+    for a, b in zip(players[0::2], players[1::2]):
+        runs.append(a.run(b.name, True, args.games))
+        runs.append(b.run(a.name, False, args.games))
+    await asyncio.gather(*runs)
+    t_play = time.perf_counter() - t1
+    rss_after = server_rss_kb(args.server_pid)
+    for p in players:
+        p.writer.close()
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "players_connected": len(players),
+        "connect_per_sec": round(len(players) / t_connect, 1) if t_connect else None,
+        "connect_ms": percentiles(stats.connect_ms),
+        "games": stats.games,
+        "moves": stats.moves,
+        "chats": stats.chats,
+        "moves_per_sec": round(stats.moves / t_play, 1) if t_play else None,
+        "latency_ms": {"move_ok": percentiles(stats.move_ok_ms), "opponent_move": percentiles(stats.opponent_ms)},
+        "server_rss_kb": {"before": rss_before, "after": rss_after},
+        "errors": stats.errors,
+    }
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Các chỉ số tệ hơn baseline quá tolerance (tỉ lệ)."""
+    bad = []
+    for key in ("moves_per_sec", "connect_per_sec"):
+        old, new = baseline.get(key), result.get(key)
+        if old and new is not None and new < old * (1 - tolerance):
+            bad.append(f"{key}: {new} < {old}")
+    for kind in ("move_ok", "opponent_move"):
+        for q in ("p50", "p99", "p999"):
+            old = baseline.get("latency_ms", {}).get(kind, {}).get(q)
+            new = result["latency_ms"][kind].get(q)
+            if old and new is not None and new > old * (1 + tolerance):
+                bad.append(f"{kind}.{q}: {new}ms > {old}ms")
+    return bad
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Giả lập nhiều người chơi và đo server Caro "
+                                     "(với --think-ms nhỏ hãy chạy server kèm --no-rate-limit)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--players", type=int, default=100, help="số người chơi (làm tròn xuống số chẵn)")
+    parser.add_argument("--games", type=int, default=1, help="số ván mỗi cặp")
+    parser.add_argument("--mode", choices=["random", "scripted"], default="random")
+    parser.add_argument("--think-ms", type=float, default=0, help="thời gian nghĩ ngẫu nhiên tối đa mỗi nước")
+    parser.add_argument("--chat-rate", type=float, default=0.05, help="xác suất gửi chat trước mỗi nước")
+    parser.add_argument("--connect-rate", type=float, default=0, help="kết nối/giây (0 = không giới hạn)")
+    parser.add_argument("--concurrency", type=int, default=200, help="số kết nối đang bắt tay cùng lúc")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--settle", type=float, default=0.5)
+    parser.add_argument("--codec", action="append", help="codec đề nghị khi đăng nhập (mặc định: frame, json)")
+    parser.add_argument("--prefix", default="sim")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-pid", type=int, help="PID server để đọc RSS từ /proc")
+    parser.add_argument("--out", help="ghi kết quả JSON ra file (mặc định stdout)")
+    parser.add_argument("--compare", help="file JSON baseline để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.players + 256)), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    result = asyncio.run(main(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for r in regressions:
+            print("REGRESSION", r, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
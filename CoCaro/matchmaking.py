@@ -0,0 +1,97 @@
+# Hàng chờ ghép trận theo điểm Elo
+import bisect, heapq, itertools, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+Entry = Tuple[float, float, str]  # (điểm, thời điểm vào hàng, tên)
+
+class Matchmaker:
+    """Người chờ được sắp theo điểm và chỉ hai người liền kề mới được ghép với nhau.
+
+    Cửa sổ điểm của mỗi người nới rộng dần theo thời gian chờ, nên mỗi cặp liền kề có
+    một thời điểm bắt đầu hợp lệ tính trước được; các thời điểm đó nằm trong một heap
+    và một đợt pair() chỉ lấy những cặp đã tới hạn chứ không quét cả hàng. Thứ tự liền
+    kề là danh sách liên kết (prev/next) nên rời hàng là O(1); danh sách sắp xếp chỉ dùng
+    để tìm chỗ chèn và được dọn phần tử đã rời theo lô.
+    """
+    def __init__(self, window: float = 100.0, widen: float = 20.0, max_window: float = 1000.0,
+                 clock: Callable[[], float] = time.time):
+        self.window = window
+        self.widen = widen
+        self.max_window = max_window
+        self.clock = clock
+        self.entries: Dict[str, Entry] = {}
+        self.sorted: List[Entry] = []  # có thể còn phần tử đã rời hàng (xem live())
+        self.prev: Dict[Entry, Optional[Entry]] = {}
+        self.next: Dict[Entry, Optional[Entry]] = {}
+        self.ready: List[Tuple[float, int, Entry, Entry]] = []  # heap (thời điểm hợp lệ, stt, a, b)
+        self.seq = itertools.count()  # phá hoà trong heap để không phải so sánh Entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def live(self, e: Entry) -> bool:
+        return self.entries.get(e[2]) is e
+
+    def join(self, name: str, rating: float) -> bool:
+        if name in self.entries:
+            return False
+        e = self.entries[name] = (rating, self.clock(), name)
+        i = bisect.bisect_left(self.sorted, e)
+        s = self.sorted
+        j = i - 1
+        while j >= 0 and not self.live(s[j]):
+            j -= 1
+        k = i
+        while k < len(s) and not self.live(s[k]):
+            k += 1
+        left = s[j] if j >= 0 else None
+        right = s[k] if k < len(s) else None
+        s.insert(i, e)
+        self.prev[e], self.next[e] = left, right
+        if left: self.next[left] = e
+        if right: self.prev[right] = e
+        self._link(left, e)
+        self._link(e, right)
+        return True
+
+    def leave(self, name: str) -> bool:
+        e = self.entries.pop(name, None)
+        if e is None:
+            return False
+        left, right = self.prev.pop(e), self.next.pop(e)
+        if left: self.next[left] = right
+        if right: self.prev[right] = left
+        self._link(left, right)
+        if len(self.sorted) > 2 * len(self.entries) + 64:
+            self.sorted = [x for x in self.sorted if self.live(x)]
+        return True
+
+    def _link(self, a: Optional[Entry], b: Optional[Entry]):
+        """Đưa cặp liền kề (a, b) vào heap với thời điểm cả hai cửa sổ đều phủ được chênh lệch."""
+        if a is None or b is None:
+            return
+        gap = b[0] - a[0]
+        if gap > self.max_window:
+            return
+        at = max(a[1], b[1]) + max(0.0, gap - self.window) / self.widen
+        heapq.heappush(self.ready, (at, next(self.seq), a, b))
+
+    def pair(self, now: Optional[float] = None) -> List[Tuple[str, str]]:
+        """Một đợt ghép. Trả về các cặp (người chờ lâu hơn, người kia)."""
+        now = self.clock() if now is None else now
+        ready, pairs = self.ready, []
+        while ready and ready[0][0] <= now:
+            _, _, a, b = heapq.heappop(ready)
+            if not (self.live(a) and self.next.get(a) is b):
+                continue  # cặp đã cũ: một trong hai đã rời hàng hoặc có người chen vào giữa
+            self.leave(a[2]); self.leave(b[2])
+            pairs.append((a[2], b[2]) if a[1] <= b[1] else (b[2], a[2]))
+        if len(ready) > 4 * len(self.entries) + 64:
+            # dọn các cặp cũ còn nằm trong heap
+            self.ready = []
+            for a, b in self.next.items():
+                self._link(a, b)
+        return pairs
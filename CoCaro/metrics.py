@@ -0,0 +1,121 @@
+# Số liệu vận hành của server ở định dạng text của Prometheus
+import asyncio, bisect, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# mốc histogram thời gian (giây): từ vài micro giây tới vài giây
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "n")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.n = 0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(BUCKETS, v)] += 1
+        self.sum += v
+        self.n += 1
+
+class Metrics:
+    """Bộ đếm, histogram và gauge của một tiến trình server.
+
+    Server chỉ tạo đối tượng này khi bật --metrics-port; khi tắt, self.metrics là None
+    và mọi điểm đo trên đường nóng chỉ tốn một phép kiểm tra `if mt:`. Gauge là hàm
+    gọi lúc render, nên các giá trị như số client không phải cập nhật liên tục.
+    """
+    def __init__(self, labels: Optional[Dict[str, str]] = None):
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.gauges: Dict[str, Tuple[Callable[[], float], str]] = {}
+        self.help: Dict[str, str] = {}
+        self.base = ",".join(f'{k}="{v}"' for k, v in (labels or {}).items())
+        self.lag_task: Optional[asyncio.Task] = None
+
+    def inc(self, name: str, label: str = "", by: float = 1):
+        """label là chuỗi nhãn Prometheus đã định dạng sẵn, vd. 'type="move"'."""
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + by
+
+    def observe(self, name: str, v: float, label: str = ""):
+        h = self.histograms.get((name, label))
+        if h is None:
+            h = self.histograms[(name, label)] = Histogram()
+        h.observe(v)
+
+    def timed(self, name: str, fn: Callable, *args):
+        """Gọi fn(*args) và ghi thời gian chạy vào histogram name."""
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def gauge(self, name: str, fn: Callable[[], float], help: str = "", kind: str = "gauge"):
+        """Giá trị đọc lúc render; kind="counter" cho bộ đếm mà server đã tự giữ."""
+        self.gauges[name] = (fn, kind)
+        if help: self.help[name] = help
+
+    def describe(self, name: str, help: str):
+        self.help[name] = help
+
+    def _labels(self, *parts: str) -> str:
+        s = ",".join(p for p in (self.base,) + parts if p)
+        return "{" + s + "}" if s else ""
+
+    def render(self) -> str:
+        out: List[str] = []
+        def head(name: str, kind: str):
+            if name in self.help: out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} {kind}")
+        for name, (fn, kind) in sorted(self.gauges.items()):
+            head(name, kind)
+            out.append(f"{name}{self._labels()} {fn():g}")
+        last = None
+        for (name, label), v in sorted(self.counters.items()):
+            if name != last:
+                head(name, "counter"); last = name
+            out.append(f"{name}{self._labels(label)} {v:g}")
+        last = None
+        for (name, label), h in sorted(self.histograms.items()):
+            if name != last:
+                head(name, "histogram"); last = name
+            acc = 0
+            for le, c in zip(BUCKETS + ("+Inf",), h.counts):
+                acc += c
+                le = 'le="%s"' % le
+                out.append(f"{name}_bucket{self._labels(label, le)} {acc}")
+            out.append(f"{name}_sum{self._labels(label)} {h.sum:.6f}")
+            out.append(f"{name}_count{self._labels(label)} {h.n}")
+        return "\n".join(out) + "\n"
+
+    def start_lag_probe(self, interval: float = 0.5):
+        """Đo độ trễ event loop: ngủ interval giây rồi ghi phần ngủ lố."""
+        async def probe():
+            loop = asyncio.get_running_loop()
+            while True:
+                t0 = loop.time()
+                await asyncio.sleep(interval)
+                self.observe("caro_event_loop_lag_seconds", max(0.0, loop.time() - t0 - interval))
+        self.describe("caro_event_loop_lag_seconds", "Event loop oversleep per probe")
+        self.lag_task = asyncio.create_task(probe())
+
+    async def serve(self, host: str, port: int):
+        """Endpoint HTTP tối giản: mọi GET đều trả về render()."""
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode()
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: %d\r\n\r\n" % len(body) + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+        return await asyncio.start_server(handle, host, port)
+
+    def close(self):
+        if self.lag_task:
+            self.lag_task.cancel()
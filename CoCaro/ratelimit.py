@@ -0,0 +1,59 @@
+# Giới hạn tốc độ gói tin từ client theo thuật toán token bucket
+import time
+from typing import Dict, Optional, Tuple
+
+# loại gói -> (số gói mỗi giây, số gói dồn tối đa); "*" là giới hạn chung cho mọi loại
+LIMITS: Dict[str, Tuple[float, float]] = {
+    "*": (30, 60),
+    "move": (10, 20),
+    "chat": (1, 5),
+    "challenge": (0.5, 5),
+    "accept": (1, 5),
+    "history": (1, 10), "stats": (1, 10), "leaderboard": (1, 10), "list_matches": (1, 10),
+    "spectate": (1, 5), "unspectate": (1, 5),
+    "queue_join": (1, 5), "queue_leave": (1, 5),
+    "replay": (0.5, 3), "replay_stop": (1, 5),
+    "sync": (2, 10),
+}
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class RateLimiter:
+    """Các bucket của một client: một bucket chung và một bucket cho mỗi loại gói có
+    trong limits (tạo khi gặp lần đầu). Loại không có trong bảng chỉ chịu bucket chung."""
+    __slots__ = ("limits", "total", "buckets", "warned")
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = LIMITS):
+        self.limits = limits
+        now = time.monotonic()
+        rate, burst = limits["*"]
+        self.total = TokenBucket(rate, burst, now)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.warned = False  # đã báo "rate limited" cho đợt bị chặn hiện tại
+
+    def allow(self, t: Optional[str]) -> bool:
+        now = time.monotonic()
+        b = self.buckets.get(t)
+        if b is None and t in self.limits:
+            rate, burst = self.limits[t]
+            b = self.buckets[t] = TokenBucket(rate, burst, now)
+        # bucket riêng trước: gói bị chặn theo loại không tiêu token của bucket chung
+        ok = (b is None or b.take(now)) and self.total.take(now)
+        if ok:
+            self.warned = False
+        return ok
@@ -0,0 +1,169 @@
+# Tự chơi hàng loạt (không mạng, không giao diện) để phân tích offline và chỉnh bot
+import argparse, itertools, os, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # chỉ module này cần numpy; server/client vẫn chạy khi không cài
+    np = None
+
+import history
+from analysis import bounded_map
+from bot import WEIGHTS
+from common import BOARD_SIZE, DIRS, Board, encode_moves, find_win_line
+
+POLICIES = ("greedy", "random")
+# điểm cộng cho một ô khi cửa sổ chứa nó đang có k quân của một bên (như Engine.candidates)
+GAIN = [WEIGHTS[k+1] - WEIGHTS[k] for k in range(5)] + [0]
+# GAIN_AB[own*6 + opp]: điểm của cả cửa sổ (tấn công nếu không có quân đối thủ, phòng thủ nếu
+# không có quân mình), để mỗi hướng chỉ cần một lần tra bảng; int32 đủ chứa tổng 20 cửa sổ
+GAIN_AB = [(GAIN[a] if not b else 0) + (GAIN[b] if not a else 0) for a in range(6) for b in range(6)]
+
+def _span(n: int, d: int) -> Tuple[int, int]:
+    """Khoảng toạ độ bắt đầu của cửa sổ 5 ô theo một trục khi mỗi bước đi d ô."""
+    return (4, n) if d < 0 else (0, n - 4*d)
+
+def window_sums(a: "np.ndarray", dx: int, dy: int) -> "np.ndarray":
+    """a: (games, n, n). Trả về tổng 5 ô của mọi cửa sổ theo hướng (dx, dy); phần tử
+    [g, i, j] là cửa sổ bắt đầu tại ô thứ i, j của khoảng _span trên mỗi trục."""
+    n = a.shape[-1]
+    (x0, x1), (y0, y1) = _span(n, dx), _span(n, dy)
+    return sum(a[:, y0 + k*dy:y1 + k*dy, x0 + k*dx:x1 + k*dx] for k in range(5))
+
+def five_at(padded: "np.ndarray", xs: "np.ndarray", ys: "np.ndarray", side: int) -> "np.ndarray":
+    """padded: (games, n+8, n+8) bàn cờ có viền 4 ô trống. True ở những ván mà side có năm
+    liên tiếp đi qua ô (xs[g], ys[g]); chỉ nước vừa đi mới tạo được năm, nên chỉ cần xét
+    9 ô trên mỗi đường qua nó thay vì cả bàn."""
+    k = np.arange(-4, 5)
+    g = np.arange(len(padded))[:, None]
+    out = np.zeros(len(padded), bool)
+    for dx, dy in DIRS:
+        line = (padded[g, ys[:, None] + 4 + k*dy, xs[:, None] + 4 + k*dx] == side).view(np.uint8)
+        out |= (sum(line[:, i:i + 5] for i in range(5)) == 5).any(axis=1)
+    return out
+
+def scores(own: "np.ndarray", opp: "np.ndarray") -> "np.ndarray":
+    """Điểm tấn công + phòng thủ của từng ô cho cả lô, cùng công thức với Engine.candidates."""
+    n = own.shape[-1]
+    table = np.array(GAIN_AB, np.int32)
+    out = np.zeros(own.shape, np.int32)
+    for dx, dy in DIRS:
+        g = table.take(window_sums(own, dx, dy)*6 + window_sums(opp, dx, dy))
+        (x0, x1), (y0, y1) = _span(n, dx), _span(n, dy)
+        for k in range(5):
+            out[:, y0 + k*dy:y1 + k*dy, x0 + k*dx:x1 + k*dx] += g
+    return out
+
+def play_batch(games: int, size: int = BOARD_SIZE, policy: str = "greedy", noise: float = 0.1,
+               seed: Optional[int] = None):
+    """Chơi games ván cùng lúc; mỗi lượt đặt một quân vào mọi ván chưa kết thúc.
+
+    greedy chọn ô điểm cao nhất (hoà điểm thì ngẫu nhiên), riêng noise phần ván mỗi lượt
+    đi ngẫu nhiên để các ván không giống nhau; random luôn đi ngẫu nhiên.
+    Trả về (cells, lengths, winners): cells[g, i] là ô y*size+x của nước thứ i,
+    winners 1 = X, 2 = O, 0 = hoà.
+    """
+    rng = np.random.default_rng(seed)
+    padded = np.zeros((games, size + 8, size + 8), np.uint8)  # 0 trống, 1 X, 2 O; viền cho five_at
+    board = padded[:, 4:4 + size, 4:4 + size]
+    cells = np.zeros((games, size*size), np.int16)
+    lengths = np.zeros(games, np.int32)
+    winners = np.zeros(games, np.uint8)
+    active = np.arange(games)
+    for ply in range(size*size):
+        if not len(active):
+            break
+        side = 1 + ply % 2
+        b = board[active]
+        own, opp = (b == side).view(np.uint8), (b == 3 - side).view(np.uint8)
+        pick = rng.random(own.shape)  # trong [0, 1): chỉ phân định các ô cùng điểm
+        if policy == "greedy":
+            greedy = rng.random(len(active)) >= noise
+            pick[greedy] += scores(own[greedy], opp[greedy])
+        pick[b != 0] = -1
+        c = pick.reshape(len(active), -1).argmax(axis=1)
+        xs, ys = c % size, c // size
+        board[active, ys, xs] = side
+        cells[active, ply] = c
+        lengths[active] = ply + 1
+        won = five_at(padded[active], xs, ys, side)
+        winners[active[won]] = side
+        active = active[~won]
+    return cells, lengths, winners
+
+def board_of(cells: List[int], size: int) -> Board:
+    """Dựng Board (bitboard) từ dãy ô, X đi trước."""
+    b = Board(size)
+    for i, c in enumerate(cells):
+        b.place(c % size, c // size, "XO"[i % 2])
+    return b
+
+def batch_rows(job: Tuple[str, int, int, str, float, int]) -> List[Tuple]:
+    """Chạy trong process pool: chơi một lô rồi trả về các dòng theo INSERT_MATCH."""
+    prefix, games, size, policy, noise, seed = job
+    t0 = datetime.now().isoformat(timespec="seconds")
+    cells, lengths, winners = play_batch(games, size, policy, noise, seed)
+    t1 = datetime.now().isoformat(timespec="seconds")
+    px, po = f"{policy}#X", f"{policy}#O"
+    names = {0: "none", 1: px, 2: po}
+    rows = []
+    width = len(str(games - 1))
+    for g in range(games):
+        moves = cells[g, :lengths[g]].tolist()
+        b = board_of(moves, size)
+        line = []
+        if winners[g]:
+            last = moves[-1]
+            line = find_win_line(b, last % size, last // size, "XO"[winners[g] - 1])
+        # nước đi tự chơi không có thời điểm thật: ts = 0, phát lại sẽ dùng khoảng nghỉ tối thiểu
+        data = encode_moves([{"x": c % size, "y": c // size, "ts": 0} for c in moves], size)
+        # id đệm số 0 để thứ tự (finished_at, id) khi dựng lại stats/ratings trùng thứ tự đã ghi
+        rows.append((f"{prefix}g{g:0{width}d}", px, po, names[int(winners[g])], t0, t1, data,
+                     history.encode_line(line), b.digest()))
+    return rows
+
+def run(db_path: str, games: int, batch: int = 2000, size: int = BOARD_SIZE, policy: str = "greedy",
+        noise: float = 0.1, seed: Optional[int] = None, workers: Optional[int] = None) -> dict:
+    """Chia games thành các lô batch ván, chơi song song và ghi vào db_path (matches cùng
+    player_stats và ratings, như HistoryWriter)."""
+    if np is None:
+        raise RuntimeError("selfplay cần numpy (pip install numpy)")
+    stamp = int(time.time())
+    seeds = itertools.count(seed if seed is not None else stamp)
+    width = len(str((games - 1) // batch))
+    jobs = ((f"S{stamp}b{i:0{width}d}", min(batch, games - start), size, policy, noise, next(seeds))
+            for i, start in enumerate(range(0, games, batch)))
+    conn = history.connect(db_path)
+    totals = {"games": 0, "X": 0, "O": 0, "draw": 0}
+    t0 = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            for rows in bounded_map(pool, batch_rows, jobs, 2*(workers or os.cpu_count() or 1)):
+                history.write_matches(conn, rows)
+                for r in rows:
+                    totals["X" if r[3] == r[1] else ("O" if r[3] == r[2] else "draw")] += 1
+                totals["games"] += len(rows)
+    finally:
+        conn.close()
+    totals["seconds"] = round(time.perf_counter() - t0, 2)
+    return totals
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tự chơi hàng loạt bằng numpy, ghi kết quả vào DB lịch sử")
+    parser.add_argument("--db", default="selfplay.db", help="DB đích (nên tách khỏi game_history.db của server)")
+    parser.add_argument("--games", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=2000, help="số ván chơi cùng lúc trong một tiến trình")
+    parser.add_argument("--size", type=int, default=BOARD_SIZE)
+    parser.add_argument("--policy", choices=POLICIES, default="greedy")
+    parser.add_argument("--noise", type=float, default=0.1, help="tỉ lệ nước ngẫu nhiên của greedy")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--workers", type=int, help="số tiến trình (mặc định: số CPU)")
+    args = parser.parse_args()
+    if np is None:
+        parser.error("selfplay cần numpy (pip install numpy)")
+    t = run(args.db, args.games, args.batch, args.size, args.policy, args.noise, args.seed, args.workers)
+    n = t["games"] or 1
+    print(f"{t['games']} ván trong {t['seconds']}s ({t['games']/max(t['seconds'], 1e-9):.0f} ván/s): "
+          f"X thắng {100*t['X']/n:.1f}%, O thắng {100*t['O']/n:.1f}%, hoà {100*t['draw']/n:.1f}%")
@@ -1,9 +1,31 @@
-import asyncio, sqlite3, json, time
-from dataclasses import dataclass, field
+import argparse, asyncio, cProfile, gc, heapq, itertools, json, multiprocessing, os, secrets, signal, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
 from datetime import datetime
-from typing import Dict, Optional, List
+import re
+from typing import Dict, Optional, List, Set
 
-from common import BOARD_SIZE, THINK_TIME_SECONDS, send_json, recv_json, check_win
+from common import BOARD_SIZE, THINK_TIME_SECONDS, FrameTooLarge, send_json, recv_json, encode_moves, check_win, find_win_line, Board
+from fanout import Outbox, HoldBox, PresenceFanout, OVERFLOW_POLICIES, multicast
+from codec import negotiate, LINE_JSON
+import history
+from history import HistoryWriter, HistoryReader
+from timers import TimerWheel
+from cluster import ClusterLink, Coordinator, RemoteOutbox
+from bot import BotPlayer
+from matchmaking import Matchmaker
+from metrics import Metrics
+from ratelimit import LIMITS, RateLimiter
+import checkpoint
+from checkpoint import CheckpointLog
+
+# nhãn Prometheus định dạng sẵn cho các loại gói hợp lệ; loại lạ gộp vào "other"
+# để client không làm phình số chuỗi thời gian
+MSG_LABELS = {t: f'type="{t}"' for t in (
+    "challenge", "accept", "move", "chat", "history", "stats", "leaderboard", "list_matches",
+    "spectate", "unspectate", "queue_join", "queue_leave", "ping", "pong", "replay", "replay_stop", "sync", "other")}
+PING = {"type": "ping"}
+SYNC_DIFF_MAX = 32  # sync thiếu nhiều nước hơn thì gửi cả ảnh bàn cờ thay vì diff
 
 @dataclass
 class Client:
@@ -11,138 +33,855 @@ class Client:
     reader: asyncio.StreamReader
     writer: asyncio.StreamWriter
     in_match: Optional[str] = None
+    outbox: Optional[Outbox] = None
+    worker: Optional[int] = None       # khác None: người chơi nối vào worker khác (proxy)
+    match_owner: Optional[int] = None  # worker đang giữ trận in_match
+    spectating: Optional[str] = None
+    session: Optional[str] = None       # token cấp ở login_ok, dùng cho resume
+    detached_at: Optional[float] = None # khác None: mất kết nối, đang trong thời gian ân hạn
+    limiter: Optional[RateLimiter] = None
+    last_seen: float = 0.0              # time.monotonic() của gói gần nhất nhận từ client
+    heartbeat: bool = False             # client trả lời ping (khai báo codecs khi login/resume, hoặc đã gửi pong)
+    replay: Optional[asyncio.Task] = None
+
+@dataclass
+class TimeControl:
+    per_move: float = THINK_TIME_SECONDS  # tối đa cho một nước
+    total: Optional[float] = None         # quỹ thời gian cả ván của mỗi bên
+    increment: float = 0                  # cộng thêm sau mỗi nước (Fischer)
+
+    @classmethod
+    def from_msg(cls, d: Optional[Dict]) -> "TimeControl":
+        if not d:
+            return cls()
+        tc = cls(d.get("per_move", THINK_TIME_SECONDS), d.get("total"), d.get("increment", 0))
+        nums = [tc.per_move, tc.increment] + ([tc.total] if tc.total is not None else [])
+        # total = 0 (hoặc per_move = 0) sẽ hết giờ ngay nước đầu; bỏ qua total thì dùng None
+        if (not all(isinstance(v, (int, float)) and 0 <= v <= 24*3600 for v in nums)
+                or tc.per_move <= 0 or (tc.total is not None and tc.total <= 0)):
+            raise ValueError("bad time control")
+        return tc
 
 @dataclass
 class Match:
     id: str
     player_x: str
     player_o: str
-    board: List[List[str]] = field(default_factory=lambda: [["." for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)])
+    size: int = BOARD_SIZE
+    board: Board = None  # tạo trong __post_init__ theo size
     turn: str = "X"
     started_at: float = field(default_factory=time.time)
     moves: List[Dict] = field(default_factory=list)
     deadline: Optional[float] = None
+    tc: TimeControl = field(default_factory=TimeControl)
+    clock: Dict[str, float] = field(default_factory=dict)  # thời gian còn lại mỗi bên khi có tc.total
+    turn_started: float = 0.0
+    spectators: Set[str] = field(default_factory=set)
+    paused: Optional[float] = None  # thời gian còn lại của lượt khi người đi đang mất kết nối
+    paused_at: float = 0.0
+    win_line: List = field(default_factory=list)  # tính một lần ở nước thắng, dùng cho match_end và lịch sử
+    cells: bytearray = None  # ảnh bàn cờ '.XO' theo hàng, cấp sẵn một lần và sửa tại chỗ mỗi nước
+    snap: str = ""
+    snap_seq: int = -1       # số nước ứng với snap (chuỗi đã mã hoá của cells)
+
+    def __post_init__(self):
+        if self.board is None:
+            self.board = Board(self.size)
+        if self.cells is None:
+            self.cells = bytearray(b"." * (self.size * self.size))
+        if self.tc.total is not None and not self.clock:
+            self.clock = {"X": self.tc.total, "O": self.tc.total}
+
+    def place(self, x: int, y: int, symbol: str):
+        self.board.place(x, y, symbol)
+        self.cells[y*self.size + x] = 88 if symbol == "X" else 79  # ord("X"), ord("O")
+
+    def load_moves(self, xs: List[int], ys: List[int], ts: List[int]):
+        """Nạp cả dãy nước (X đi trước, xen kẽ) vào ván trống một lần, không qua place()
+        từng nước; dùng khi khôi phục checkpoint."""
+        b, size, cells = self.board, self.size, self.cells
+        stride, x_bits, o_bits = b.stride, 0, 0
+        for x, y in zip(xs[0::2], ys[0::2]):
+            x_bits |= 1 << (y*stride + x)
+            cells[y*size + x] = 88
+        for x, y in zip(xs[1::2], ys[1::2]):
+            o_bits |= 1 << (y*stride + x)
+            cells[y*size + x] = 79
+        b.x_bits, b.o_bits, b.count = x_bits, o_bits, len(xs)
+        self.moves = [{"x": x, "y": y, "symbol": s, "ts": t} for x, y, s, t in zip(xs, ys, "XO"*(len(xs)//2 + 1), ts)]
+        self.turn = "X" if len(xs) % 2 == 0 else "O"
+
+    def snapshot(self) -> str:
+        """Bàn cờ dạng chuỗi size*size ký tự; chỉ mã hoá lại khi đã có nước mới, nên
+        sync/spectate/resume lặp lại ở cùng một thế cờ dùng chung một chuỗi."""
+        if self.snap_seq != len(self.moves):
+            self.snap, self.snap_seq = self.cells.decode("ascii"), len(self.moves)
+        return self.snap
 
 class CaroServer:
-    def __init__(self, host="0.0.0.0", port=7777, db_path="game_history.db"):
+    def __init__(self, host="0.0.0.0", port=7777, db_path="game_history.db",
+                 outbox_size=256, overflow_policy="disconnect", presence_delay=0.05,
+                 commit_interval=0.2, timer_tick=0.1,
+                 worker_id: Optional[int] = None, cluster_path: Optional[str] = None,
+                 bot_name: Optional[str] = "Bot", bot_workers: int = 2, bot_think_time: float = 2.0,
+                 resume_grace: float = 30.0, queue_interval: float = 0.5, invite_ttl: float = 60.0,
+                 metrics_port: Optional[int] = None, metrics_host: str = "127.0.0.1",
+                 max_frame: int = 16384, login_timeout: float = 10.0, idle_timeout: float = 90.0,
+                 ping_interval: float = 30.0, rate_limits: Optional[Dict] = LIMITS,
+                 checkpoint_path: Optional[str] = None, checkpoint_interval: float = 0.2):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy must be one of {OVERFLOW_POLICIES}")
         self.host = host
         self.port = port
-        self.db = sqlite3.connect(db_path)
-        self.db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS matches (
-                id TEXT PRIMARY KEY,
-                player_x TEXT,
-                player_o TEXT,
-                winner TEXT,
-                started_at TEXT,
-                finished_at TEXT,
-                moves TEXT
-            )
-            """
-        )
-        self.db.commit()
+        self.outbox_size = outbox_size
+        self.overflow_policy = overflow_policy
+        self.history = HistoryWriter(db_path, commit_interval=commit_interval)
+        self.history_reader = HistoryReader(db_path)
         self.clients: Dict[str, Client] = {}
         self.matches: Dict[str, Match] = {}
-        self.pending_invites: Dict[tuple, bool] = {}
+        self.remote_matches: Dict[str, tuple] = {}  # cluster: id -> (worker, [x, o]) của trận ở worker khác
+        self.pending_invites: Dict[tuple, TimeControl] = {}
+        self.invites_of: Dict[str, Set[tuple]] = {}  # tên -> khoá lời mời có tên đó, dọn O(1) khi rời
+        self.reaped = {"clients": 0, "invites": 0, "matches": 0}
+        self.sessions: Dict[str, str] = {}  # token -> tên
+        self.resume_grace = resume_grace
+        self.invite_ttl = invite_ttl
+        self.queue_interval = queue_interval
+        self.matchmaker = Matchmaker()
+        self.ratings: Dict[str, float] = {}
+        self.queue_task: Optional[asyncio.Task] = None
+        self.timers = TimerWheel(self.on_timeouts, tick=timer_tick)
+        self.presence = PresenceFanout(lambda: (c.outbox for c in self.clients.values() if c.worker is None), presence_delay)
+        self.slow_disconnects = 0
+        # khác None trong lúc xử lý một nước đi: send()/publish() chỉ gom lại, flush_batch() gửi
+        self.batch: Optional[Dict[int, tuple]] = None
+        self.batch_watch: List[tuple] = []
+        self.max_frame = max_frame
+        self.login_timeout = login_timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.rate_limits = rate_limits  # None: tắt giới hạn tốc độ
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.throttled = 0
+        self.oversize_frames = 0
+        self.idle_disconnects = 0
+        self.login_timeouts = 0
+        self.worker_id = worker_id
+        self.cluster = ClusterLink(self, worker_id, cluster_path) if cluster_path else None
+        self.main_task: Optional[asyncio.Task] = None
+        self.bot_name = bot_name
+        self.bot_workers = bot_workers
+        self.bot_think_time = bot_think_time
+        self.bot_pool: Optional[ProcessPoolExecutor] = None
+        self.bot_slots: Optional[asyncio.Semaphore] = None  # số tìm kiếm đang chạy <= số tiến trình của pool
+        self.bot_seq = itertools.count(1)
+        # None khi tắt: các điểm đo trên đường nóng chỉ còn một phép kiểm tra
+        self.metrics = Metrics({"worker": str(worker_id)} if cluster_path else None) if metrics_port else None
+        self.metrics_addr = (metrics_host, metrics_port)
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint: Optional[CheckpointLog] = None
 
     async def start(self):
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
-        print(f"Server listening on {self.host}:{self.port}")
-        async with server:
-            await server.serve_forever()
+        self.main_task = asyncio.current_task()
+        try:
+            # SIGTERM (kill, systemd, docker stop) dừng như Ctrl+C: close() vẫn ghi nốt lịch sử
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # Windows, hoặc event loop không chạy ở main thread
+        if self.cluster:
+            await self.cluster.connect()
+        # điểm Elo và các trận khôi phục phải sẵn sàng trước khi nhận kết nối: resume tới sớm
+        # không được gặp "session expired", login mới không bị trận khôi phục ghi đè
+        self.ratings = await self.history_reader.run(history.load_ratings)
+        if self.checkpoint_path:
+            t0 = time.perf_counter()
+            # dựng hàng trăm nghìn đối tượng một lượt: tắt GC để nó không quét đi quét lại
+            # cả heap, xong thì freeze để các lần quét sau bỏ qua phần đã khôi phục
+            gc.disable()
+            try:
+                saved = checkpoint.load(self.checkpoint_path)
+                self.restore_matches(saved)
+            finally:
+                gc.enable()
+            gc.freeze()
+            print(f"Restored {len(saved)} matches from {self.checkpoint_path} in {(time.perf_counter() - t0)*1000:.0f} ms")
+            self.checkpoint = CheckpointLog(self.checkpoint_path, saved, interval=self.checkpoint_interval)
+        # limit chặn độ dài một dòng line-JSON; codec khung nhận max_frame qua read()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=self.max_frame,
+                                            reuse_port=True if self.cluster else None)
+        print(f"Server listening on {self.host}:{self.port}" + (f" (worker {self.worker_id})" if self.cluster else ""))
+        self.timers.start()
+        self.queue_task = asyncio.create_task(self.matchmaking_loop())
+        if self.idle_timeout > 0:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+        if self.metrics:
+            await self.start_metrics()
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass  # stop() là đường dừng bình thường
+        finally:
+            self.close()
+
+    def stop(self):
+        """Yêu cầu start() dừng lại (close() sẽ chạy trong finally)."""
+        if self.main_task:
+            self.main_task.cancel()
+
+    def close(self):
+        """Dừng server: ghi nốt các trận còn trong hàng đợi lịch sử."""
+        print("registry:", self.counts())
+        self.timers.stop()
+        if self.queue_task:
+            self.queue_task.cancel()
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        if self.metrics:
+            self.metrics.close()
+            if self.metrics_server:
+                self.metrics_server.close()
+        if self.bot_pool:
+            self.bot_pool.shutdown(cancel_futures=True)
+        self.history.close()
+        if self.checkpoint:
+            # các trận còn dở vẫn nằm trong log: lần khởi động sau sẽ khôi phục chúng
+            self.checkpoint.close()
+        self.history_reader.close()
+
+    async def start_metrics(self):
+        mt = self.metrics
+        mt.gauge("caro_clients", lambda: sum(1 for c in self.clients.values() if c.writer is not None and c.worker is None),
+                 "Connected clients on this process")
+        mt.gauge("caro_clients_detached", lambda: sum(1 for c in self.clients.values() if c.detached_at),
+                 "Clients waiting to resume")
+        mt.gauge("caro_matches", lambda: len(self.matches), "Active matches owned by this process")
+        mt.gauge("caro_queue_waiting", lambda: len(self.matchmaker), "Players in the matchmaking queue")
+        mt.gauge("caro_timers", lambda: len(self.timers), "Pending deadlines in the timer wheel")
+        mt.gauge("caro_invites", lambda: len(self.pending_invites), "Pending invites")
+        mt.gauge("caro_sessions", lambda: len(self.sessions), "Resumable session tokens")
+        for kind in self.reaped:
+            mt.gauge(f"caro_reaped_{kind}_total", lambda kind=kind: self.reaped[kind],
+                     f"{kind.capitalize()} removed when their player left", "counter")
+        mt.gauge("caro_slow_disconnects_total", lambda: self.slow_disconnects, "Clients dropped for a full outbox", "counter")
+        mt.gauge("caro_idle_disconnects_total", lambda: self.idle_disconnects, "Clients dropped by the idle timeout", "counter")
+        mt.gauge("caro_login_timeouts_total", lambda: self.login_timeouts, "Connections that never logged in", "counter")
+        mt.gauge("caro_oversize_frames_total", lambda: self.oversize_frames, "Connections closed for a frame over max_frame", "counter")
+        mt.describe("caro_throttled_total", "Client messages dropped by the rate limiter")
+        mt.gauge("caro_history_rows_written_total", lambda: self.history.written, "Matches committed to the history DB", "counter")
+        mt.gauge("caro_history_write_seconds_total", lambda: self.history.write_seconds,
+                 "Time spent in history DB transactions (writer thread)", "counter")
+        mt.gauge("caro_history_write_retries_total", lambda: self.history.retried,
+                 "History DB batches retried after a transient error", "counter")
+        mt.gauge("caro_history_rows_failed_total", lambda: self.history.failed,
+                 "Matches dropped after the history DB write kept failing", "counter")
+        mt.describe("caro_messages_total", "Client messages handled by client_loop")
+        mt.describe("caro_outbound_bytes_total", "Bytes written to client sockets")
+        mt.describe("caro_drain_seconds", "Time waiting on writer.drain (backpressure)")
+        mt.describe("caro_handle_move_seconds", "Time in handle_move")
+        mt.describe("caro_check_win_seconds", "Time in check_win")
+        mt.describe("caro_save_history_seconds", "Time in save_history on the event loop")
+        mt.start_lag_probe()
+        host, port = self.metrics_addr
+        if self.cluster:
+            port += self.worker_id  # mỗi worker một cổng riêng
+        self.metrics_server = await mt.serve(host, port)
+        print(f"Metrics on http://{host}:{port}/metrics")
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """Số đối tượng còn trong các chỉ mục và số đã dọn từ lúc khởi động."""
+        live = {"clients": len(self.clients), "sessions": len(self.sessions), "matches": len(self.matches),
+                "invites": len(self.pending_invites), "queue": len(self.matchmaker), "timers": len(self.timers)}
+        return {"live": live, "reaped": dict(self.reaped)}
+
+    def restore_matches(self, saved: Dict[bytes, List[bytes]]):
+        """Dựng lại các trận từ checkpoint. Cả hai người chơi coi như đang mất kết nối:
+        họ resume bằng token phiên cũ trong resume_grace giây, lượt đang đi được giữ
+        nguyên quỹ thời gian (thời gian server nằm xuống không bị tính)."""
+        now = time.time()
+        for mid, (info, xs, ys, ts, clock) in zip(saved, checkpoint.parse_all(saved)):
+            m = Match(mid.decode("ascii"), info["x"], info["o"], size=info["size"], tc=TimeControl(**info["tc"]),
+                      started_at=info["started_at"])
+            m.load_moves(xs, ys, ts)
+            if clock:
+                m.clock = clock
+            budget = m.tc.per_move if m.tc.total is None else min(m.tc.per_move, m.clock[m.turn])
+            m.paused, m.paused_at, m.turn_started = budget, now, now
+            self.matches[m.id] = m
+            for name, token in zip((m.player_x, m.player_o), info["sessions"]):
+                self.clients[name] = Client(name, None, None, in_match=m.id, outbox=HoldBox(), session=token,
+                                            detached_at=now)
+                self.sessions[token] = name
+                self.timers.schedule(("grace", name), now + self.resume_grace)
+
+    def new_limiter(self) -> Optional[RateLimiter]:
+        return RateLimiter(self.rate_limits) if self.rate_limits else None
+
+    def new_outbox(self, writer: asyncio.StreamWriter) -> Outbox:
+        return Outbox(writer, self.outbox_size, on_overflow=self.on_outbox_overflow, metrics=self.metrics)
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = None
         try:
-            msg = await recv_json(reader)
+            msg = await asyncio.wait_for(recv_json(reader), self.login_timeout)
+            if msg.get("type") == "resume":
+                client = await self.resume_session(msg, reader, writer)
+                if client:
+                    await self.client_loop(client)
+                return
             if msg.get("type") != "login" or not msg.get("name"):
                 await send_json(writer, {"type": "error", "msg": "Must login first"})
                 writer.close(); await writer.wait_closed(); return
             name = msg["name"].strip()
-            if name in self.clients:
+            if name in self.clients or self.is_bot_name(name) or (self.cluster and not await self.cluster.claim(name)):
                 await send_json(writer, {"type": "error", "msg": "Name already in use"})
                 writer.close(); await writer.wait_closed(); return
-            self.clients[name] = Client(name, reader, writer)
-            await send_json(writer, {"type": "login_ok", "users": list(self.clients.keys())})
-            await self.broadcast_user_list()
-            await self.client_loop(self.clients[name])
+            client = Client(name, reader, writer, limiter=self.new_limiter(), last_seen=time.monotonic(),
+                            heartbeat="codecs" in msg)
+            client.outbox = self.new_outbox(writer)
+            self.clients[name] = client
+            client.session = self.new_session(name)
+            codec = negotiate(msg.get("codecs"))
+            # login_ok luôn là line-JSON; sau đó hai bên mới chuyển sang codec đã chọn
+            self.send(client, {"type": "login_ok", "users": self.user_names(), "codec": codec.name,
+                               "session": client.session, "resume_grace": self.resume_grace})
+            client.outbox.codec = codec
+            self.presence.joined(name)
+            await self.client_loop(client)
+        except asyncio.TimeoutError:
+            self.login_timeouts += 1
+        except FrameTooLarge:
+            self.oversize_frames += 1
         except Exception:
             pass
         finally:
-            gone = None
-            for n, c in list(self.clients.items()):
-                if c.writer is writer:
-                    gone = n
-                    del self.clients[n]
-            await self.broadcast_user_list()
-            if gone:
-                print(f"{gone} disconnected")
-
-    async def broadcast_user_list(self):
-        users = list(self.clients.keys())
-        for c in list(self.clients.values()):
-            try:
-                await send_json(c.writer, {"type": "user_list", "users": users})
-            except:
-                pass
+            # client của chính kết nối này; nếu đã resume sang socket khác thì không đụng tới
+            c = client if client and client.writer is writer else None
+            if c:
+                c.outbox.close()
+                if c.in_match and self.resume_grace > 0:
+                    self.detach(c)
+                else:
+                    await self.reap_client(c)
+            # lỗi giao thức (gói quá lớn, JSON hỏng, hết giờ login) cũng phải đóng socket
+            writer.close()
+
+    async def reap_client(self, c: Client):
+        """Người chơi rời hẳn: xử thua trận đang dở (nếu có) rồi xoá khỏi mọi chỉ mục."""
+        m = self.matches.get(c.in_match)
+        if m:
+            self.reaped["matches"] += 1
+            await self.finish_match(m, winner=self.opponent_of(m, c.name), reason="disconnect")
+        self.drop_client(c)
+
+    def drop_client(self, c: Client):
+        if self.clients.get(c.name) is c:
+            del self.clients[c.name]
+            self.reaped["clients"] += 1
+        self.sessions.pop(c.session, None)
+        self.timers.cancel(("grace", c.name))
+        self.matchmaker.leave(c.name)
+        self.stop_replay(c)
+        self.drop_invites(c.name)
+        self.stop_spectating(c)
+        self.presence.left(c.name)
+        if self.cluster:
+            self.cluster.release(c.name)
+        print(f"{c.name} disconnected")
+
+    def new_session(self, name: str) -> str:
+        # trong cluster token mang id worker để worker khác biết phiên không ở chỗ mình
+        token = (f"w{self.worker_id}." if self.cluster else "") + secrets.token_urlsafe(16)
+        self.sessions[token] = name
+        return token
+
+    def detach(self, c: Client):
+        """Giữ chỗ cho người chơi mất kết nối giữa trận trong resume_grace giây; đồng hồ
+        lượt của họ dừng lại trong lúc đó (hết ân hạn thì xử thua)."""
+        c.outbox = HoldBox(c.outbox.codec)
+        c.reader = c.writer = None
+        c.detached_at = time.time()
+        self.stop_spectating(c)
+        self.stop_replay(c)
+        self.timers.schedule(("grace", c.name), c.detached_at + self.resume_grace)
+        m = self.matches.get(c.in_match)
+        if m and m.deadline and self.to_move(m) is c:
+            self.timers.cancel(m.id)
+            m.paused, m.paused_at, m.deadline = max(0.0, m.deadline - c.detached_at), c.detached_at, None
+        print(f"{c.name} detached, waiting {self.resume_grace:g}s for resume")
+
+    async def resume_session(self, msg: Dict, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Optional[Client]:
+        """Gắn socket mới vào Client cũ, gửi ảnh chụp trận rồi phát lại các nước đi
+        từ msg["seq"] (số nước client đã nhận) và các gói giữ lại khi mất kết nối."""
+        token = msg.get("session")
+        c = self.clients.get(self.sessions.get(token))
+        if c is None or c.session != token:
+            elsewhere = self.cluster and isinstance(token, str) and not token.startswith(f"w{self.worker_id}.")
+            await send_json(writer, {"type": "error", "msg": "session on another worker" if elsewhere else "session expired"})
+            writer.close(); await writer.wait_closed(); return None
+        if c.writer is not None:
+            # kết nối cũ chưa bị phát hiện là đã chết (half-open): thay nó bằng kết nối mới
+            old = c.outbox
+            self.detach(c)
+            old.abort()
+        held = c.outbox.held
+        self.timers.cancel(("grace", c.name))
+        c.reader, c.writer, c.detached_at = reader, writer, None
+        c.limiter = c.limiter or self.new_limiter()  # giữ bucket cũ: kết nối lại không xoá được giới hạn
+        c.last_seen = time.monotonic()
+        c.heartbeat = "codecs" in msg
+        c.outbox = self.new_outbox(writer)
+        codec = negotiate(msg.get("codecs"))
+        m = self.matches.get(c.in_match)
+        snap = None
+        seq = msg.get("seq")
+        if m:
+            you = "X" if c.name == m.player_x else "O"
+            snap = {"id": m.id, "you": you, "opponent": self.opponent_of(m, c.name), "size": m.size,
+                    "time": asdict(m.tc), "turn": m.turn, "seq": len(m.moves)}
+            if not isinstance(seq, int) or not 0 <= seq <= len(m.moves):
+                # client không còn trạng thái: gửi cả bàn cờ thay vì phát lại
+                snap["cells"] = m.snapshot()
+                seq = len(m.moves)
+        self.send(c, {"type": "resume_ok", "users": self.user_names(), "codec": codec.name,
+                      "session": c.session, "match": snap})
+        c.outbox.codec = codec
+        if m:
+            for i, mv in enumerate(m.moves[seq:], seq + 1):
+                self.send(c, {"type": "move_ok" if mv["symbol"] == snap["you"] else "opponent_move",
+                              "x": mv["x"], "y": mv["y"], "symbol": mv["symbol"], "seq": i})
+            if self.to_move(m) is c:
+                self.resume_turn(m, c)
+        for obj in held:
+            self.send(c, obj)
+        print(f"{c.name} resumed")
+        return c
+
+    def to_move(self, m: Match) -> Optional[Client]:
+        return self.clients.get(m.player_x if m.turn == "X" else m.player_o)
+
+    def resume_turn(self, m: Match, c: Client):
+        """Chạy tiếp đồng hồ lượt đã dừng khi c mất kết nối và báo lại your_turn."""
+        now = time.time()
+        if m.paused is not None:
+            m.turn_started += now - m.paused_at
+            m.deadline = now + m.paused
+            m.paused = None
+            self.timers.schedule(m.id, m.deadline)
+        if m.deadline:
+            msg = {"type": "your_turn", "deadline": int(m.deadline), "seq": len(m.moves)}
+            if m.clock:
+                msg["clock"] = {k: round(v, 1) for k, v in m.clock.items()}
+            self.send(c, msg)
+
+    def user_names(self) -> List[str]:
+        names = [n for n, c in self.clients.items() if not isinstance(c.outbox, BotPlayer)]
+        return names + [self.bot_name] if self.bot_name else names
+
+    def send(self, client: Client, obj: Dict):
+        """Xếp gói tin vào outbox của client; không chờ socket."""
+        batch = self.batch
+        if batch is None:
+            client.outbox.send(obj)
+        else:
+            entry = batch.get(id(client))
+            if entry is None:
+                batch[id(client)] = (client, [obj])
+            else:
+                entry[1].append(obj)
+
+    def flush_batch(self):
+        """Gửi lô của một nước đi: mỗi client một gói (một lần write), người đi trước vì
+        move_ok được gom đầu tiên, khán giả sau cùng."""
+        batch, self.batch = self.batch, None
+        for c, msgs in batch.values():
+            box = c.outbox
+            if len(msgs) > 1 and isinstance(box, Outbox):
+                box.send_many(msgs)
+            else:
+                for obj in msgs: box.send(obj)
+        watch, self.batch_watch = self.batch_watch, []
+        for m, watchers, msgs in watch:
+            self.multicast_watchers(m, watchers, msgs)
+
+    def on_outbox_overflow(self, box: Outbox):
+        if self.overflow_policy == "disconnect":
+            self.slow_disconnects += 1
+            box.abort()
 
     async def client_loop(self, client: Client):
-        reader, writer = client.reader, client.writer
+        reader, codec, mt = client.reader, client.outbox.codec, self.metrics
+        limiter, limit = client.limiter, self.max_frame
         while True:
-            msg = await recv_json(reader)
+            msg = await codec.read(reader, limit)
+            client.last_seen = time.monotonic()
+            if not isinstance(msg, dict):
+                self.send(client, {"type": "error", "msg": "bad request"})
+                continue
             t = msg.get("type")
-            if t == "challenge":
-                await self.handle_challenge(client, msg.get("opponent"))
-            elif t == "accept":
-                await self.handle_accept(client, msg.get("opponent"))
-            elif t == "move":
-                await self.handle_move(client, msg)
-            elif t == "chat":
-                await self.relay_chat(client, msg.get("text", ""))
+            if not isinstance(t, str):  # list/dict không băm được, làm hỏng tra bảng của limiter và metrics
+                t = msg["type"] = None
+            if mt:
+                mt.inc("caro_messages_total", MSG_LABELS.get(t, MSG_LABELS["other"]))
+            if limiter and not limiter.allow(t):
+                self.throttle(client, t)
+                continue
+            owner = self.remote_owner(client, msg) if self.cluster else None
+            if owner is not None:
+                self.cluster.send({"op": "forward", "worker": owner, "from": client.name, "msg": msg})
             else:
-                await send_json(writer, {"type": "error", "msg": "unknown type"})
+                await self.dispatch(client, msg)
+
+    def throttle(self, client: Client, t):
+        """Bỏ gói vượt giới hạn tốc độ; chỉ báo lỗi một lần cho mỗi đợt bị chặn."""
+        self.throttled += 1
+        if self.metrics:
+            self.metrics.inc("caro_throttled_total", MSG_LABELS.get(t, MSG_LABELS["other"]))
+        if not client.limiter.warned:
+            client.limiter.warned = True
+            self.send(client, {"type": "error", "msg": "rate limited", "for": t})
+
+    async def heartbeat_loop(self):
+        """Mỗi ping_interval giây: ping các client im lặng từ một khoảng ping_interval trở lên,
+        ngắt những client im lặng quá idle_timeout (pong cũng tính là có hoạt động).
+
+        Client cũ không biết ping (không có heartbeat) thì không bị ngắt vì im lặng: chúng
+        vẫn được ping, và kết nối đã chết sẽ lộ ra khi ghi gói ping bị lỗi."""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            quiet = []
+            for c in list(self.clients.values()):
+                if c.writer is None or c.worker is not None:
+                    continue  # bot, proxy của worker khác hoặc đang chờ resume
+                idle = now - c.last_seen
+                if idle >= self.idle_timeout and c.heartbeat:
+                    self.idle_disconnects += 1
+                    c.outbox.abort()
+                elif idle >= self.ping_interval:
+                    quiet.append(c.outbox)
+            multicast(quiet, [PING])
+
+    def remote_owner(self, client: Client, msg: Dict) -> Optional[int]:
+        """Worker phải xử lý msg nếu không phải worker này (trận hoặc lời mời nằm ở đó)."""
+        t = msg.get("type")
+        if t in ("move", "chat", "sync") and client.in_match and client.in_match not in self.matches:
+            return client.match_owner
+        if t == "sync" and client.spectating and client.spectating not in self.matches:
+            owner = re.search(r"w(\d+)$", client.spectating)
+            return int(owner.group(1)) if owner else None
+        if t in ("spectate", "unspectate"):
+            mid = msg.get("id") if t == "spectate" else client.spectating
+            owner = re.search(r"w(\d+)$", mid or "")
+            if mid not in self.matches and owner and int(owner.group(1)) != self.worker_id:
+                if t == "spectate":
+                    client.spectating = mid
+                else:
+                    client.spectating = None
+                return int(owner.group(1))
+        if t == "accept":
+            opp = self.clients.get(msg.get("opponent"))
+            if opp and opp.worker is not None:
+                return opp.worker
+        return None
+
+    async def on_cluster(self, msg: Dict):
+        op = msg["op"]
+        if op == "deliver":
+            c = self.clients.get(msg["to"])
+            if c and c.worker is None:
+                if c.outbox.codec is LINE_JSON and not c.detached_at:
+                    c.outbox.put(msg["data"].encode("utf-8"))
+                else:
+                    # data có thể gồm nhiều gói line-JSON đã gộp (flush_batch/publish), như BotPlayer.put
+                    for line in msg["data"].splitlines():
+                        c.outbox.send(json.loads(line))
+        elif op == "forward":
+            c = self.clients.get(msg["from"])
+            if c and c.worker is not None:
+                await self.dispatch(c, msg["msg"])
+        elif op == "joined":
+            self.add_remote(msg["name"], msg["worker"])
+        elif op == "left":
+            c = self.clients.get(msg["name"])
+            if c and c.worker is not None:
+                del self.clients[msg["name"]]
+                self.drop_invites(c.name)
+                self.stop_spectating(c)
+                m = self.matches.get(c.in_match)
+                if m:
+                    # người chơi ở worker khác đã rời hẳn (hết ân hạn hoặc không resume)
+                    self.reaped["matches"] += 1
+                    await self.finish_match(m, winner=self.opponent_of(m, c.name), reason="disconnect")
+                self.presence.left(msg["name"])
+        elif op == "snapshot":
+            # sau khi nối lại: bỏ người chơi/trận của worker khác đã kết thúc trong lúc mất link
+            for name in [n for n, c in self.clients.items() if c.worker is not None and n not in msg["names"]]:
+                await self.on_cluster({"op": "left", "name": name})
+            self.remote_matches.clear()
+            for name, w in msg["names"].items():
+                self.add_remote(name, w)
+            for mid, (w, players) in msg["matches"].items():
+                self.on_cluster_match(mid, w, players)
+        elif op == "match":
+            self.on_cluster_match(msg["id"], msg["worker"], msg["players"])
+        elif op == "match_end":
+            self.on_cluster_match(msg["id"], None, msg["players"])
 
-    async def handle_challenge(self, client: Client, opponent: str | None):
+    def on_cluster_reconnect(self):
+        """Link tới coordinator vừa được nối lại: coordinator đã quên tên và trận của worker
+        này (nếu nó kịp dọn link cũ), nên khai báo lại; rid -1 vì không chờ trả lời."""
+        for c in self.clients.values():
+            if c.worker is None and not isinstance(c.outbox, BotPlayer):
+                self.cluster.send({"op": "claim", "rid": -1, "name": c.name})
+        for m in self.matches.values():
+            self.cluster.send({"op": "match", "id": m.id, "players": [m.player_x, m.player_o]})
+
+    def add_remote(self, name: str, worker: int):
+        if name not in self.clients:
+            self.clients[name] = Client(name, None, None, outbox=RemoteOutbox(self.cluster, name), worker=worker)
+            self.presence.joined(name)
+
+    def on_cluster_match(self, match_id: str, worker: Optional[int], players: List[str]):
+        if worker is not None:
+            if worker != self.worker_id:
+                self.remote_matches[match_id] = (worker, players)
+        else:
+            self.remote_matches.pop(match_id, None)
+        for name in players:
+            c = self.clients.get(name)
+            if c is None:
+                continue
+            if worker is not None:
+                c.in_match, c.match_owner = match_id, worker
+            elif c.in_match == match_id:
+                c.in_match = c.match_owner = None
+
+    async def dispatch(self, client: Client, msg: Dict):
+        t = msg.get("type")
+        if t == "challenge":
+            await self.handle_challenge(client, msg.get("opponent"), msg.get("time"))
+        elif t == "accept":
+            await self.handle_accept(client, msg.get("opponent"))
+        elif t == "move":
+            # handle_move không có điểm chờ thật, nên lô chỉ chứa gói của chính nước đi này
+            self.batch = {}
+            try:
+                if self.metrics:
+                    t0 = time.perf_counter()
+                    await self.handle_move(client, msg)
+                    self.metrics.observe("caro_handle_move_seconds", time.perf_counter() - t0)
+                else:
+                    await self.handle_move(client, msg)
+            finally:
+                self.flush_batch()
+        elif t == "chat":
+            await self.relay_chat(client, msg.get("text", ""))
+        elif t in ("history", "stats", "leaderboard"):
+            await self.handle_query(client, t, msg)
+        elif t == "list_matches":
+            self.list_matches(client, msg)
+        elif t == "spectate":
+            self.handle_spectate(client, msg.get("id"))
+        elif t == "unspectate":
+            self.stop_spectating(client)
+        elif t == "queue_join":
+            self.queue_join(client)
+        elif t == "queue_leave":
+            self.send(client, {"type": "queue_left", "was_waiting": self.matchmaker.leave(client.name)})
+        elif t == "sync":
+            self.handle_sync(client, msg.get("since"))
+        elif t == "replay":
+            await self.handle_replay(client, msg.get("id"), msg.get("speed", 1.0))
+        elif t == "replay_stop":
+            self.stop_replay(client)
+        elif t == "ping":
+            self.send(client, {"type": "pong"})
+        elif t == "pong":
+            client.heartbeat = True  # client_loop đã cập nhật last_seen
+        else:
+            self.send(client, {"type": "error", "msg": "unknown type"})
+
+    async def handle_challenge(self, client: Client, opponent: str | None, time_control: Optional[Dict] = None):
+        if opponent and opponent == self.bot_name:
+            return await self.challenge_bot(client, time_control)
         if not opponent or opponent not in self.clients:
-            return await send_json(client.writer, {"type": "error", "msg": "opponent not found"})
+            return self.send(client, {"type": "error", "msg": "opponent not found"})
         if client.in_match or self.clients[opponent].in_match:
-            return await send_json(client.writer, {"type": "error", "msg": "someone already in a match"})
-        self.pending_invites[(client.name, opponent)] = True
-        await send_json(self.clients[opponent].writer, {"type": "invite", "from": client.name})
+            return self.send(client, {"type": "error", "msg": "someone already in a match"})
+        try:
+            tc = TimeControl.from_msg(time_control)
+        except (ValueError, TypeError, AttributeError):
+            return self.send(client, {"type": "error", "msg": "bad time control"})
+        self.add_invite(client.name, opponent, tc)
+        self.timers.schedule(("invite", client.name, opponent), time.time() + self.invite_ttl)
+        self.send(self.clients[opponent], {"type": "invite", "from": client.name, "time": asdict(tc)})
+
+    def add_invite(self, challenger: str, opponent: str, tc: TimeControl):
+        key = (challenger, opponent)
+        self.pending_invites[key] = tc
+        for name in key:
+            self.invites_of.setdefault(name, set()).add(key)
+
+    def drop_invite(self, challenger: str, opponent: str) -> Optional[TimeControl]:
+        self.timers.cancel(("invite", challenger, opponent))
+        key = (challenger, opponent)
+        tc = self.pending_invites.pop(key, None)
+        if tc is not None:
+            for name in key:
+                keys = self.invites_of.get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.invites_of[name]
+        return tc
+
+    def drop_invites(self, name: str):
+        """Bỏ mọi lời mời gửi đi hoặc nhận về của name."""
+        for a, b in list(self.invites_of.get(name, ())):
+            if self.drop_invite(a, b) is not None:
+                self.reaped["invites"] += 1
+
+    def expire_invite(self, challenger: str, opponent: str):
+        c = self.clients.get(challenger)
+        if self.drop_invite(challenger, opponent) is not None and c:
+            self.send(c, {"type": "invite_expired", "opponent": opponent})
+
+    def queue_join(self, client: Client):
+        if client.in_match:
+            return self.send(client, {"type": "error", "msg": "already in a match"})
+        rating = self.ratings.get(client.name, history.ELO_START)
+        self.matchmaker.join(client.name, rating)
+        self.send(client, {"type": "queue_ok", "rating": round(rating), "waiting": len(self.matchmaker)})
+
+    async def matchmaking_loop(self):
+        """Ghép trận theo đợt mỗi queue_interval giây thay vì mỗi lần có người vào hàng."""
+        while True:
+            await asyncio.sleep(self.queue_interval)
+            for a, b in self.matchmaker.pair():
+                ca, cb = self.clients.get(a), self.clients.get(b)
+                if ca and cb and not ca.in_match and not cb.in_match:
+                    self.add_invite(a, b, TimeControl())
+                    await self.handle_accept(cb, a)
+                else:
+                    for c in (ca, cb):
+                        if c and not c.in_match:
+                            self.matchmaker.join(c.name, self.ratings.get(c.name, history.ELO_START))
+
+    async def challenge_bot(self, client: Client, time_control: Optional[Dict]):
+        """Mỗi lời thách đấu bot tạo một BotPlayer riêng, nên nhiều trận với bot chạy song song."""
+        if client.in_match:
+            return self.send(client, {"type": "error", "msg": "someone already in a match"})
+        try:
+            tc = TimeControl.from_msg(time_control)
+        except (ValueError, TypeError, AttributeError):
+            return self.send(client, {"type": "error", "msg": "bad time control"})
+        if self.bot_pool is None:
+            self.bot_pool = ProcessPoolExecutor(self.bot_workers, mp_context=multiprocessing.get_context("spawn"))
+            self.bot_slots = asyncio.Semaphore(self.bot_workers)
+        bot = BotPlayer(self, self.bot_pool, self.bot_slots, min(self.bot_think_time, tc.per_move))
+        # lịch sử và Elo ghi dưới một tên cố định cho mỗi mức độ mạnh (thời gian nghĩ), không theo
+        # từng BotPlayer, để bảng xếp hạng không đầy bot dùng một lần
+        bot.rated_as = self.bot_name if bot.think_time >= self.bot_think_time else f"{self.bot_name}#{bot.think_time:g}s"
+        # trong cluster tên bot mang hậu tố worker như mã trận, để không trùng giữa các worker
+        suffix = f"w{self.worker_id}" if self.cluster else ""
+        bot.client = Client(f"{self.bot_name}#{next(self.bot_seq)}{suffix}", None, None, outbox=bot)
+        self.clients[bot.client.name] = bot.client
+        self.add_invite(client.name, bot.client.name, tc)
+        await self.handle_accept(bot.client, client.name)
+
+    def rated_name(self, name: str) -> str:
+        c = self.clients.get(name)
+        return c.outbox.rated_as if c and isinstance(c.outbox, BotPlayer) else name
+
+    def is_bot_name(self, name: str) -> bool:
+        return bool(self.bot_name) and (name == self.bot_name or name.startswith(self.bot_name + "#"))
+
+    def remove_bot(self, bot_client: Client):
+        if self.clients.get(bot_client.name) is bot_client:
+            del self.clients[bot_client.name]
+        bot_client.outbox.close()
 
     async def handle_accept(self, client: Client, opponent: str | None):
         if not opponent or (opponent, client.name) not in self.pending_invites:
-            return await send_json(client.writer, {"type": "error", "msg": "no invite found"})
-        del self.pending_invites[(opponent, client.name)]
-        match_id = f"M{int(time.time()*1000)}"
+            return self.send(client, {"type": "error", "msg": "no invite found"})
+        tc = self.drop_invite(opponent, client.name)
+        match_id = self.new_match_id()
         player_x = opponent
         player_o = client.name
-        m = Match(match_id, player_x, player_o)
+        m = Match(match_id, player_x, player_o, tc=tc)
         self.matches[match_id] = m
         self.clients[player_x].in_match = match_id
         self.clients[player_o].in_match = match_id
-        await send_json(self.clients[player_x].writer, {"type": "match_start", "you": "X", "opponent": player_o, "size": BOARD_SIZE})
-        await send_json(self.clients[player_o].writer, {"type": "match_start", "you": "O", "opponent": player_x, "size": BOARD_SIZE})
+        self.matchmaker.leave(player_x)
+        self.matchmaker.leave(player_o)
+        if self.cluster:
+            self.cluster.send({"op": "match", "id": match_id, "players": [player_x, player_o]})
+        if self.checkpoint and not (self.is_bot_name(player_x) or self.is_bot_name(player_o)):
+            # trận với bot không được log: BotPlayer không dựng lại được sau khi khởi động lại
+            self.checkpoint.submit(checkpoint.start_record(match_id, {
+                "x": player_x, "o": player_o, "size": m.size, "tc": asdict(tc),
+                "started_at": m.started_at, "sessions": [self.clients[player_x].session, self.clients[player_o].session]}))
+        self.send(self.clients[player_x], {"type": "match_start", "id": match_id, "you": "X", "opponent": player_o, "size": m.size, "time": asdict(tc), "seq": 0})
+        self.send(self.clients[player_o], {"type": "match_start", "id": match_id, "you": "O", "opponent": player_x, "size": m.size, "time": asdict(tc), "seq": 0})
         await self.start_turn_timer(m)
 
+    def new_match_id(self) -> str:
+        ms = int(time.time()*1000)
+        suffix = f"w{self.worker_id}" if self.cluster else ""
+        while f"M{ms}{suffix}" in self.matches:
+            ms += 1
+        return f"M{ms}{suffix}"
+
     async def start_turn_timer(self, m: Match):
-        cur_name = m.player_x if m.turn == "X" else m.player_o
-        cur_client = self.clients.get(cur_name)
-        if not cur_client:
+        now = time.time()
+        budget = m.tc.per_move
+        if m.tc.total is not None:
+            budget = min(budget, m.clock[m.turn])
+        m.turn_started = now
+        cur_client = self.to_move(m)
+        if cur_client and cur_client.detached_at:
+            # người đi đang mất kết nối: giữ nguyên quỹ thời gian tới khi resume
+            m.paused, m.paused_at, m.deadline = budget, now, None
             return
-        m.deadline = time.time() + THINK_TIME_SECONDS
-        await send_json(cur_client.writer, {"type": "your_turn", "deadline": int(m.deadline)})
+        m.deadline = now + budget
+        self.timers.schedule(m.id, m.deadline)
+        if cur_client:
+            msg = {"type": "your_turn", "deadline": int(m.deadline), "seq": len(m.moves)}
+            if m.clock:
+                msg["clock"] = {k: round(v, 1) for k, v in m.clock.items()}
+            self.send(cur_client, msg)
 
-        async def timer_task(match_id: str, expected_turn: str, deadline: float):
-            await asyncio.sleep(THINK_TIME_SECONDS)
-            mm = self.matches.get(match_id)
-            if not mm:
-                return
-            if mm.deadline and time.time() >= deadline and mm.turn == expected_turn:
-                winner = mm.player_o if expected_turn == "X" else mm.player_x
-                await self.finish_match(mm, winner=winner, reason="timeout")
+    def charge_clock(self, m: Match, symbol: str):
+        """Trừ thời gian đã nghĩ vào đồng hồ của symbol và cộng increment."""
+        self.timers.cancel(m.id)
+        m.deadline = None
+        if m.clock:
+            spent = time.time() - m.turn_started
+            m.clock[symbol] = max(0.0, m.clock[symbol] - spent) + m.tc.increment
 
-        asyncio.create_task(timer_task(m.id, m.turn, m.deadline))
+    async def on_timeouts(self, keys: List):
+        now = time.time()
+        for key in keys:
+            if isinstance(key, tuple):
+                if key[0] == "grace":
+                    await self.on_grace_expired(key[1])
+                else:
+                    self.expire_invite(key[1], key[2])
+                continue
+            m = self.matches.get(key)
+            if m and m.deadline and m.deadline <= now:
+                winner = m.player_o if m.turn == "X" else m.player_x
+                await self.finish_match(m, winner=winner, reason="timeout")
+
+    async def on_grace_expired(self, name: str):
+        c = self.clients.get(name)
+        if not c or not c.detached_at:
+            return
+        await self.reap_client(c)
 
     def opponent_of(self, m: Match, name: str) -> str:
         return m.player_o if name == m.player_x else m.player_x
@@ -150,53 +889,231 @@ class CaroServer:
     async def handle_move(self, client: Client, msg: Dict):
         match_id = client.in_match
         if not match_id or match_id not in self.matches:
-            return await send_json(client.writer, {"type": "error", "msg": "not in a match"})
+            return self.send(client, {"type": "error", "msg": "not in a match"})
         m = self.matches[match_id]
         symbol = "X" if client.name == m.player_x else "O"
         if symbol != m.turn:
-            return await send_json(client.writer, {"type": "error", "msg": "not your turn"})
+            return self.send(client, {"type": "error", "msg": "not your turn"})
         x, y = msg.get("x"), msg.get("y")
-        if not isinstance(x, int) or not isinstance(y, int) or not (0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE):
-            return await send_json(client.writer, {"type": "error", "msg": "bad coords"})
-        if m.board[y][x] != ".":
-            return await send_json(client.writer, {"type": "error", "msg": "occupied"})
-        m.board[y][x] = symbol
+        if not isinstance(x, int) or not isinstance(y, int) or not m.board.in_bounds(x, y):
+            return self.send(client, {"type": "error", "msg": "bad coords"})
+        if m.board.occupied(x, y):
+            return self.send(client, {"type": "error", "msg": "occupied"})
+        m.place(x, y, symbol)
         m.moves.append({"x": x, "y": y, "symbol": symbol, "ts": int(time.time())})
-        m.deadline = None
-        await send_json(client.writer, {"type": "move_ok", "x": x, "y": y, "symbol": symbol})
+        seq = len(m.moves)
+        self.charge_clock(m, symbol)
+        if self.checkpoint:
+            self.checkpoint.submit(checkpoint.move_record(m.id, x, y, m.moves[-1]["ts"], m.clock))
+        self.send(client, {"type": "move_ok", "x": x, "y": y, "symbol": symbol, "seq": seq})
         opp = self.clients.get(self.opponent_of(m, client.name))
         if opp:
-            await send_json(opp.writer, {"type": "opponent_move", "x": x, "y": y, "symbol": symbol})
-        if check_win(m.board, x, y, symbol):
+            self.send(opp, {"type": "opponent_move", "x": x, "y": y, "symbol": symbol, "seq": seq})
+        if m.spectators:
+            self.publish(m, {"type": "match_move", "id": m.id, "x": x, "y": y, "symbol": symbol, "seq": seq})
+        mt = self.metrics
+        if mt.timed("caro_check_win_seconds", check_win, m.board, x, y, symbol) if mt else check_win(m.board, x, y, symbol):
+            # check_win (bitboard) chạy mỗi nước; đường thắng chỉ dò một lần khi đã biết là thắng
+            m.win_line = [[wx, wy] for wx, wy in find_win_line(m.board, x, y, symbol)]
             return await self.finish_match(m, winner=client.name, reason="win")
+        if m.board.is_full():
+            return await self.finish_match(m, winner=None, reason="draw")
         m.turn = "O" if m.turn == "X" else "X"
         await self.start_turn_timer(m)
 
     async def finish_match(self, m: Match, winner: Optional[str], reason: str):
-        for name in [m.player_x, m.player_o]:
+        self.timers.cancel(m.id)
+        if self.checkpoint:
+            self.checkpoint.submit(checkpoint.end_record(m.id))
+        m.deadline = m.paused = None
+        # tên ghi lịch sử/Elo; lấy trước khi gửi match_end vì BotPlayer tự gỡ mình khi nhận gói đó
+        rated = (self.rated_name(m.player_x), self.rated_name(m.player_o))
+        # cùng công thức với HistoryWriter, nên điểm trong bộ nhớ khớp với DB
+        score = 1.0 if winner == m.player_x else (0.0 if winner == m.player_o else 0.5)
+        rx, ro = history.elo(self.ratings.get(rated[0], history.ELO_START),
+                             self.ratings.get(rated[1], history.ELO_START), score)
+        self.ratings[rated[0]], self.ratings[rated[1]] = rx, ro
+        for name, key in zip((m.player_x, m.player_o), rated):
             c = self.clients.get(name)
             if c:
                 who = "you" if winner == name else ("opponent" if winner else "none")
-                await send_json(c.writer, {"type": "match_end", "reason": reason, "winner": who})
+                self.send(c, {"type": "match_end", "reason": reason, "winner": who, "rating": round(self.ratings[key]),
+                              "win_line": m.win_line, "seq": len(m.moves)})
                 c.in_match = None
-        self.save_history(m, winner)
+        if m.spectators:
+            self.publish(m, {"type": "match_over", "id": m.id, "reason": reason, "winner": winner or "none",
+                             "win_line": m.win_line, "seq": len(m.moves)})
+            for name in m.spectators:
+                c = self.clients.get(name)
+                if c and c.spectating == m.id:
+                    c.spectating = None
+            m.spectators.clear()
+        if self.metrics:
+            self.metrics.timed("caro_save_history_seconds", self.save_history, m, score, rated)
+        else:
+            self.save_history(m, score, rated)
         if m.id in self.matches:
             del self.matches[m.id]
+        if self.cluster:
+            self.cluster.send({"op": "match_end", "id": m.id, "players": [m.player_x, m.player_o]})
+
+    def list_matches(self, client: Client, msg: Dict):
+        """Các trận đang chơi theo thứ tự id, phân trang theo khoá như history/leaderboard:
+        msg["after"] là id cuối của trang trước, "next" khác None khi còn trang sau. Trong
+        cluster có cả trận của worker khác (chỉ biết tên người chơi)."""
+        limit = msg.get("limit", 20)
+        if not isinstance(limit, int) or not 1 <= limit <= 100:
+            limit = 20
+        after = msg.get("after")
+        if after is not None and not isinstance(after, str):
+            return self.send(client, {"type": "error", "msg": "bad cursor"})
+        ids = itertools.chain(self.matches, self.remote_matches)
+        page = heapq.nsmallest(limit + 1, ids if after is None else (mid for mid in ids if mid > after))
+        rows = []
+        for mid in page[:limit]:
+            m = self.matches.get(mid)
+            if m:
+                rows.append({"id": mid, "player_x": m.player_x, "player_o": m.player_o,
+                             "moves": len(m.moves), "spectators": len(m.spectators)})
+            else:
+                w, (px, po) = self.remote_matches[mid]
+                rows.append({"id": mid, "player_x": px, "player_o": po, "moves": None, "spectators": None, "worker": w})
+        self.send(client, {"type": "match_list", "matches": rows, "next": page[limit - 1] if len(page) > limit else None})
+
+    def handle_spectate(self, client: Client, match_id: Optional[str]):
+        m = self.matches.get(match_id)
+        if not m:
+            return self.send(client, {"type": "error", "msg": "match not found"})
+        self.stop_spectating(client)
+        m.spectators.add(client.name)
+        client.spectating = m.id
+        last = m.moves[-1] if m.moves else None
+        self.send(client, {
+            "type": "spectate_ok", "id": m.id, "player_x": m.player_x, "player_o": m.player_o,
+            "size": m.size, "turn": m.turn, "deadline": int(m.deadline) if m.deadline else None,
+            "cells": m.snapshot(), "last": [last["x"], last["y"]] if last else None, "seq": len(m.moves),
+        })
+
+    def handle_sync(self, client: Client, since):
+        """Trạng thái trận hiện tại cho người chơi hoặc khán giả: các nước từ since
+        (mảng phẳng x,y,x,y..., ký hiệu suy ra từ thứ tự vì X đi trước) nếu since hợp lệ và
+        đủ gần, ngược lại là ảnh bàn cờ đóng gói sẵn của Match."""
+        m = self.matches.get(client.in_match) or self.matches.get(client.spectating)
+        if not m:
+            return self.send(client, {"type": "error", "msg": "not in a match"})
+        n = len(m.moves)
+        msg = {"type": "sync", "id": m.id, "seq": n, "size": m.size, "turn": m.turn,
+               "deadline": int(m.deadline) if m.deadline else None}
+        if isinstance(since, int) and 0 <= since <= n and n - since <= SYNC_DIFF_MAX:
+            msg["since"] = since
+            msg["diff"] = [v for mv in m.moves[since:] for v in (mv["x"], mv["y"])]
+        else:
+            msg["cells"] = m.snapshot()
+        self.send(client, msg)
+
+    def stop_spectating(self, client: Client):
+        m = self.matches.get(client.spectating) if client.spectating else None
+        if m:
+            m.spectators.discard(client.name)
+        client.spectating = None
+
+    async def handle_replay(self, client: Client, match_id: Optional[str], speed):
+        if not isinstance(match_id, str) or not isinstance(speed, (int, float)) or not 0 <= speed <= 100:
+            return self.send(client, {"type": "error", "msg": "bad replay request"})
+        found = await self.history_reader.run(history.load_replay, match_id)
+        if found is None:
+            return self.send(client, {"type": "error", "msg": "match not found"})
+        self.stop_replay(client)
+        client.replay = asyncio.create_task(self.run_replay(client, *found, speed))
+
+    def stop_replay(self, client: Client):
+        if client.replay:
+            client.replay.cancel()
+            client.replay = None
+
+    async def run_replay(self, client: Client, info: Dict, size: int, moves: List, speed: float):
+        """Phát lại một trận đã lưu: replay_start, các nước theo nhịp thời gian thật chia
+        cho speed (speed 0: gửi cả trận trong một gói replay_moves), rồi replay_end kèm đường thắng."""
+        mid = info["id"]
+        header = {k: info[k] for k in history.MATCH_COLUMNS}  # win_line/board_hash để dành cho replay_end
+        self.send(client, {"type": "replay_start", **header, "size": size, "count": len(moves), "speed": speed})
+        board = Board(size)
+        if speed == 0:
+            for x, y, s, _ in moves: board.place(x, y, s)
+            self.send(client, {"type": "replay_moves", "id": mid, "moves": [[x, y] for x, y, _, _ in moves]})
+        else:
+            lo, hi = history.REPLAY_GAP
+            prev = moves[0][3] if moves else 0
+            for i, (x, y, s, ts) in enumerate(moves):
+                if i:
+                    await asyncio.sleep(min(hi, max(lo, ts - prev)) / speed)
+                prev = ts
+                board.place(x, y, s)
+                self.send(client, {"type": "replay_move", "id": mid, "i": i, "x": x, "y": y, "symbol": s})
+        line = info["win_line"]
+        if line is None:  # trận lưu trước khi có cột win_line
+            line = []
+            if moves and info["winner"] in (info["player_x"], info["player_o"]):
+                x, y, s, _ = moves[-1]
+                line = [list(p) for p in find_win_line(board, x, y, s)]
+        self.send(client, {"type": "replay_end", "id": mid, "winner": info["winner"], "win_line": line,
+                           "board_hash": info["board_hash"] or board.digest()})
+        client.replay = None
 
-    def save_history(self, m: Match, winner: Optional[str]):
-        self.db.execute(
-            "INSERT OR REPLACE INTO matches (id, player_x, player_o, winner, started_at, finished_at, moves) VALUES (?,?,?,?,?,?,?)",
+    def publish(self, m: Match, msg: Dict):
+        """Đẩy một sự kiện tới mọi khán giả của m. Gói tin được mã hoá một lần cho mỗi
+        codec; khán giả nào đầy hàng đợi thì bị gỡ khỏi trận (có thể spectate lại)
+        thay vì làm chậm người chơi."""
+        watchers = [c for c in map(self.clients.get, m.spectators) if c]
+        if self.batch is not None:
+            last = self.batch_watch[-1] if self.batch_watch else None
+            if last and last[0] is m and last[1] == watchers:
+                last[2].append(msg)  # match_move + match_over cùng một nước: chung một gói
+            else:
+                self.batch_watch.append((m, watchers, [msg]))
+            return
+        self.multicast_watchers(m, watchers, [msg])
+
+    def multicast_watchers(self, m: Match, watchers: List[Client], msgs: List[Dict]):
+        refused = set(multicast([c.outbox for c in watchers], msgs, best_effort=True))
+        for c in watchers:
+            if c.outbox in refused:
+                m.spectators.discard(c.name)
+                c.spectating = None
+
+    def save_history(self, m: Match, score: float, rated: tuple):
+        px, po = rated
+        self.history.submit(
             (
                 m.id,
-                m.player_x,
-                m.player_o,
-                winner or "none",
+                px,
+                po,
+                px if score == 1.0 else (po if score == 0.0 else "none"),
                 datetime.fromtimestamp(m.started_at).isoformat(timespec="seconds"),
                 datetime.now().isoformat(timespec="seconds"),
-                json.dumps(m.moves, ensure_ascii=False),
-            ),
+                encode_moves(m.moves, m.size),
+                history.encode_line(m.win_line),
+                m.board.digest(),
+            )
         )
-        self.db.commit()
+
+    async def handle_query(self, client: Client, t: str, msg: Dict):
+        name = msg.get("name") or client.name
+        limit = msg.get("limit", 20)
+        if not isinstance(limit, int) or not 1 <= limit <= 100:
+            limit = 20
+        cursor = msg.get("before") if t == "history" else msg.get("after")
+        if cursor is not None and not (isinstance(cursor, list) and len(cursor) == 2):
+            return self.send(client, {"type": "error", "msg": "bad cursor"})
+        if t == "history":
+            rows, nxt = await self.history_reader.run(history.player_history, name, cursor, limit)
+            self.send(client, {"type": "history", "name": name, "matches": rows, "next": nxt})
+        elif t == "stats":
+            stats = await self.history_reader.run(history.player_stats, name)
+            self.send(client, {"type": "stats", "name": name, "stats": stats})
+        else:
+            rows, nxt = await self.history_reader.run(history.leaderboard, cursor, limit)
+            self.send(client, {"type": "leaderboard", "rows": rows, "next": nxt})
 
     async def relay_chat(self, client: Client, text: str):
         match_id = client.in_match
@@ -205,7 +1122,80 @@ class CaroServer:
         m = self.matches[match_id]
         opp = self.clients.get(self.opponent_of(m, client.name))
         if opp:
-            await send_json(opp.writer, {"type": "chat", "from": client.name, "text": text})
+            self.send(opp, {"type": "chat", "from": client.name, "text": text})
+
+def run_profiled(path: Optional[str], fn, *fn_args):
+    """Gọi fn(*fn_args); có path thì chạy dưới cProfile và ghi kết quả ra path khi dừng
+    (Ctrl+C hoặc SIGTERM). Xem bằng: python -m pstats <path>."""
+    if not path:
+        return fn(*fn_args)
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        return fn(*fn_args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+        print(f"profile written to {path}")
+
+def run_worker(worker_id: int, args, cluster_path: str):
+    server = CaroServer(args.host, args.port, args.db, worker_id=worker_id, cluster_path=cluster_path,
+                        **server_options(args))
+    # mỗi worker một file profile riêng
+    run_profiled(args.profile and f"{args.profile}.w{worker_id}", asyncio.run, server.start())
+
+def server_options(args) -> Dict:
+    return {"bot_name": args.bot_name or None, "bot_workers": args.bot_workers, "bot_think_time": args.bot_think,
+            "resume_grace": args.resume_grace, "metrics_port": args.metrics_port, "metrics_host": args.metrics_host,
+            "max_frame": args.max_frame, "login_timeout": args.login_timeout, "idle_timeout": args.idle_timeout,
+            "ping_interval": args.ping_interval, "rate_limits": None if args.no_rate_limit else LIMITS,
+            "checkpoint_path": args.checkpoint, "checkpoint_interval": args.checkpoint_interval}
+
+def run_cluster(args):
+    """Chạy args.workers tiến trình cùng nghe một cổng (SO_REUSEPORT) và một Coordinator."""
+    cluster_path = os.path.join(tempfile.gettempdir(), f"caro-{args.port}.sock")
+    # không dùng daemon: worker cần được tạo process pool riêng cho bot
+    procs = [multiprocessing.Process(target=run_worker, args=(i, args, cluster_path))
+             for i in range(args.workers)]
+    for p in procs: p.start()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(Coordinator(cluster_path).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGTERM để worker dừng êm ngay (close() ghi nốt lịch sử) thay vì thử nối lại coordinator
+        for p in procs: p.terminate()
+        for p in procs: p.join(5)
+        for p in procs:
+            if p.is_alive(): p.kill()
 
 if __name__ == "__main__":
-    asyncio.run(CaroServer().start())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--db", default="game_history.db")
+    parser.add_argument("--workers", type=int, default=1, help="số tiến trình worker (Linux, SO_REUSEPORT)")
+    parser.add_argument("--bot-name", default="Bot", help="tên đối thủ máy (chuỗi rỗng để tắt)")
+    parser.add_argument("--bot-think", type=float, default=2.0, help="thời gian nghĩ tối đa mỗi nước của bot (giây)")
+    parser.add_argument("--bot-workers", type=int, default=2, help="số tiến trình tìm nước đi cho bot")
+    parser.add_argument("--resume-grace", type=float, default=30.0, help="số giây giữ trận cho người chơi mất kết nối (0 = xử thua ngay)")
+    parser.add_argument("--metrics-port", type=int, help="bật endpoint Prometheus ở cổng này (cluster: cổng + id worker)")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--max-frame", type=int, default=16384, help="kích thước tối đa một gói từ client (byte)")
+    parser.add_argument("--login-timeout", type=float, default=10.0, help="số giây chờ gói login/resume đầu tiên")
+    parser.add_argument("--idle-timeout", type=float, default=90.0, help="ngắt client im lặng quá số giây này (0 = tắt)")
+    parser.add_argument("--ping-interval", type=float, default=30.0, help="chu kỳ ping client im lặng (giây)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="tắt token bucket theo client (vd. khi chạy loadtest)")
+    parser.add_argument("--checkpoint", help="file log các trận đang chơi; khởi động lại sẽ khôi phục chúng")
+    parser.add_argument("--checkpoint-interval", type=float, default=0.2, help="chu kỳ ghi + fsync log checkpoint (giây)")
+    parser.add_argument("--profile", help="chạy dưới cProfile, ghi kết quả ra file này khi dừng (cluster: <file>.w<id>)")
+    args = parser.parse_args()
+    if args.workers > 1 and args.checkpoint:
+        parser.error("--checkpoint chỉ hỗ trợ chạy một tiến trình (tên người chơi trong cluster do coordinator giữ)")
+    if args.workers > 1:
+        run_cluster(args)
+    else:
+        run_profiled(args.profile, asyncio.run, CaroServer(args.host, args.port, args.db, **server_options(args)).start())
@@ -0,0 +1,75 @@
+import asyncio, time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+class TimerWheel:
+    """Bánh xe hẹn giờ dùng chung cho mọi hạn chót của server.
+
+    Mỗi khoá (vd. match id) có tối đa một hạn chót. schedule/cancel là O(1):
+    khoá được băm vào ô int(deadline/tick) % slots. Một task duy nhất quay bánh
+    xe mỗi tick và gọi on_expire một lần với cả lô khoá hết hạn.
+    """
+    def __init__(self, on_expire: Callable[[List[Hashable]], Awaitable[None]],
+                 tick: float = 0.1, slots: int = 512, clock: Callable[[], float] = time.time):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        self.where: Dict[Hashable, int] = {}
+        self.clock = clock
+        self.cursor = int(clock() / tick)
+        self.task: Optional[asyncio.Task] = None
+        self.fired = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """Đặt (hoặc dời) hạn chót của key."""
+        self.cancel(key)
+        # không cho rơi vào ô đã quay qua, nếu không sẽ phải đợi hết một vòng
+        idx = max(int(deadline / self.tick), self.cursor) % len(self.slots)
+        self.slots[idx][key] = deadline
+        self.where[key] = idx
+
+    def cancel(self, key: Hashable):
+        idx = self.where.pop(key, None)
+        if idx is not None:
+            del self.slots[idx][key]
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Quay tới thời điểm now, gỡ và trả về các khoá đã hết hạn."""
+        expired: List[Hashable] = []
+        target = int(now / self.tick)
+        n = len(self.slots)
+        # đứng yên quá một vòng thì chỉ cần duyệt mỗi ô một lần
+        start = max(self.cursor, target - n + 1)
+        for t in range(start, target + 1):
+            slot = self.slots[t % n]
+            if not slot:
+                continue
+            for key, dl in list(slot.items()):
+                if dl <= now:
+                    del slot[key]
+                    del self.where[key]
+                    expired.append(key)
+        self.cursor = target
+        return expired
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            expired = self.advance(self.clock())
+            if expired:
+                self.fired += len(expired)
+                try:
+                    await self.on_expire(expired)
+                except Exception as e:
+                    print(f"timer callback failed: {e}")